@@ -1,42 +1,76 @@
 import logging
 import os
+import sys
 from pathlib import Path
 
-import colorama
-import cyclone.web
-import i18n
-import requests_respectful
-from twisted.internet import protocol
-
 if __name__ == "__main__" and __package__ is None:
     __package__ = "FruityBot.bot"
 
+from .startup import profile
+
+# before anything else is imported, so those imports get timed too
+if "--profile-startup" in sys.argv:
+    profile.enable()
+
+with profile.phase("imports"):
+    import colorama
+    import i18n
+    import redis
+    from twisted.internet import protocol, reactor, task
+
 root_dir = Path(__file__).resolve().parent
 os.chdir(root_dir)
 colorama.init()
 (root_dir / "log").mkdir(exist_ok=True)
 
-from .logger import loginit
+with profile.phase("logging"):
+    from .logger import loginit
 
-loginit(root_dir)
+    loginit(root_dir)
 logger = logging.getLogger(__name__)
 
-from .utils import convert_time, Config
-from . import core_bot
-from .localize import tl, load_locales
-from . import database
-from . import app
+with profile.phase("bot imports"):
+    from .utils import convert_time, Config
+    from . import core_bot
+    from .localize import tl, load_locales
+    from . import database
 
 
 class FruityBot(core_bot.CoreBot):
     VERSION = 5
 
     def stop(self):
+        self.user_pref.flush()
         self.user_pref.database.close()
         super().stop()
 
+    def connectionLost(self, reason):
+        # the pool flush_user_pref runs on is stopped, so release writes what's pending instead
+        if self.user_pref_flusher.running:
+            self.user_pref_flusher.stop()
+        super().connectionLost(reason)
+
+    def release(self):
+        super().release()
+        # in the thread release runs in, once the commands still queued have changed what they will
+        try:
+            self.user_pref.flush()
+        except Exception:
+            logger.exception("FruityBot.release | user preference flush failed")
+        self.user_pref.database.close()
+
+    def flush_user_pref(self):
+        d = self.dispatcher.defer_to_pool(self.user_pref.flush)
+        d.addErrback(lambda failure: logger.error("User preference flush failed", exc_info=failure.value))
+        return d
+
     def reload_init(self):
         self.root_dir = root_dir
+        if getattr(self, 'user_pref_flusher', None) is not None:
+            # keep deferred writes of the table about to be replaced
+            reactor.callFromThread(self.user_pref_flusher.stop)
+            self.user_pref.flush()
+            self.user_pref.database.close()
         super().reload_init()
 
         user_pref_table = """CREATE TABLE IF NOT EXISTS user_pref(
@@ -47,12 +81,16 @@ class FruityBot(core_bot.CoreBot):
                              )"""
         # FOREIGN KEY (username) REFERENCES user_ids(username)
 
-        db_args = self.Config().mariadb
-        database_file = database.DatabaseFile(db_args.user, db_args.password, db_args.database)
+        db_args = self.Config().get("database", {})
+        with profile.phase("user preferences"):
+            database_file = database.from_config(self.Config())
 
-        self.user_pref = database.UserPrefTable(database_file, "user_pref", user_pref_table,
-                                                ['1970-01-01 00:00:00', None, 'en'])
-        self.user_pref.create()
+            self.user_pref = database.UserPrefTable(database_file, "user_pref", user_pref_table,
+                                                    ['1970-01-01 00:00:00', None, 'en'],
+                                                    cache_size=db_args.get("cache_size", 1024))
+            self.user_pref.create()
+        self.user_pref_flusher = task.LoopingCall(self.flush_user_pref)
+        reactor.callFromThread(self.user_pref_flusher.start, db_args.get("flush_interval", 30), now=False)
 
         # migrate database.db
         if Path("./user_pref.csv").resolve().is_file():
@@ -60,27 +98,30 @@ class FruityBot(core_bot.CoreBot):
             import datetime
             with Path("./user_pref.csv").resolve().open('r') as csv_file:
                 reader = csv.DictReader(csv_file, delimiter=',', quotechar='"')
+                rows = {}
                 for line in reader:
                     line["last_command"] = datetime.datetime.strptime(line["last_command"], "%Y-%m-%dT%H:%M:%S.%f%z") \
                         .strftime("%Y-%m-%d %H:%M:%S")
-                    self.user_pref[line.pop("username")] = {k: v for k, v in line.items()}
+                    rows[line.pop("username")] = {k: v for k, v in line.items()}
+                self.user_pref.set_many(rows)
             Path("./user_pref.csv").unlink()
 
         self.users = {}
-        load_locales()
+        with profile.phase("locales"):
+            load_locales(self.root_dir / "locale_cache.json")
         logger.debug("FruityBot.reload_init | bot initialized")
 
-    def before_command(self, e, full_command):
+    def before_command(self, e, command):
         logger.debug("FruityBot.before_command | starting")
 
         # check if user in database
         if not e.source.nick in self.user_pref:
-            logger.debug(f"FruityBot.before_command | user {e.source.nick} not in database")
+            logger.debug("FruityBot.before_command | user %s not in database", e.source.nick)
             self.msg(e.source.nick, tl("general.first_time", self.user_pref.get(e.source.nick).locale))
             self.user_pref[e.source.nick] = {}
 
         if convert_time(self.user_pref[e.source.nick].last_command) < convert_time(self.Config().main.last_update):
-            logger.debug(f"FruityBot.before_command | user {e.source.nick} outdated")
+            logger.debug("FruityBot.before_command | user %s outdated", e.source.nick)
             self.msg(e.source.nick, tl("general.update", self.user_pref[e.source.nick].locale))
             self.user_pref.update_last_command(e.source.nick)
 
@@ -107,7 +148,7 @@ class BotFactory(protocol.ReconnectingClientFactory):
             p.factory = self
             self.instance = p
             return p
-        except requests_respectful.exceptions.RequestsRespectfulRedisError:
+        except redis.RedisError:
             logger.exception("Redis Error")
 
     def clientConnectionLost(self, connector, reason):
@@ -145,6 +186,10 @@ if __name__ == "__main__":
     logger.info(f"Loading {_config.filename.name}")
     bot = reactor.connectTCP(_config().main.server, 6667, bot_factory)
 
+    with profile.phase("api server"):
+        import cyclone.web
+        from . import app
+
     app_api = cyclone.web.Application([
         (r"/api/is_online", app.OnlineHandler, {"connector": bot}),
         (r"/api/info", app.InfoHandler, {"connector": bot})
@@ -1,23 +1,32 @@
+import enum
+import hashlib
+import inspect
 import logging
-import zlib
+import numbers
 from abc import ABC
 from functools import partial, update_wrapper, wraps
 from typing import Iterable
 
-import dill
-
 from FruityBot.localize import tl
+from FruityBot.utils import LRUCache, SingleFlight
 
 logger = logging.getLogger(__name__)
 
 
-def command(func=None, *, cmd_help=None, aliases=tuple(), include_funcname=True):
+def command(func=None, *, cmd_help=None, aliases=tuple(), include_funcname=True, on_reactor=False):
+    """Mark a Module method as a command.
+
+    Commands normally block and are run on the bot's worker pool. Coroutine functions, and functions
+    declared with on_reactor=True (which must not block, and may return a Deferred), run on the reactor.
+    """
+
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             return f(*args, **kwargs)
 
         wrapper.__dict__["command"] = True
+        wrapper.__dict__["cmd_on_reactor"] = on_reactor or inspect.iscoroutinefunction(f)
         fname = f.__name__ if not f.__name__.startswith("cmd_") else f.__name__[4:]
         wrapper.__dict__["cmd_help"] = cmd_help if cmd_help and type(cmd_help) is str else f"help.{fname}"
 
@@ -62,27 +71,79 @@ def requires_args(f):
     return wrapper
 
 
+def cache_key(value):
+    """Reduce a cached function's arguments to plain values, so equal arguments give equal keys across processes."""
+    if isinstance(value, enum.Enum):
+        return cache_key(value.value)
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes)):
+        return value
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (tuple, list)):
+        return tuple(cache_key(i) for i in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, cache_key(v)) for k, v in value.items()))
+    raise TypeError(f"Can't build a cache key from {type(value).__qualname__}; pass cached(key=...)")
+
+
 class cached:
-    def __init__(self, f):
+    """Cache a Module method's results in process and in Redis (shared between bot processes).
+
+    Use as @cached or @cached(ttl=..., local_ttl=..., local_size=..., key=...). ttl is how long results stay
+    in Redis; the bounded in-process LRU keeps them for local_ttl (default: ttl). key receives the method's
+    arguments (without self) and returns what identifies the result; by default that is all of them.
+    Concurrent misses for the same key wait for a single call of the method.
+
+    Keys live under the bot's cache version and serializer, so bumping the version on reload drops every
+    result pickled from the old code.
+    """
+    _missing = object()
+
+    def __new__(cls, f=None, **kwargs):
+        if f is None:  # decorator has parentheses
+            return partial(cls, **kwargs)
+        return super().__new__(cls)
+
+    def __init__(self, f, *, ttl=60 * 60 * 12, local_ttl=None, local_size=256, key=None):
         self._f = f
+        self.ttl = ttl
+        self.key = key
+        self.local = LRUCache(local_size, ttl if local_ttl is None else local_ttl)
+        self.flight = SingleFlight()
         update_wrapper(self, f)
 
+    def redis_key(self, f_self, args, kwargs):
+        key_args = self.key(*args, **kwargs) if self.key is not None else (args, kwargs)
+        digest = hashlib.blake2b(repr(cache_key(key_args)).encode(), digest_size=12).hexdigest()
+        return (f"fruitybot:cache:v{f_self.bot.cache_version}:{f_self.bot.cache_serializer.name}:"
+                f"{type(f_self).__module__}.{type(f_self).__name__}.{self._f.__name__}:{digest}")
+
     def __call__(self, *args, **kwargs):
-        f_self, *__ = args
-        f = self._f
-        cache_redis = f_self.bot.cache_redis
+        f_self, *f_args = args
+        redis_key = self.redis_key(f_self, f_args, kwargs)
+
+        result = self.local.get(redis_key, self._missing)
+        if result is self._missing:
+            result = self.flight.do(redis_key, self._fetch, redis_key, f_self.bot, args, kwargs)
+        return result
+
+    def _fetch(self, redis_key, bot, args, kwargs):
+        # an earlier flight may have finished between the local miss and getting here
+        result = self.local.get(redis_key, self._missing)
+        if result is not self._missing:
+            return result
 
         # check if saved in redis
-        redis_key = f"{type(f_self).__module__}.{type(f_self).__name__}.{f.__name__}_{'_'.join(str(args))}"
-
-        if cache_redis.exists(redis_key):
-            return dill.loads(zlib.decompress(bytes(cache_redis.get(redis_key))))
+        data = bot.cache_redis.get(redis_key)
+        if data is not None:
+            result = bot.cache_serializer.loads(data)
         else:
-            result = f(*args, **kwargs)
-            cache_redis.set(redis_key,
-                            zlib.compress(dill.dumps(result, dill.HIGHEST_PROTOCOL)),
-                            ex=60 * 60 * 12)  # 12 hours
-            return result
+            result = self._f(*args, **kwargs)
+            bot.cache_redis.set(redis_key, bot.cache_serializer.dumps(result), ex=self.ttl)
+        self.local[redis_key] = result
+        return result
 
     def __get__(self, instance, owner):
         if instance is None:
@@ -97,6 +158,9 @@ class Module(ABC):
         self.bot = bot
         super().__init__()
 
+    def close(self):
+        """Called before a reload replaces this module; stop anything started in __init__ here."""
+
     def get_functions(self):
         function_names = [func for func in dir(self)
                           if callable(getattr(self, func))
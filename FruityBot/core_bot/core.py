@@ -1,14 +1,19 @@
 import importlib
+import inspect
 import logging
 import pathlib
 
 import redis
 from irc.client import Event, NickMask
-from twisted.internet import defer, reactor, threads
-from twisted.python import threadpool
+from twisted.internet import defer, reactor
 from twisted.words.protocols import irc
 
-from ..utils import Config, ThreadDict
+from .dispatcher import CommandDispatcher, QueueFull, maybe_deferred
+from .outbound import NOTICE, REPLY, OutboundQueue
+from .router import CommandRouter
+from ..serializers import get_serializer
+from ..startup import profile
+from ..utils import Config
 
 logger = logging.getLogger(__name__)
 
@@ -20,16 +25,16 @@ class CoreBot(irc.IRCClient):
     def dccSend(self, user, file):
         raise NotImplementedError
 
-    lineRate = 1
     heartbeatInterval = 64
+    lines_sent = 0
 
     VERSION = 1
 
+    CACHE_VERSION_KEY = "fruitybot:cache_version"
+
     def stop(self):
         self.quit()
         reactor.callFromThread(reactor.callLater, 5, reactor.callFromThread, reactor.stop)
-        for v in self.thread_pools.values():
-            reactor.callFromThread(v.stop)
 
     def reload_init(self):
         try:
@@ -51,17 +56,36 @@ class CoreBot(irc.IRCClient):
         self.nickname = self.Config().main.nick
         self.password = self.Config().main.password if self.Config().main.password else None
 
-        self.thread_pools = ThreadDict(10)
+        workers = self.Config().main.get("workers", 4)
+        max_queue = self.Config().main.get("max_queue", 5)
+        if getattr(self, 'dispatcher', None) is None:
+            self.dispatcher = CommandDispatcher(workers, max_queue)
+        else:
+            self.dispatcher.configure(workers, max_queue)
+
+        flood_rate = self.Config().main.get("flood_rate", 1)
+        flood_burst = self.Config().main.get("flood_burst", 5)
+        if getattr(self, 'outbound', None) is None:
+            self.outbound = OutboundQueue(self.send_msg, flood_rate, flood_burst)
+        else:
+            self.outbound.configure(flood_rate, flood_burst)
 
-        self.cache_redis = redis.Redis(port=6379, db=0)
+        with profile.phase("cache"):
+            self.cache_redis = redis.Redis(port=6379, db=0)
+            cache_args = self.Config().get("cache", {})
+            self.cache_serializer = get_serializer(cache_args.get("serializer", "pickle"),
+                                                   cache_args.get("compression", "zlib"))
+            self.cache_version = self.get_cache_version()
 
+        self.close_modules()
         self.modules = {}
 
         for module in self.Config().main.modules:
             logger.info(f"Loading module \"{module}\"")
-            imodule = importlib.import_module(f"..modules.{module}", package=__package__)
-            self.modules[f"{str(module).capitalize()}"] = (getattr(imodule, f"{str(module).capitalize()}")({}, self),
-                                                           imodule)
+            with profile.phase(f"module {module}"):
+                imodule = importlib.import_module(f"..modules.{module}", package=__package__)
+                self.modules[f"{str(module).capitalize()}"] = \
+                    (getattr(imodule, f"{str(module).capitalize()}")({}, self), imodule)
             logger.info(f"Module \"{module}\" loaded successfully")
 
         function_tuples = tuple((k, v[0].get_functions()) for k, v in self.modules.items())
@@ -73,11 +97,38 @@ class CoreBot(irc.IRCClient):
                 for key in func.__dict__["cmd_aliases"]:
                     self.alias_to_func[key] = func
         logger.debug(f"CoreBot.reload_init | aliases: {self.alias_to_func}")
+        self.router = CommandRouter(self.Config().main.prefix, self.alias_to_func)
 
         logger.debug(f"CoreBot.reload_init | functions loaded: {self.command_func_names}")
 
         self.whois_result = None
 
+    def close_modules(self):
+        """Stop the modules' loops, pools and threads, before a reload replaces them or the bot goes away."""
+        for module, __ in getattr(self, "modules", {}).values():
+            try:
+                module.close()
+            except Exception:
+                logger.exception("CoreBot.close_modules | failed to close %s", type(module).__qualname__)
+
+    def get_cache_version(self):
+        """The shared cache version; without redis, the one this process has (0 at first)."""
+        current = getattr(self, "cache_version", 0)
+        try:
+            # never back onto a namespace this process moved on from while redis was away
+            return max(current, int(self.cache_redis.get(self.CACHE_VERSION_KEY) or 0))
+        except redis.RedisError:
+            logger.warning("CoreBot.get_cache_version | redis unavailable, keeping version %d", current)
+            return current
+
+    def bump_cache_version(self):
+        """Move cached to a fresh namespace, e.g. once reloaded code may have changed what gets cached."""
+        try:
+            self.cache_version = self.cache_redis.incr(self.CACHE_VERSION_KEY)
+        except redis.RedisError:
+            logger.warning("CoreBot.bump_cache_version | redis unavailable, only bumping this process's version")
+            self.cache_version += 1
+
     def __init__(self, channel=None):
         self.channel = channel
 
@@ -86,6 +137,17 @@ class CoreBot(irc.IRCClient):
         logger.info(f"Trying nickname {self.nickname} on server {self.Config().main.server}"
                     f"{' using password ' + self.password if self.password is not None else ''}")
 
+    def connectionLost(self, reason):
+        super().connectionLost(reason)
+        # a reconnect builds a new bot, so this one's modules, queues and workers have to go
+        self.close_modules()
+        self.outbound.stop()
+        reactor.callInThread(self.release)
+
+    def release(self):
+        """Let queued commands finish and release the workers; runs in a thread once the connection is lost."""
+        self.dispatcher.stop()
+
     def irc_ERR_NICKNAMEINUSE(self, prefix, params):
         logger.warning(f"Someone of nickname {self.nickname} already exists")
         self.nickname = self.nickname + "_"
@@ -93,13 +155,14 @@ class CoreBot(irc.IRCClient):
         logger.info(f"Now using {self.nickname}")
 
     def signedOn(self):
+        profile.report("signed on")
         logger.info(f"Bot signed on as {self.nickname} at {self.Config().main.server}"
                     f"{' with password ' + self.password if self.password else ''}")
         if self.channel is not None:
             self.join(self.channel)
 
     def joined(self, channel):
-        self.msg(self.Config().main.owner, "Bot started.")
+        self.msg(self.Config().main.owner, "Bot started.", priority=NOTICE)
         logger.info(f"JOIN: BOT:{channel}")
 
     def privmsg(self, user_host, channel, msg):
@@ -109,7 +172,7 @@ class CoreBot(irc.IRCClient):
 
         # create pseudo-event object
         e = Event("privmsg", NickMask(user_host), channel, msg.split())
-        logger.info(f"MESSAGE: BOT:{self.nickname} <- USER:{e.source.nick}: {msg}")
+        logger.info("MESSAGE: BOT:%s <- USER:%s: %s", self.nickname, e.source.nick, msg)
         self.on_msg(e)
 
     def action(self, user_host, channel, msg):
@@ -119,73 +182,88 @@ class CoreBot(irc.IRCClient):
 
         # create pseudo-event object
         e = Event("action", NickMask(user_host), channel, ("!action " + msg).split())
-        logger.info(f"ACTION: BOT:{self.nickname} <- USER:{e.source.nick} {msg}")
+        logger.info("ACTION: BOT:%s <- USER:%s %s", self.nickname, e.source.nick, msg)
         self.on_msg(e)
 
     def on_msg(self, e):
         # check if message is a command
-        if ' '.join(e.arguments)[len(self.Config().main.prefix) - 1] == self.Config().main.prefix \
-                and len(' '.join(e.arguments)) > 1:
+        commands = self.router.parse(' '.join(e.arguments))
+        if commands:
             try:
-                # check if user has a threadpool
-                if e.source.nick in self.thread_pools:
-                    user_pool = self.thread_pools[e.source.nick]
-                else:
-                    user_pool = threadpool.ThreadPool(1, 1, e.source.nick)
-                    self.thread_pools[e.source.nick] = user_pool
-                threads.deferToThreadPool(reactor, user_pool, self.message_to_commands, e)
-                user_pool.start()
-            except Exception:
-                logger.exception("Deferred Exception")
-                # revert to single thread method
-                self.message_to_commands(e)
+                d = self.dispatcher.submit(e.source.nick, self.message_to_commands, e, commands)
+            except QueueFull:
+                logger.info("CoreBot.on_msg | queue full for %s, dropping message", e.source.nick)
+                self.msg(e.source.nick, "You have too many commands waiting; please wait for them to finish.")
+            else:
+                d.addErrback(lambda failure: logger.error("Command Exception", exc_info=failure.value))
 
-    def message_to_commands(self, e):
+    @defer.inlineCallbacks
+    def message_to_commands(self, e, commands):
         # if command is a compound multiple command (has semicolons) execute in order
-        for command in ' '.join(e.arguments).split(self.Config().main.prefix)[1].split(";"):
-            # for command in a list of full string minus prefix split by semicolons
-
-            self.do_command(e, command.strip())
-
-    def do_command(self, e, full_command):
-        command = full_command.split()[0]
-        # command word is first word
+        for command in commands:
+            yield self.do_command(e, command)
 
+    @defer.inlineCallbacks
+    def do_command(self, e, command):
         try:
-            if self.alias_to_func.get(command, None):
-                self.run_module_command(e, full_command)
+            if command.func:
+                yield self.run_module_command(e, command)
             else:
-                self.msg(e.source.nick, f"Invalid command: {command}. {self.Config().main.prefix}h for help.")
+                self.msg(e.source.nick, f"Invalid command: {command.name}. {self.router.prefix}h for help.")
         except Exception as exc:
             logger.exception("")
             self.msg(e.source.nick, f"An unhandled exception has occurred: {type(exc).__qualname__}, {exc}")
 
-    def run_module_command(self, e, full_command):
-        command = full_command.split()[0]
-        func = self.alias_to_func.get(command, None)
+    @defer.inlineCallbacks
+    def run_module_command(self, e, command):
+        func = command.func
         if not func:
             raise ModuleNotFoundError()
         module = type(func.__self__)
 
-        logger.debug(f"CoreBot.run_module_command | command incurred: {command}; function {func.__name__} "
-                     f"in module {module.__qualname__!s}")
+        logger.debug("CoreBot.run_module_command | command incurred: %s; function %s in module %s", command.name,
+                     func.__name__, module.__qualname__)
 
-        self.before_command(e, full_command)
-        ret = func(e)
+        # each command of a compound message only sees its own arguments
+        e = Event(e.type, e.source, e.target, [self.router.prefix + command.name, *command.args])
+
+        yield self.defer_call(self.before_command, e, command)
+        ret = yield self.defer_call(func, e)
         if ret and isinstance(ret, str):
-            logger.debug(f"CoreBot.run_module_command | sending returned string: {ret}")
+            logger.debug("CoreBot.run_module_command | sending returned string: %s", ret)
             self.msg(e.source.nick, ret)
-        self.after_command(e, full_command)
+        yield self.defer_call(self.after_command, e, command)
+
+    def defer_call(self, f, *args, **kwargs):
+        """Call f and return a Deferred of its result.
+
+        Coroutine functions and commands declared with on_reactor run on the reactor thread; anything
+        else is assumed to block and runs on the dispatcher's worker pool.
+        """
+        if inspect.iscoroutinefunction(f) or getattr(f, "cmd_on_reactor", False):
+            return maybe_deferred(f, *args, **kwargs)
+        return self.dispatcher.defer_to_pool(f, *args, **kwargs)
 
-    def before_command(self, e, full_command):
+    async def before_command(self, e, command):
         pass
 
-    def after_command(self, e, full_command):
+    async def after_command(self, e, command):
         pass
 
-    def msg(self, user, message, length=None):
-        logger.info(f"MESSAGE: BOT:{self.nickname} -> USER:{user}: {message}")
+    def msg(self, user, message, length=None, priority=REPLY):
+        """Queue message to user at priority (REPLY, PROGRESS or NOTICE); safe to call from any thread."""
+        logger.info("MESSAGE: BOT:%s -> USER:%s: %s", self.nickname, user, message)
+        reactor.callFromThread(self.outbound.put, user, message, length, priority)
+
+    def send_msg(self, user, message, length=None):
+        """Send message right away, returning how many lines it took; for OutboundQueue."""
+        sent = self.lines_sent
         super().msg(user, message, length)
+        return self.lines_sent - sent
+
+    def sendLine(self, line):
+        self.lines_sent += 1
+        super().sendLine(line)
 
     def get_whois(self):
         self.whois_result = defer.Deferred()
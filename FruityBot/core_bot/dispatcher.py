@@ -0,0 +1,102 @@
+import inspect
+import logging
+from collections import deque
+
+from twisted.internet import defer, threads
+from twisted.python import failure, threadpool
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+def maybe_deferred(f, *args, **kwargs):
+    """Call f on the current thread and wrap whatever it gives back (value, Deferred or coroutine) in a Deferred."""
+    try:
+        result = f(*args, **kwargs)
+    except Exception:
+        return defer.fail()
+    if inspect.iscoroutine(result):
+        return defer.ensureDeferred(result)
+    if isinstance(result, defer.Deferred):
+        return result
+    return defer.succeed(result)
+
+
+class CommandDispatcher:
+    """Keeps every user's jobs in order on the reactor, with one fixed-size thread pool for blocking work.
+
+    Each nick has its own queue and at most one job per nick is in flight, so a user's commands run
+    one after another while different users interleave. Jobs themselves run on the reactor and hand
+    blocking calls to the shared pool with defer_to_pool. Queue bookkeeping only happens on the
+    reactor thread, so no locking is needed.
+    """
+
+    def __init__(self, workers=4, max_queue=5, name="commands", pool=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.max_queue = max_queue
+        self.queues = {}
+
+        if pool is None:
+            pool = threadpool.ThreadPool(workers, workers, name)
+            pool.start()
+            self.reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+        self.pool = pool
+        self.stopped = False
+
+    def configure(self, workers, max_queue):
+        self.max_queue = max_queue
+        self.pool.adjustPoolsize(workers, workers)
+        logger.debug(f"CommandDispatcher.configure | {workers} workers, queue depth {max_queue}")
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.pool.stop()
+
+    def pending(self, nick):
+        """Number of jobs queued for nick, including the one currently running."""
+        return len(self.queues.get(nick, ()))
+
+    def defer_to_pool(self, f, *args, **kwargs):
+        """Run a blocking f on the shared pool, returning a Deferred fired on the reactor."""
+        return threads.deferToThreadPool(self.reactor, self.pool, f, *args, **kwargs)
+
+    def submit(self, nick, f, *args, **kwargs):
+        """Queue f to run on the reactor once every job already queued for nick has finished.
+
+        f may return a plain value, a Deferred or a coroutine; the job counts as running until that
+        finishes. Returns a Deferred firing with the result of f; raises QueueFull if nick already has
+        max_queue jobs waiting.
+        """
+        queue = self.queues.setdefault(nick, deque())
+        if len(queue) >= self.max_queue:
+            raise QueueFull(nick)
+
+        d = defer.Deferred()
+        queue.append((d, f, args, kwargs))
+        if len(queue) == 1:
+            self._run_next(nick)
+        return d
+
+    def _run_next(self, nick):
+        __, f, args, kwargs = self.queues[nick][0]
+        job = maybe_deferred(f, *args, **kwargs)
+        job.addBoth(self._job_done, nick)
+
+    def _job_done(self, result, nick):
+        queue = self.queues[nick]
+        d = queue.popleft()[0]
+        if queue:
+            self._run_next(nick)
+        else:
+            del self.queues[nick]
+
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
@@ -0,0 +1,109 @@
+import logging
+from collections import OrderedDict, deque
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# priority classes, sent in this order
+REPLY, PROGRESS, NOTICE = 0, 1, 2
+
+
+class OutboundQueue:
+    """Sends messages within the server's flood budget, fairly between recipients.
+
+    Replaces IRCClient.lineRate, which sends every line in one global queue, so a user getting a long
+    reply or a stream of progress bars delays everyone else. Here each priority class keeps a queue per
+    recipient, and recipients take turns a message at a time; a class is only served while every class
+    above it is empty. A recipient has at most one progress message queued: a newer one replaces it, and a
+    reply drops it, as it would only arrive after the reply it was the progress of.
+
+    The budget is a token bucket of rate lines a second, saving up to burst; a message split over several
+    lines costs one token each. send(user, message, length) sends a message and returns how many lines
+    that took. Everything here runs on the reactor; CoreBot.msg hands messages over from any thread.
+    """
+
+    def __init__(self, send, rate=1., burst=5, reactor=None, samples=1000):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = reactor.seconds()
+        self.queues = [OrderedDict() for __ in (REPLY, PROGRESS, NOTICE)]  # per class, user: deque of entries
+        self.send_call = None
+        self.waits = {}  # priority: deque of recent wait times
+        self.samples = samples
+        self.dropped = 0
+
+    def configure(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        logger.debug(f"OutboundQueue.configure | {rate} lines/s, bursts of {burst}")
+
+    def put(self, user, message, length=None, priority=REPLY):
+        """Queue a message to user; must be called on the reactor."""
+        queue = self.queues[priority].setdefault(user, deque())
+        entry = [message, length, self.reactor.seconds()]
+        if priority == PROGRESS and queue:
+            # superseded, but it keeps its place in line
+            queue[0][:2] = entry[:2]
+            self.dropped += 1
+        else:
+            queue.append(entry)
+            if priority == REPLY and self.queues[PROGRESS].pop(user, None):
+                self.dropped += 1
+        if self.send_call is None:
+            self._send()
+
+    def _take(self):
+        now = self.reactor.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0. if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def _send(self):
+        self.send_call = None
+        while any(self.queues):
+            wait = self._take()
+            if wait > 0:
+                self.send_call = self.reactor.callLater(wait, self._send)
+                return
+            priority, queues = next((priority, queues) for priority, queues in enumerate(self.queues) if queues)
+            user, queue = next(iter(queues.items()))
+            message, length, queued = queue.popleft()
+            if queue:
+                queues.move_to_end(user)
+            else:
+                del queues[user]
+            self.waits.setdefault(priority, deque(maxlen=self.samples)).append(self.reactor.seconds() - queued)
+            try:
+                lines = self.send(user, message, length)
+            except Exception:
+                logger.exception(f"OutboundQueue._send | sending to {user} failed")
+                lines = 1
+            self.tokens -= lines or 1
+
+    def pending(self, user=None):
+        """Number of messages queued, for user or for everyone."""
+        if user is None:
+            return sum(len(queue) for queues in self.queues for queue in queues.values())
+        return sum(len(queues.get(user, ())) for queues in self.queues)
+
+    def stop(self):
+        """Drop everything queued, e.g. once the connection is gone."""
+        if self.send_call is not None and self.send_call.active():
+            self.send_call.cancel()
+        self.send_call = None
+        for queues in self.queues:
+            queues.clear()
+
+    def metrics(self):
+        """Per priority: messages recently sent, and their queue wait p50/p99/max in seconds."""
+        result = {"queued": self.pending(), "superseded": self.dropped}
+        for priority, waits in sorted(self.waits.items()):
+            p50, p99 = numpy.percentile(waits, [50, 99])
+            result[priority] = {"count": len(waits), "p50": float(p50), "p99": float(p99), "max": max(waits)}
+        return result
@@ -0,0 +1,43 @@
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+ParsedCommand = namedtuple("ParsedCommand", ("name", "args", "func"))
+ParsedCommand.__doc__ = "One command of a message: the alias used, its arguments, and the bound command (None if unknown)."
+
+
+class CommandRouter:
+    """Turns raw message lines into ParsedCommands.
+
+    Built once per reload_init from the prefix and alias table, so parsing a line is a single pass
+    over it plus one dict lookup per command.
+    """
+
+    def __init__(self, prefix, alias_to_func):
+        self.prefix = prefix
+        self.prefix_len = len(prefix)
+        self.alias_to_func = dict(alias_to_func)
+
+    def is_command(self, line):
+        return len(line) > self.prefix_len and line.startswith(self.prefix)
+
+    def parse(self, line):
+        """Split a line into its commands; compound commands are separated by semicolons.
+
+        Returns an empty tuple if the line does not start with the prefix. Commands after the first may
+        repeat the prefix ("!np ...; !acc 99") or leave it out ("!np ...; acc 99").
+        """
+        if not self.is_command(line):
+            return ()
+
+        commands = []
+        for segment in line[self.prefix_len:].split(";"):
+            words = segment.split()
+            if not words:
+                continue
+            name = words[0]
+            if name.startswith(self.prefix) and len(name) > self.prefix_len:
+                name = name[self.prefix_len:]
+            commands.append(ParsedCommand(name, tuple(words[1:]), self.alias_to_func.get(name)))
+        return tuple(commands)
@@ -1,65 +1,346 @@
+import contextlib
 import datetime
 import functools
 import logging
-from threading import Lock
+import queue
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from threading import Lock, RLock
 
-import MySQLdb as mariadb
 import box
 
+from .utils import LRUCache, convert_time
+
 logger = logging.getLogger(__name__)
 
 
-class DatabaseFile:
-    def __init__(self, user, password, database):
-        self.db_args = (user, password, database)
-        self.database_name = database
-        self.execute_mutex = Lock()
-        self._conn = mariadb.connect(user=user, password=password)
-        self.execute(f"CREATE DATABASE IF NOT EXISTS {database}")
-        self.close()
-        self.connect(user, password, database)
-
-    def connect(self, user, password, database):
+class ConnectionPool:
+    """Hands database connections out to threads, keeping between min_size and max_size of them open.
+
+    connect is a callable returning a new DB-API connection. Connections idle for longer than
+    ping_interval seconds are health checked before being handed out again.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=5, ping_interval=60):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(f"Invalid pool size {min_size}-{max_size}")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.ping_interval = ping_interval
+
+        self.idle = queue.LifoQueue()  # (connection, time last released)
+        self.size = 0
+        self.size_mutex = Lock()
+        for __ in range(min_size):
+            self.release(self._new())
+
+    def _new(self):
+        with self.size_mutex as __:
+            if self.size >= self.max_size:
+                return None
+            self.size += 1
+        try:
+            conn = self._connect()
+        except Exception:
+            with self.size_mutex as __:
+                self.size -= 1
+            raise
+        logger.debug(f"ConnectionPool._new | connection made ({self.size}/{self.max_size})")
+        return conn
+
+    @staticmethod
+    def healthy(conn):
         try:
-            self._conn = mariadb.connect(user=user, password=password, database=database)
-            logger.debug("DatabaseFile.connect | connection made")
+            if hasattr(conn, "ping"):
+                conn.ping()
+            else:
+                conn.cursor().execute("SELECT 1")
             return True
-        except mariadb.Error:
-            logger.exception("")
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        """Take a connection, waiting up to timeout seconds (forever if None) when all are in use."""
+        try:
+            conn, released = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self._new()
+            if conn is not None:
+                return conn
+            conn, released = self.idle.get(timeout=timeout)
+
+        if time.monotonic() - released > self.ping_interval and not self.healthy(conn):
+            logger.debug("ConnectionPool.acquire | dropping dead connection")
+            self.discard(conn)
+            return self.acquire(timeout)
+        return conn
+
+    def release(self, conn):
+        self.idle.put((conn, time.monotonic()))
+
+    def discard(self, conn):
+        with self.size_mutex as __:
+            self.size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                conn, __ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+
+class Backend(ABC):
+    """A database engine behind DatabaseFile.
+
+    Queries are written with %s placeholders; prepare() turns them into what the driver expects.
+    table_info() returns one row per column of a table as (ordinal position, name, type, nullable,
+    default, position in primary key or 0).
+    """
+    name = None
+
+    @abstractmethod
+    def connect(self):
+        """Open a new DB-API connection."""
+
+    def create_database(self):
+        """Make sure the database exists; called once before the pool opens."""
+
+    def is_disconnect(self, exc):
         return False
 
+    def prepare(self, cmd):
+        return cmd
+
+    @abstractmethod
+    def table_info(self, database, table_name):
+        pass
+
+    @abstractmethod
+    def upsert_query(self, table_name, key_column, columns):
+        """An INSERT of (key_column, *columns) that updates columns when the key already exists."""
+
+
+class MariaDBBackend(Backend):
+    name = "mariadb"
+    # server gone away / lost connection during query
+    RECONNECT_ERRORS = (2006, 2013)
+
+    def __init__(self, user, password, database, driver=None):
+        if driver is None:
+            import MySQLdb as driver
+        self.driver = driver
+        self.user = user
+        self.password = password
+        self.database_name = database
+
+    def connect(self):
+        return self.driver.connect(user=self.user, password=self.password, database=self.database_name)
+
+    def create_database(self):
+        conn = self.driver.connect(user=self.user, password=self.password)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"CREATE DATABASE IF NOT EXISTS {self.database_name}")
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
+
+    def is_disconnect(self, exc):
+        return isinstance(exc, self.driver.OperationalError) and exc.args and exc.args[0] in self.RECONNECT_ERRORS
+
+    def table_info(self, database, table_name):
+        return database.execute(f"""
+            SELECT
+              col.ORDINAL_POSITION,
+              col.COLUMN_NAME,
+              col.COLUMN_TYPE,
+              col.IS_NULLABLE,
+              col.COLUMN_DEFAULT,
+              ifnull(kcu.ORDINAL_POSITION, 0)
+            FROM information_schema.COLUMNS col
+            LEFT JOIN information_schema.KEY_COLUMN_USAGE kcu
+                ON col.TABLE_SCHEMA=kcu.TABLE_SCHEMA
+                AND col.TABLE_NAME=kcu.TABLE_NAME
+                AND col.COLUMN_NAME=kcu.COLUMN_NAME
+            WHERE col.TABLE_SCHEMA=%s
+                AND col.TABLE_NAME=%s
+            ORDER BY col.ORDINAL_POSITION
+        """, (self.database_name, table_name))
+
+    def upsert_query(self, table_name, key_column, columns):
+        return f"""INSERT INTO {table_name}({', '.join((key_column, *columns))})
+            VALUES({', '.join(['%s'] * (len(columns) + 1))})
+            ON DUPLICATE KEY UPDATE {', '.join(f'{column}=VALUES({column})' for column in columns)}
+        """
+
+
+class SQLiteBackend(Backend):
+    """An embedded database file, for single-node bots and tests. Runs in WAL mode so reads don't block writes."""
+    name = "sqlite"
+
+    def __init__(self, path, timeout=10):
+        self.path = str(path)
+        self.database_name = self.path
+        self.timeout = timeout
+        # DATETIME columns come back as datetime, like they do from MariaDB
+        sqlite3.register_converter("DATETIME", lambda value: convert_time(value.decode()))
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def prepare(self, cmd):
+        return cmd.replace("%s", "?")
+
+    def table_info(self, database, table_name):
+        # PRAGMA table_info gives (cid, name, type, notnull, default, pk)
+        return tuple((cid + 1, name, col_type, "NO" if notnull else "YES", default, pk)
+                     for cid, name, col_type, notnull, default, pk
+                     in database.execute(f"PRAGMA table_info({table_name})"))
+
+    def upsert_query(self, table_name, key_column, columns):
+        return f"""INSERT INTO {table_name}({', '.join((key_column, *columns))})
+            VALUES({', '.join(['%s'] * (len(columns) + 1))})
+            ON CONFLICT({key_column}) DO UPDATE SET {', '.join(f'{column}=excluded.{column}' for column in columns)}
+        """
+
+
+BACKENDS = {backend.name: backend for backend in (MariaDBBackend, SQLiteBackend)}
+
+
+def from_config(config):
+    """Build the DatabaseFile selected by the "database" section of the bot configuration."""
+    backend_name = config.get("database", {}).get("backend", "mariadb")
+    if backend_name not in BACKENDS:
+        raise ValueError(f"Unknown database backend {backend_name}")
+
+    args = config[backend_name]
+    if backend_name == "mariadb":
+        backend = MariaDBBackend(args.user, args.password, args.database)
+    else:
+        backend = SQLiteBackend(args.path)
+    return DatabaseFile(backend, min_size=args.get("pool_min", 1), max_size=args.get("pool_max", 5))
+
+
+class DatabaseFile:
+    def __init__(self, backend, min_size=1, max_size=5):
+        self.backend = backend
+        self.database_name = backend.database_name
+
+        backend.create_database()
+        self.pool = ConnectionPool(backend.connect, min_size, max_size)
+        self._local = threading.local()
+
     def close(self):
-        self._conn.close()
+        self.pool.close()
 
-    @property
-    def conn(self):
-        return self._conn
+    def is_disconnect(self, exc):
+        return self.backend.is_disconnect(exc)
+
+    def table_info(self, table_name):
+        return self.backend.table_info(self, table_name)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run every execute of this thread inside the block on one connection, committing at the end.
+
+        The transaction is rolled back if the block raises. Nested blocks join the outer transaction.
+        """
+        if getattr(self._local, "conn", None) is not None:
+            yield self
+            return
+
+        conn = self.pool.acquire()
+        self._local.conn = conn
+        try:
+            yield self
+            conn.commit()
+        except BaseException as exc:
+            if self.is_disconnect(exc):
+                self.pool.discard(conn)
+                conn = None
+            else:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            if conn is not None:
+                self.pool.release(conn)
 
     def execute(self, cmd, args=None):
-        with self.execute_mutex as __:
-            if type(cmd) == str:
-                try:
-                    cursor = self.conn.cursor()
-                    cursor.execute(cmd, args)
-                except (AttributeError, mariadb.OperationalError) as exc:
-                    if eval(str(exc))[0] in [2013, 2006]:
-                        logger.debug("DatabaseFile.execute | reconnecting to db")
-                        self.connect(*self.db_args)
-                        cursor = self.conn.cursor()
-                        cursor.execute(cmd, args)
-                    else:
-                        raise
+        return self._run("execute", cmd, args)
+
+    def executemany(self, cmd, args):
+        return self._run("executemany", cmd, args)
+
+    def _run(self, method, cmd, args):
+        if type(cmd) != str:
+            raise TypeError
+
+        cmd = self.backend.prepare(cmd)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            # inside transaction(), which commits and handles errors itself
+            return self._cursor_run(conn, method, cmd, args)
+
+        conn = self.pool.acquire()
+        try:
+            try:
+                ret = self._cursor_run(conn, method, cmd, args)
+            except Exception as exc:
+                if not self.is_disconnect(exc):
+                    raise
+                logger.debug("DatabaseFile.execute | reconnecting to db")
+                self.pool.discard(conn)
+                # discarded; if reconnecting fails there's nothing left to clean up
+                conn = None
+                conn = self.pool.acquire()
+                ret = self._cursor_run(conn, method, cmd, args)
+            conn.commit()
+        except BaseException as exc:
+            if conn is not None:
+                if self.is_disconnect(exc):
+                    self.pool.discard(conn)
+                else:
+                    conn.rollback()
+                    self.pool.release(conn)
+            raise
+        self.pool.release(conn)
+        return ret
+
+    @staticmethod
+    def _cursor_run(conn, method, cmd, args):
+        cursor = conn.cursor()
+        try:
+            if args is None:
+                getattr(cursor, method)(cmd)
             else:
-                raise TypeError
-            ret = cursor.fetchall()
+                getattr(cursor, method)(cmd, args)
+            return cursor.fetchall()
+        finally:
             cursor.close()
-            self.conn.commit()
-            return ret
 
 
 class DatabaseTable:
-    def __init__(self, database, table_name, create_query, defaults):
-        if type(database) != DatabaseFile:
+    # cached marker for keys known not to be in the table
+    MISSING = object()
+    VERSION_STRIPES = 1024
+
+    def __init__(self, database, table_name, create_query, defaults, cache_size=1024):
+        if not isinstance(database, DatabaseFile):
             raise TypeError
         self.database = database
 
@@ -67,123 +348,313 @@ class DatabaseTable:
         self.create_query = create_query  # query to create the table
         self.defaults = defaults  # defaults of each column on the table
 
-        self.write_mutex = Lock()
+        # reentrant: writes look up the schema, which takes the mutex too
+        self.write_mutex = RLock()
+
+        # rows by primary key; writes only drop the key they touch, and rows are never changed in place
+        self.cache = LRUCache(cache_size)
+        # column updates waiting for flush(), by primary key
+        self.pending = {}
+        self.pending_mutex = Lock()
+        # bumped (under pending_mutex) whenever a key's row changes, by hash of the key; a lookup only caches
+        # the row it read if its version didn't change meanwhile
+        self.versions = [0] * self.VERSION_STRIPES
 
     def create(self):
         self._execute(self.create_query)
 
     def execute(self, cmd, args=tuple()):
-        logger.debug(f"DatabaseTable.execute | {' '.join(cmd.split())} with args {args}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("DatabaseTable.execute | %s with args %s", " ".join(cmd.split()), args)
         self._primary_keys.cache_clear()
         self._columns.cache_clear()
         self._table_info.cache_clear()
+        with self.pending_mutex as _:
+            self.versions = [version + 1 for version in self.versions]
+            self.cache.clear()
         return self._execute(cmd, args)
 
     def _execute(self, cmd, args=tuple()):
-        args = tuple(map(str, args))
-        return self.database.execute(cmd, args)
+        return self.database.execute(cmd, self._db_args(args))
+
+    def _executemany(self, cmd, rows):
+        return self.database.executemany(cmd, [self._db_args(args) for args in rows])
+
+    @staticmethod
+    def _db_args(args):
+        # None is NULL, everything else goes in as text
+        return tuple(i if i is None else str(i) for i in args)
 
     def has_key(self, key):
         return self.__contains__(key)
 
-    @functools.lru_cache()
+    def _row(self, values):
+        row = box.Box(dict(zip(self._columns(), values)))
+        with self.pending_mutex as _:
+            # the database has not seen these yet
+            row.update(self.pending.get(row[self._primary_keys()[0]], {}))
+        return row
+
+    def _version(self, key):
+        return self.versions[hash(key) % self.VERSION_STRIPES]
+
+    def _invalidate(self, key):
+        """Drop key's cached row and stop lookups already running from caching what they read."""
+        with self.pending_mutex as _:
+            self.versions[hash(key) % self.VERSION_STRIPES] += 1
+            self.cache.pop(key)
+
+    def _fill(self, key, row, version):
+        with self.pending_mutex as _:
+            if self._version(key) == version:
+                self.cache[key] = row
+
+    def _lookup(self, key):
+        row = self.cache.get(key)
+        if row is None:
+            version = self._version(key)
+            cursor = self._execute(f"SELECT * FROM {self.table_name} WHERE {self._primary_keys()[0]}=%s", (key,))
+            rows = [self._row(i) for i in cursor]
+            row = rows[0] if rows else self.MISSING
+            self._fill(key, row, version)
+        return row
+
     def __getitem__(self, key):
-        cursor = self._execute(f"SELECT * FROM {self.table_name} WHERE {self._primary_keys()[0]}=%s", (key,))
-        try:
-            obj = [box.Box(dict(zip(self._columns(), i))) for i in cursor][0]
-        except IndexError as exc:
-            raise KeyError from exc
-        if obj:
-            logger.debug(f"DatabaseTable.__getitem__ | getting {key}: {obj}")
-            return obj
-        else:
+        obj = self._lookup(key)
+        if obj is self.MISSING:
             raise KeyError(f"'{key}'")
+        logger.debug("DatabaseTable.__getitem__ | getting %s: %s", key, obj)
+        # cached rows are shared between threads, so callers get their own
+        return box.Box(obj)
 
     def get(self, key):
-        fallback = box.Box(dict(zip(self._columns(), (key, *self.defaults))))
         try:
             obj = self[key]
-            logger.debug(f"DatabaseTable.get | getting {key}: {obj}")
+            logger.debug("DatabaseTable.get | getting %s: %s", key, obj)
             return obj
         except KeyError:
-            logger.debug(f"DatabaseTable.get | getting {key}: {fallback}; key does not exist")
+            fallback = box.Box(dict(zip(self._columns(), (key, *self.defaults))))
+            logger.debug("DatabaseTable.get | getting %s: %s; key does not exist", key, fallback)
             return fallback
 
     def __setitem__(self, key, value):
         if type(value) in (tuple, list):
             # I doubt I'll ever use this directly, but it's here if ever I do.
             if key in self:
-                logger.debug(f"DatabaseTable.__setitem__ | setting {key}; full modify")
-                for k, v in dict(zip(self._columns(), (key, *value))):
-                    self.modify_row(key, k, v)
+                logger.debug("DatabaseTable.__setitem__ | setting %s; full modify", key)
+                self.modify_columns(key, dict(zip(self._value_columns(), value)))
             else:
-                logger.debug(f"DatabaseTable.__setitem__ | setting {key}; full insert")
+                logger.debug("DatabaseTable.__setitem__ | setting %s; full insert", key)
                 self.insert_row(key, value)
         elif type(value) == dict:
             if key in self:
-                logger.debug(f"DatabaseTable.__setitem__ | setting {key}; partial modify")
-                for k, v in value.items():
-                    self.modify_row(key, k, v)
+                logger.debug("DatabaseTable.__setitem__ | setting %s; partial modify", key)
+                self.modify_columns(key, value)
             else:
-                logger.debug(f"DatabaseTable.__setitem__ | setting {key}; partial insert")
-                self.__setitem__(key, tuple(value.get(*i)
-                                            for i in zip([v for v in self._columns()
-                                                          if v not in set(self._primary_keys())], self.defaults)))
+                logger.debug("DatabaseTable.__setitem__ | setting %s; partial insert", key)
+                self.__setitem__(key, tuple(value.get(*i) for i in zip(self._value_columns(), self.defaults)))
         else:
             raise TypeError
 
     def __delitem__(self, key):
         with self.write_mutex as _:
-            logger.debug(f"DatabaseTable.__delitem__ | deleting {key}")
+            logger.debug("DatabaseTable.__delitem__ | deleting %s", key)
+            with self.pending_mutex as __:
+                self.pending.pop(key, None)
             self._execute(f"DELETE FROM {self.table_name} WHERE {self._primary_keys()[0]}=%s", (key,))
-            self.__getitem__.cache_clear()
-            self.__contains__.cache_clear()
+            self._invalidate(key)
 
     def __iter__(self):
         return iter(self._execute(f"SELECT {self._primary_keys()[0]} FROM {self.table_name}"))
 
-    @functools.lru_cache()
     def __contains__(self, key):
-        ret = bool(self._execute(f"SELECT {self._primary_keys()[0]} FROM {self.table_name} "
-                                 f"WHERE {self._primary_keys()[0]}=%s",
-                                 (key,)))
-        logger.debug(f"DatabaseTable.__contains__ | checking {key}'s existence: "
-                     f"{'exists' if ret else 'does not exist'}")
+        ret = self._lookup(key) is not self.MISSING
+        logger.debug("DatabaseTable.__contains__ | checking %s's existence: %s", key,
+                     "exists" if ret else "does not exist")
         return ret
 
+    def get_many(self, keys, chunk_size=500):
+        """Get the rows of every key in keys that exists, by key.
+
+        Cached keys are not queried again; the rest are fetched with one IN (...) query per chunk_size keys.
+        """
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            row = self.cache.get(key)
+            if row is None:
+                missing.append(key)
+            elif row is not self.MISSING:
+                found[key] = box.Box(row)
+
+        primary_key = self._primary_keys()[0]
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            versions = [self._version(key) for key in chunk]
+            logger.debug("DatabaseTable.get_many | fetching %d rows", len(chunk))
+            rows = {row[primary_key]: row for row in map(self._row, self._execute(
+                f"SELECT * FROM {self.table_name} WHERE {primary_key} IN ({', '.join(['%s'] * len(chunk))})", chunk
+            ))}
+            for key, version in zip(chunk, versions):
+                row = rows.get(key, self.MISSING)
+                self._fill(key, row, version)
+                if row is not self.MISSING:
+                    found[key] = box.Box(row)
+        return found
+
+    def set_many(self, mapping, chunk_size=500):
+        """Set many rows at once; values are full rows or dicts of columns, like with __setitem__.
+
+        Existing rows get one UPDATE per set of changed columns and new rows one INSERT (filled with the
+        defaults), each sent with executemany in a single transaction.
+        """
+        value_columns = self._value_columns()
+        primary_key = self._primary_keys()[0]
+        existing = self.get_many(mapping, chunk_size)
+
+        inserts = []
+        updates = {}
+        for key, value in mapping.items():
+            if type(value) in (tuple, list):
+                value = dict(zip(value_columns, value))
+            elif type(value) != dict:
+                raise TypeError
+            if not set(value) <= set(value_columns):
+                raise ValueError
+
+            if key in existing:
+                if value:
+                    updates.setdefault(tuple(value), []).append((*value.values(), key))
+            else:
+                inserts.append((key, *(value.get(*i) for i in zip(value_columns, self.defaults))))
+
+        logger.debug("DatabaseTable.set_many | inserting %d rows, updating %d rows", len(inserts),
+                     sum(map(len, updates.values())))
+        # columns written per key; deferred updates to them are older than this
+        written = {key: columns for columns, rows in updates.items() for *__, key in rows}
+        written.update((key, value_columns) for key, *__ in inserts)
+        with self.write_mutex as _:
+            superseded = self._pending_of(written)
+            with self.database.transaction():
+                if inserts:
+                    self._executemany(f"""INSERT INTO {self.table_name}({', '.join((primary_key, *value_columns))})
+                        VALUES({', '.join(['%s'] * (len(value_columns) + 1))})
+                    """, inserts)
+                for columns, rows in updates.items():
+                    self._executemany(f"""UPDATE {self.table_name}
+                        SET {', '.join(f'{column}=%s' for column in columns)}
+                        WHERE {primary_key}=%s
+                    """, rows)
+                for key in mapping:
+                    self._invalidate(key)
+            self._drop_pending(superseded)
+
     def modify_row(self, key, column, value):
-        if column not in self._columns():
+        self.modify_columns(key, {column: value})
+
+    def modify_columns(self, key, changes):
+        """Change several columns of an existing row with a single UPDATE."""
+        if not set(changes) <= set(self._columns()):
             raise ValueError
 
         with self.write_mutex as _:
-            if self[key][column] != value:
-                logger.debug(f"DatabaseTable.modify_row | change {key}'s {column} to {value}")
+            row = self[key]
+            changes = {column: value for column, value in changes.items() if row[column] != value}
+            if changes:
+                logger.debug("DatabaseTable.modify_columns | change %s's %s", key, changes)
+                superseded = self._pending_of({key: changes})
                 self._execute(f"""UPDATE {self.table_name}
-                    SET {column}=%s
+                    SET {', '.join(f'{column}=%s' for column in changes)}
                     WHERE {self._primary_keys()[0]}=%s;
-                """, (value, key))
-                logger.debug(f"DatabaseTable.modify_row | {key}'s {column} changed to {value}")
+                """, (*changes.values(), key))
+                self._drop_pending(superseded)
             else:
-                logger.debug(f"DatabaseTable.modify_row | {key}'s {column} is already {value}")
-            self.__getitem__.cache_clear()
+                logger.debug("DatabaseTable.modify_columns | %s already has those values", key)
+            self._invalidate(key)
 
     def insert_row(self, key, value):
-        logger.debug(f"DatabaseTable.insert_row | inserting row {value} to {key}")
+        logger.debug("DatabaseTable.insert_row | inserting row %s to %s", value, key)
         with self.write_mutex as _:
+            superseded = self._pending_of({key: self._value_columns()})
             self._execute(f"""INSERT INTO {self.table_name}({', '.join(self._columns())})
                              VALUES({', '.join(['%s' if i is not None else 'NULL' for i in (key, *value)])})
                          """, (key, *tuple(i for i in value if i is not None)))
-            self.__getitem__.cache_clear()
-            self.__contains__.cache_clear()
+            self._invalidate(key)
+            self._drop_pending(superseded)
+
+    def _pending_of(self, written):
+        """The deferred updates to the columns of written ({key: columns}), which a write of them supersedes."""
+        with self.pending_mutex as _:
+            return {key: {column: self.pending[key][column] for column in columns if column in self.pending[key]}
+                    for key, columns in written.items() if key in self.pending}
+
+    def _drop_pending(self, superseded):
+        """Drop the deferred updates a write superseded, unless they were deferred again since."""
+        with self.pending_mutex as _:
+            for key, changes in superseded.items():
+                pending = self.pending.get(key)
+                if pending is None:
+                    continue
+                for column, value in changes.items():
+                    if pending.get(column, self.MISSING) is value:
+                        del pending[column]
+                if not pending:
+                    del self.pending[key]
+
+    def defer_update(self, key, column, value):
+        """Change column of an existing row right away in the cache, and in the database on the next flush()."""
+        if column not in self._columns():
+            raise ValueError
+
+        with self.pending_mutex as _:
+            self.pending.setdefault(key, {})[column] = value
+            # a lookup running now may have merged pending in before this
+            self.versions[hash(key) % self.VERSION_STRIPES] += 1
+            row = self.cache.get(key)
+            if row is not None and row is not self.MISSING:
+                # replaced, never changed in place, as other threads may be reading it
+                self.cache[key] = box.Box(row, **{column: value})
+        logger.debug("DatabaseTable.defer_update | %s's %s will be %s", key, column, value)
+
+    def flush(self):
+        """Write every deferred update, batching rows that change the same columns into one statement.
+
+        If writing fails, the updates are kept for the next flush (behind any made since) and the error raised.
+        """
+        # so a row deleted meanwhile doesn't get its updates back if this fails
+        with self.write_mutex as _:
+            with self.pending_mutex as __:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return 0
+
+            batches = {}
+            for key, changes in pending.items():
+                columns = tuple(sorted(changes))
+                batches.setdefault(columns, []).append((key, *(changes[column] for column in columns)))
+
+            primary_key = self._primary_keys()[0]
+            try:
+                with self.database.transaction():
+                    for columns, rows in batches.items():
+                        logger.debug("DatabaseTable.flush | writing %s of %d rows", ", ".join(columns), len(rows))
+                        self._executemany(self.database.backend.upsert_query(self.table_name, primary_key, columns),
+                                          rows)
+            except BaseException:
+                with self.pending_mutex as __:
+                    for key, changes in pending.items():
+                        self.pending[key] = {**changes, **self.pending.get(key, {})}
+                raise
+        return len(pending)
 
     @property
     def columns(self):
-        logger.debug(f"DatabaseTable.columns | retrieving")
+        logger.debug("DatabaseTable.columns | retrieving")
         return self._columns()
 
     @property
     def primary_keys(self):
-        logger.debug(f"DatabaseTable.primary_keys | retrieving")
+        logger.debug("DatabaseTable.primary_keys | retrieving")
         return self._primary_keys()
 
     @property
@@ -195,6 +666,10 @@ class DatabaseTable:
     def _columns(self):
         return tuple(i[1] for i in self._table_info())
 
+    def _value_columns(self):
+        # every column but the primary key, in the order of self.defaults
+        return [column for column in self._columns() if column not in set(self._primary_keys())]
+
     @functools.lru_cache()
     def _primary_keys(self):
         return tuple(i[0] for i in sorted(list((i[1], i[5]) for i in self._table_info()
@@ -203,27 +678,11 @@ class DatabaseTable:
     @functools.lru_cache()
     def _table_info(self):
         with self.write_mutex as _:
-            return self._execute(f"""
-                SELECT 
-                  col.ORDINAL_POSITION,
-                  col.COLUMN_NAME,
-                  col.COLUMN_TYPE,
-                  col.IS_NULLABLE,
-                  col.COLUMN_DEFAULT,
-                  ifnull(kcu.ORDINAL_POSITION, 0)
-                FROM information_schema.COLUMNS col
-                LEFT JOIN information_schema.KEY_COLUMN_USAGE kcu
-                    ON col.TABLE_SCHEMA=kcu.TABLE_SCHEMA
-                    AND col.TABLE_NAME=kcu.TABLE_NAME
-                    AND col.COLUMN_NAME=kcu.COLUMN_NAME
-                WHERE col.TABLE_SCHEMA='{self.database.database_name}'
-                    AND col.TABLE_NAME='{self.table_name}'
-            """)
+            return self.database.table_info(self.table_name)
 
 
 class UserPrefTable(DatabaseTable):
     def update_last_command(self, key):
-        self[key] = {
-            "last_command": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        }
+        # written on the next flush; only the latest time per user matters
+        self.defer_update(key, "last_command", datetime.datetime.utcnow().replace(microsecond=0))
         # "%Y-%m-%dT%H:%M:%S.%f%z"
@@ -1,7 +1,11 @@
+import functools
+import json
 import logging
+import os
+from types import MappingProxyType
 
 import i18n
-import pycountry
+from i18n.translator import TranslationFormatter
 
 logger = logging.getLogger(__name__)
 
@@ -10,31 +14,100 @@ class LocaleException(Exception):
     pass
 
 
-languages = [lang for lang in pycountry.languages]
-alpha_2_langs = [i.alpha_2 for i in languages if hasattr(i, 'alpha_2')]
+# (locale, "namespace.key"): translation, built by load_locales and replaced whole, never changed in place,
+# so tl reads it without locks or i18n's global locale settings
+translations = MappingProxyType({})
+locales = ()
+
+
+@functools.lru_cache(maxsize=None)
+def valid_locales():
+    """Every ISO 639-1 code; pycountry's catalog is only loaded the first time this is called."""
+    import pycountry
+    return frozenset(lang.alpha_2 for lang in pycountry.languages if hasattr(lang, 'alpha_2'))
 
 
 def tl(tl_namespace: str, locale: str):
     locale = 'en' if not locale else locale
-    i18n.set('locale', locale)
-    i18n.set('fallback', 'en')
-    result = i18n.t(tl_namespace)
-    if locale and locale.lower() not in alpha_2_langs:
+    if locale.lower() not in valid_locales():
         raise LocaleException("Invalid locale")
-    if result == tl_namespace:
-        raise LocaleException("No translation in any locale")
+    result = translations.get((locale, tl_namespace))
+    if result is None:
+        result = translations.get(('en', tl_namespace))
+        if result is None:
+            raise LocaleException("No translation in any locale")
     return result
 
 
-def load_locales():
-    for directory in i18n.config.get('load_path'):
-        for locale in alpha_2_langs:
+def locale_files(directories):
+    """{path: mtime_ns} of every namespace.locale.yml file in directories, from one listing of each."""
+    suffix = "." + i18n.config.get('file_format')
+    files = {}
+    for directory in directories:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(suffix) and entry.name.count(".") == 2:
+                    files[entry.path] = entry.stat().st_mtime_ns
+    return files
+
+
+def flatten(data, namespace, table, locale):
+    """Add data, a locale file's nested keys, to table under namespace the way i18n names them."""
+    for key, value in data.items():
+        # a dict with plural forms is one translation
+        if type(value) == dict and len(set(i18n.resource_loader.PLURALS).intersection(value)) < 2:
+            flatten(value, f"{namespace}.{key}", table, locale)
+        else:
+            table[locale, f"{namespace}.{key}"] = \
+                TranslationFormatter(value).format() if isinstance(value, str) else value
+
+
+def compile_translations(files):
+    """The (locale, key) table of files; placeholders are substituted up front, the same way i18n.t does
+    for a call without arguments."""
+    table = {}
+    for path in files:
+        namespace, locale, __ = os.path.basename(path).split(".")
+        try:
+            flatten(i18n.resource_loader.load_resource(path, locale), namespace, table, locale)
+        except i18n.resource_loader.I18nFileLoadError as e:
+            logger.warning(f"File not loaded; {e}")
+    return table
+
+
+def load_locales(cache=None):
+    """Compile the locale files in i18n's load path into translations.
+
+    With a cache path, the compiled table is saved there and reused while no locale file has been added,
+    removed or modified since.
+    """
+    global translations, locales
+    files = locale_files(i18n.config.get('load_path'))
+    table = None
+    if cache is not None:
+        try:
+            with open(cache, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached["files"] == files:
+                table = {(locale, key): value for locale, key, value in cached["translations"]}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if table is None:
+        table = compile_translations(files)
+        if cache is not None:
             try:
-                i18n.resource_loader.load_directory(directory, locale)
-            except i18n.resource_loader.I18nFileLoadError as e:
-                if "defined" not in str(e):
-                    logger.warning(f"File not loaded; {e}")
+                tmp = f"{cache}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({"files": files, "translations": [[*key, value] for key, value in table.items()]}, f)
+                os.replace(tmp, cache)
+            except OSError as e:
+                logger.warning(f"Locale cache not saved; {e}")
+        logger.debug("load_locales | compiled %d translations from %d files", len(table), len(files))
+
+    translations = MappingProxyType(table)
+    locales = tuple(dict.fromkeys(locale for locale, __ in table))
 
 
 def get_locales():
-    return list(i18n.translations.container.keys())
+    return list(locales)
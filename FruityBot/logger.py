@@ -1,10 +1,16 @@
+import atexit
 import json
 import logging
 import logging.config
+import logging.handlers
+import queue
+import re
 from functools import partial, update_wrapper
 
 
 class ColorFormatter(logging.Formatter):
+    """Expands $COLOR, $BGCOLOR (the record's level colors), $RESET, $BRIGHT, $<color> and $BG<color> in one
+    pass over the formatted record, with a substitution table per level built up front."""
     from colorama import Fore, Back, Style
     BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 
@@ -31,25 +37,50 @@ class ColorFormatter(logging.Formatter):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        sequences = {"RESET": self.Style.RESET_ALL, "BRIGHT": self.Style.BRIGHT}
+        for k, v in self.CCOLORS.items():
+            sequences[k] = self.COLOR_SEQ % (v + 30)
+            sequences["BG" + k] = self.COLOR_SEQ % (v + 40)
+        # longest first, so $BGRED isn't read as $BG... and $COLOR isn't cut short
+        names = sorted((*sequences, "COLOR", "BGCOLOR"), key=len, reverse=True)
+        self.pattern = re.compile(r"\$(" + "|".join(names) + ")")
+        self.substitutions = {}
+        for level_name, (color, bg_color) in self.COLORS.items():
+            table = dict(sequences, COLOR=color, BGCOLOR=bg_color)
+            self.substitutions[level_name] = partial(self.pattern.sub, lambda match, table=table: table[match[1]])
 
     def format(self, record):
-        level_name = record.levelname
-        color = self.COLORS[level_name][0]
-        bg_color = self.COLORS[level_name][1]
         message = logging.Formatter.format(self, record)
-        message = message.replace("$RESET", self.Style.RESET_ALL) \
-            .replace("$BRIGHT", self.Style.BRIGHT) \
-            .replace("$COLOR", color) \
-            .replace("$BGCOLOR", bg_color)
-        for k, v in self.CCOLORS.items():
-            message = message.replace("$" + k, self.COLOR_SEQ % (v + 30)) \
-                .replace("$BG" + k, self.COLOR_SEQ % (v + 40))
-        return message + self.Style.RESET_ALL
+        return self.substitutions[record.levelname](message) + self.Style.RESET_ALL
 
 
 def loginit(root_dir):
+    """Configure logging from root_dir/logging.json.
+
+    With "queue": true in it, the root logger's handlers run on a QueueListener thread; logging threads only
+    queue their records. Returns the listener, which is stopped (flushing what's queued) at exit.
+    """
     logging.ColorFormatter = ColorFormatter
-    logging.config.dictConfig(json.load(open((root_dir / 'logging.json'), 'r')))
+    with open(root_dir / 'logging.json', 'r') as f:
+        config = json.load(f)
+    use_queue = config.pop("queue", False)
+    logging.config.dictConfig(config)
+    if use_queue:
+        listener = start_queue(logging.getLogger())
+        atexit.register(listener.stop)
+        return listener
+
+
+def start_queue(logger):
+    """Move logger's handlers behind a QueueHandler, returning the started QueueListener that runs them."""
+    handlers = logger.handlers[:]
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
 
 
 START_STR = "starting"
@@ -68,10 +99,10 @@ def logger_deco_factory(logger):
             name_str = f"{type(instance).__name__}.{f.__name__}"
 
             args_kwargs_str = "; ".join((f"args = {args}" if args else "", f"kwargs = {kwargs}" if kwargs else ""))
-            logger.debug(" | ".join(i for i in (name_str, START_STR, args_kwargs_str) if i is not ""))
+            logger.debug(" | ".join(i for i in (name_str, START_STR, args_kwargs_str) if i != ""))
             ret = f(instance, *args, **kwargs)
             ret_str = f"returned {ret}" if ret else ""
-            logger.debug(" | ".join(i for i in (name_str, FINISH_STR, ret_str) if i is not ""))
+            logger.debug(" | ".join(i for i in (name_str, FINISH_STR, ret_str) if i != ""))
             return ret
 
         def __get__(self, instance, owner):
@@ -15,12 +15,12 @@ class Admin(Module):
         self.bot.msg(e.source.nick, "Attempting a reload...")
         try:
             self.bot.msg(e.source.nick, f"Reloading {', '.join(list(self.bot.modules.keys()))}")
-            for k, v in self.bot.modules.items():
-                importlib.reload(v[1])
-                self.bot.modules[k] = getattr(v[1], f"{k.capitalize()}")({}, self.bot), v[1]
-            # logger.debug(self.modules)
+            # reload_init closes the running modules and builds them again from the reloaded code
+            for __, imodule in self.bot.modules.values():
+                importlib.reload(imodule)
 
             reload_all(__package__, 15)
+            self.bot.bump_cache_version()
             self.bot.reload_init()
             self.bot.msg(e.source.nick, "Reload successful!")
             logger.debug(self.bot.modules)
@@ -64,9 +64,9 @@ class Admin(Module):
         self.bot.msg(e.source.nick, str(eval(' '.join(e.arguments[1:]))))
 
     @is_owner
-    @command
+    @command(on_reactor=True)
     def whois(self, e):
         d = self.bot.get_whois()
-        if d is not None:
-            d.addCallback(lambda result: self.bot.msg(e.source.nick, result[2]))
+        d.addCallback(lambda result: self.bot.msg(e.source.nick, result[2]))
         self.bot.whois(e.arguments[1])
+        return d
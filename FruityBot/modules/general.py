@@ -1,8 +1,7 @@
 import logging
 
-import slider
 from ..core_bot.bot_module import Module, command
-from ..localize import LocaleException, alpha_2_langs, get_locales, tl
+from ..localize import LocaleException, get_locales, tl, valid_locales
 from ..utils import set_pref
 
 logger = logging.getLogger(__name__)
@@ -72,6 +71,7 @@ class General(Module):
             self.bot.msg(e.source.nick, tl("set.setting_invalid", self.bot.user_pref[e.source.nick].locale))
 
     def set_mode(self, e, args):
+        import slider
         try:
             mode = slider.GameMode.parse(args[2].lower())
         except:
@@ -83,7 +83,7 @@ class General(Module):
         return True
 
     def set_lang(self, e, args):
-        if args[2].lower() in alpha_2_langs and args[2].lower() in get_locales():
+        if args[2].lower() in valid_locales() and args[2].lower() in get_locales():
             set_pref(e.source, self.bot, 'locale', args[2])
             return True
         else:
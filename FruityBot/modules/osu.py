@@ -1,37 +1,50 @@
 import datetime
 import logging
-import operator
 import pathlib
+import threading
+import time
 import urllib.parse
 import zlib
-from collections import Counter
 from collections import OrderedDict
+from functools import wraps
 from itertools import islice
 from typing import *
 
-import dill
 import math
 import numpy
 import redis
-import requests
-import urlextract
-from ratelimit import limits, sleep_and_retry
-from twisted.internet import reactor, threads
-from twisted.python import threadpool
+from twisted.internet import defer, reactor, task, threads
 
 import slider
-from ..core_bot.bot_module import Module, cached, command, requires_args
+from ..core_bot.bot_module import Module, cached, command, is_owner, requires_args
+from ..core_bot.outbound import NOTICE, PROGRESS
 from ..exceptions import MissingPreferenceError
 from ..localize import tl
-from ..utils import check_mode_in_db, is_type, strfdelta
+from ..startup import profile
+from ..utils import SingleFlight, check_mode_in_db, is_type, strfdelta
+from .osu_catch_difficulty import DIFFICULTY_MODS as CATCH_DIFFICULTY_MODS, difficulty as catch_difficulty
+from .osu_http import BeatmapDownloader, SessionClient, SessionLibrary, create_session
+from .osu_library import BeatmapCache
+from .osu_limiter import INTERACTIVE, PriorityLimiter, RedisTokenBucket, TokenBucket, limit_client
+from .osu_pp_table import PPTables, SUPPORTED_MODS
+from .osu_coplay import CoPlayIndex
+from .osu_recommend import PASSING_RANKS, Recommender, ScoreStore, pp_band, refine
+from .osu_summary import BeatmapSummaryStore, BeatmapSummary
 
 logger = logging.getLogger(__name__)
 
 
-@sleep_and_retry
-@limits(calls=60, period=60)
-def get(*args, **kwargs):
-    return requests.get(*args, **kwargs)
+def requires_library(f):
+    """Answer osu.loading instead of running the command until the library index is built."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        self, e = args
+        if self.library_ready.is_set():
+            return f(*args, **kwargs)
+        else:
+            self.bot.msg(e.source.nick, tl("osu.loading", self.bot.user_pref[e.source.nick].locale))
+
+    return wrapper
 
 
 class Osu(Module):
@@ -51,56 +64,161 @@ class Osu(Module):
         self.recommend_redis.config_set('save', f'{60 * 10} 1 {60 * 2} 10')
 
         logger.debug("Osu.__init__ | loading osu library and api client")
-        self.osu_library = slider.library.Library.create_db(self.lib_dir, recurse=False, show_progress=True)
-        self.osu_api_client = slider.client.Client(self.osu_library, self.bot.Config().osu.api)
-        self.osu_api_client.beatmap = sleep_and_retry(limits(calls=60, period=60)(self.osu_api_client.beatmap))
-
+        config = self.bot.Config().osu
+        self.http = create_session(config.get("http_pool_connections", 4), config.get("http_pool_maxsize", 16))
+        # indexing osulib takes a while with a big library, so load_library does it in the background
+        self.osu_library = None
+        self.library_ready = threading.Event()
+        self.closed = threading.Event()
+        self.limiter = self.create_limiter()
+        self.osu_api_client = limit_client(SessionClient(None, self.bot.Config().osu.api, session=self.http),
+                                           self.limiter, INTERACTIVE)
+        self.beatmap_cache = BeatmapCache(self.lib_dir, config.get("beatmap_cache_size", 256),
+                                          BeatmapDownloader(self.http, self.lib_dir / "validators.json",
+                                                            revalidate_after=config.get("beatmap_revalidate_after",
+                                                                                        60 * 60 * 24)))
+        self.summaries = BeatmapSummaryStore(self.lib_dir / "summaries.bin",
+                                             self.bot.Config().osu.get("summary_ttl", 60 * 60 * 24 * 7))
+        self.summary_flight = SingleFlight()
+
+        logger.debug("Osu.__init__ | setting up recommendations")
+        self.coplay = None  # opened by load_library
+        self.coplay_saver = task.LoopingCall(self.save_coplay)
+        reactor.callFromThread(self.coplay_saver.start, config.get("coplay_save_interval", 60 * 10), now=False)
+        self.recommender = Recommender(ScoreStore(self.osu_api_client, ttl=config.get("recommend_ttl", 60 * 60 * 6),
+                                                  on_user_best=self.index_user_best,
+                                                  limiter=self.limiter),
+                                       workers=config.get("recommend_workers", 8))
+        self.recommend_jobs = {}  # (nick, mode): RecommendJob, only touched on the reactor
+
+        logger.debug("Osu.__init__ | opening pp tables")
+        self.pp_tables = PPTables(self.lib_dir)
+        self.pp_table_builder = task.LoopingCall(self.build_pp_tables)
+        reactor.callFromThread(self.pp_table_builder.start, self.bot.Config().osu.get("pp_table_interval", 60 * 60 * 6),
+                               now=not any(self.pp_tables.tables.values()))
+
+        threading.Thread(target=self.load_library, name="osu-library", daemon=True).start()
         logger.debug("Osu.__init__ | finished")
 
+    def load_library(self):
+        """Index osulib and open the co-play index; until this is done, commands answer osu.loading.
+
+        A co-play index that can't be read is moved aside and started over. Indexing osulib is retried,
+        waiting twice as long each time up to osu.library_retry_max seconds; the owner is told about both.
+        """
+        config = self.bot.Config().osu
+        delay, max_delay = config.get("library_retry", 30), config.get("library_retry_max", 60 * 30)
+        start = time.perf_counter()
+        with profile.phase("osu library index"):
+            while True:
+                try:
+                    library = SessionLibrary.create_db(self.lib_dir, recurse=False, session=self.http)
+                    break
+                except Exception as e:
+                    logger.exception("Osu.load_library | failed to index the osu library, retrying in %ds", delay)
+                    self.notify_owner(f"Indexing the osu library failed ({e!r}), retrying in {delay}s.")
+                if self.closed.wait(delay):
+                    return
+                delay = min(delay * 2, max_delay)
+            self.coplay = self.open_coplay()
+        self.osu_api_client.library = self.osu_library = library
+        self.library_ready.set()
+        logger.info("Osu.load_library | library ready after %.1fs", time.perf_counter() - start)
+
+    def open_coplay(self):
+        """The saved co-play index, or an empty one if it can't be read."""
+        try:
+            return CoPlayIndex.open(self.lib_dir)
+        except Exception as e:
+            broken = self.lib_dir / (CoPlayIndex.FILE + ".broken")
+            logger.exception("Osu.open_coplay | failed to open the co-play index, moving it to %s", broken)
+            self.notify_owner(f"The co-play index couldn't be opened ({e!r}), it was moved to {broken.name} "
+                              f"and recommendations start over from an empty index.")
+            try:
+                (self.lib_dir / CoPlayIndex.FILE).replace(broken)
+            except OSError:
+                logger.exception("Osu.open_coplay | failed to move the co-play index")
+            return CoPlayIndex(self.lib_dir)
+
+    def notify_owner(self, message):
+        self.bot.msg(self.bot.Config().main.owner, message, priority=NOTICE)
+
+    def create_limiter(self):
+        """The token bucket every osu! API request waits on; osu.api_rate requests a minute, bursting to
+        osu.api_burst, shared through Redis between bot processes if osu.api_redis_limiter is set."""
+        config = self.bot.Config().osu
+        rate, burst = config.get("api_rate", 60) / 60, config.get("api_burst", 10)
+        if config.get("api_redis_limiter", False):
+            bucket = RedisTokenBucket(self.recommend_redis, "fruitybot:osu_api_bucket", rate, burst)
+        else:
+            bucket = TokenBucket(rate, burst)
+        return PriorityLimiter(bucket)
+
+    def close(self):
+        self.closed.set()
+        reactor.callFromThread(self.pp_table_builder.stop)
+        reactor.callFromThread(self.coplay_saver.stop)
+        self.recommender.stop()
+        if self.coplay is not None and self.coplay.dirty:
+            self.coplay.save()
+        self.beatmap_cache.downloader.save()
+
+    def build_pp_tables(self):
+        d = self.bot.dispatcher.defer_to_pool(self.pp_tables.build, self.summaries, Osu.calculate_pp_batch)
+        d.addErrback(lambda failure: logger.error("pp table build failed", exc_info=failure.value))
+        return d
+
+    def index_user_best(self, user_id, mode, scores):
+        self.coplay.add_user(user_id, mode, ((score.beatmap_id, score.pp) for score in scores
+                                             if score.rank in PASSING_RANKS))
+
+    def save_coplay(self):
+        if self.coplay is None or not self.coplay.dirty:
+            return
+        d = self.bot.dispatcher.defer_to_pool(self.coplay.save)
+        d.addErrback(lambda failure: logger.error("co-play index save failed", exc_info=failure.value))
+        return d
+
     # region utils
 
     @classmethod
-    def format_message(cls, beatmap_data, beatmap_data_api, mode, pp_kwargs_tuple: Tuple[OrderedDict], recommend=""):
-        bm_time = strfdelta(
-            datetime.timedelta(
-                seconds=int(beatmap_data_api.hit_length.seconds),
-                milliseconds=beatmap_data_api.hit_length.seconds - int(beatmap_data_api.hit_length.seconds)
-            ),
-            "{M:02}:{S:02}"
-        )
-        end_props = f"{round(float(beatmap_data_api.star_rating), 2)}* {bm_time} "
-
+    def format_message(cls, summary: BeatmapSummary, pp_kwargs_tuple: Tuple[OrderedDict], recommend="",
+                       beatmap_data=None, pp_tables=None):
+        """beatmap_data (the parsed beatmap) is only needed for pp with mods the summary can't account for
+        (see get_difficulty_beatmap); pp found in pp_tables isn't calculated again."""
+        bm_time = strfdelta(datetime.timedelta(seconds=summary.hit_length), "{M:02}:{S:02}")
+        end_props = f"{round(summary.star_rating, 2)}* {bm_time} "
+
+        mode = summary.mode
         if mode == slider.GameMode.taiko:
             mode_str = "osu!taiko"
-            end_props += f"OD{beatmap_data.overall_difficulty} MAX{beatmap_data.max_combo}"
-            max_combo = beatmap_data.max_combo
+            end_props += f"OD{summary.overall_difficulty} MAX{summary.map_max_combo}"
+            max_combo = summary.map_max_combo
         elif mode == slider.GameMode.ctb:
             mode_str = "osu!catch"
-            end_props += f"AR{beatmap_data.approach_rate} MAX{beatmap_data_api.max_combo}"
-            max_combo = beatmap_data_api.max_combo
+            end_props += f"AR{summary.approach_rate} MAX{summary.max_combo}"
+            max_combo = summary.max_combo
         elif mode == slider.GameMode.mania:
             mode_str = "osu!mania"
-            end_props += f"OD{beatmap_data.overall_difficulty} {slider.mod.key_count(beatmap_data)}K " \
-                f"OBJ{len(beatmap_data.hit_objects)}"
-            max_combo = beatmap_data.hit_objects
+            end_props += f"OD{summary.overall_difficulty} {summary.key_count}K OBJ{summary.object_count}"
+            max_combo = summary.object_count
         else:
             return False
 
         estimate_strings = [Osu.generate_arg_str(max_combo, **pp_kwargs) for pp_kwargs in pp_kwargs_tuple]
-        pp_values = tuple(str(Osu.calculate_pp(beatmap_data, beatmap_data_api, mode=mode, **i))
-                          for i in pp_kwargs_tuple)
+        pp_values = Osu.calculate_pp_many(summary, pp_kwargs_tuple, beatmap_data=beatmap_data, pp_tables=pp_tables)
 
         final_lst = []
 
         if recommend:
-            link = f"https://osu.ppy.sh/beatmapsets/{beatmap_data.beatmap_set_id}" \
-                f"#{slider.GameMode.serialize(beatmap_data.mode)}/" \
-                f"{beatmap_data_api.beatmap_id}"
-            final_lst.append(f"[{link} {beatmap_data.display_name}]")
+            link = f"https://osu.ppy.sh/beatmapsets/{summary.beatmap_set_id}" \
+                f"#{slider.GameMode.serialize(summary.map_mode)}/" \
+                f"{summary.beatmap_id}"
+            final_lst.append(f"[{link} {summary.display_name}]")
             final_lst.append(mode_str)
             final_lst.append(recommend)
         else:
-            final_lst.append(beatmap_data.display_name)
+            final_lst.append(summary.display_name)
             final_lst.append(mode_str)
         try:
             for i in range(len(estimate_strings)):
@@ -111,7 +229,7 @@ class Osu(Module):
         final_lst.append(end_props)
         return " | ".join(final_lst)
 
-    @cached
+    @cached(ttl=60 * 60 * 12, key=lambda beatmap_id, mode: (int(beatmap_id), int(mode)))
     def get_api_data(self, beatmap_id, mode):
         beatmap_data_api = self.osu_api_client.beatmap(
             beatmap_id=beatmap_id,
@@ -123,23 +241,47 @@ class Osu(Module):
         return beatmap_data_api
 
     def get_data(self, e, beatmap_id, np=False):
-        library = self.osu_library.copy()
-        beatmap_data = library.lookup_by_id(beatmap_id, download=True, save=True)
-        library.close()
+        """Summary of a beatmap in the mode the user plays it in; the beatmap and API are only read on a miss."""
+        map_mode = self.summaries.map_mode(beatmap_id)
+        if map_mode is None:
+            map_mode = self.beatmap_cache.get(beatmap_id).mode
 
-        mode = check_mode_in_db(e.source, self.bot, beatmap_data.mode, np=np)
+        mode = check_mode_in_db(e.source, self.bot, map_mode, np=np)
         if mode == -1:
             raise MissingPreferenceError
+        mode = slider.GameMode(int(mode))
+
+        summary = self.summaries.get(beatmap_id, mode)
+        if summary is None:
+            # everyone !np-ing a freshly linked map waits on the same download and API call
+            summary = self.summary_flight.do((int(beatmap_id), int(mode)), self.fetch_summary, beatmap_id, mode)
 
+        logger.debug("Osu.get_data | data = %s", summary)
+
+        return summary, mode
+
+    def fetch_summary(self, beatmap_id, mode):
+        # an earlier flight may have finished between the miss and getting here
+        summary = self.summaries.get(beatmap_id, mode)
+        if summary is not None:
+            return summary
+
+        beatmap_data = self.beatmap_cache.get(beatmap_id)
         beatmap_data_api = self.get_api_data(beatmap_id, mode)
 
         if beatmap_data_api.max_combo is None and mode is not slider.GameMode.mania:
             beatmap_data_api = self.osu_api_client.beatmap(beatmap_id=beatmap_id,
                                                            include_converted_beatmaps=True)
 
-        logger.debug(f"Osu.get_data | data = {(beatmap_data, beatmap_data_api, mode)}")
+        summary = BeatmapSummary.from_beatmap(beatmap_data, beatmap_data_api, mode)
+        self.summaries.add(summary)
+        return summary
 
-        return beatmap_data, beatmap_data_api, mode
+    def get_difficulty_beatmap(self, summary, mods):
+        """The parsed beatmap when pp with mods needs more than the summary (catch with DT, HT, HR or EZ)."""
+        if summary.mode == slider.GameMode.ctb and mods & CATCH_DIFFICULTY_MODS:
+            return self.beatmap_cache.get(summary.beatmap_id)
+        return None
 
     @staticmethod
     def get_accuracy(highscore: slider.client.HighScore, mode: slider.GameMode):
@@ -198,29 +340,78 @@ class Osu(Module):
     # region pp calculation
 
     @staticmethod
-    def calculate_pp(osu_b_data, osu_b_data_api, mode, mods=0, **kwargs):
+    def calculate_pp(summary: BeatmapSummary, mods=0, beatmap_data=None, **kwargs):
+        mode = summary.mode
         if mode == 2:
             r = Osu.CatchTheBeat()
+            kwargs["beatmap_data"] = beatmap_data
         elif mode == 3:
             r = Osu.Mania()
         elif mode == 1:
             r = Osu.Taiko()
         else:
             return -1
-        return r.calculate_pp(mods=mods, beatmap_data=osu_b_data, beatmap_data_api=osu_b_data_api, **kwargs)
+        return r.calculate_pp(summary, mods=mods, **kwargs)
+
+    @staticmethod
+    def calculate_pp_batch(summary: BeatmapSummary, mods=0, beatmap_data=None, **kwargs):
+        """calculate_pp over arrays of acc/player_combo/miss/score (one mod combination), as a numpy array."""
+        mode = summary.mode
+        if mode == 2:
+            r = Osu.CatchTheBeat()
+            kwargs["beatmap_data"] = beatmap_data
+        elif mode == 3:
+            r = Osu.Mania()
+        elif mode == 1:
+            r = Osu.Taiko()
+        else:
+            return numpy.full(numpy.broadcast(*kwargs.values()).shape if kwargs else (), -1.)
+        return r.calculate_pp_batch(summary, mods=mods, **kwargs)
+
+    @staticmethod
+    def calculate_pp_many(summary: BeatmapSummary, pp_kwargs_tuple: Tuple[OrderedDict], beatmap_data=None,
+                          pp_tables=None):
+        """pp for each of pp_kwargs_tuple, from pp_tables when it has them and otherwise evaluated in one
+        calculate_pp_batch per mod combination."""
+        pp_values = numpy.empty(len(pp_kwargs_tuple))
+        groups = {}
+        for i, pp_kwargs in enumerate(pp_kwargs_tuple):
+            pp = pp_tables.lookup(summary, **pp_kwargs) if pp_tables is not None else None
+            if pp is not None:
+                pp_values[i] = pp
+                continue
+            mods = int(pp_kwargs.get("mods", 0))
+            groups.setdefault((mods, tuple(k for k in pp_kwargs if k != "mods")), []).append(i)
+        for (mods, keys), indices in groups.items():
+            columns = {k: numpy.array([pp_kwargs_tuple[i][k] for i in indices], dtype=numpy.float64) for k in keys}
+            pp_values[indices] = Osu.calculate_pp_batch(summary, mods=mods, beatmap_data=beatmap_data, **columns)
+        return pp_values
 
     class CatchTheBeat:
         @staticmethod
-        def calculate_pp(beatmap_data, beatmap_data_api, mods=0, acc=1., player_combo=None, miss=0):
-            stars = float(beatmap_data_api.star_rating)
-            if mods & slider.Mod.double_time:
-                from .osu_diff import diff
-                stars = diff.Catch.Diff(beatmap_data, mods=mods).star_rating
-                logger.debug(stars)
+        def star_rating(summary, mods=0, beatmap_data=None):
+            stars = summary.star_rating
+            if mods & CATCH_DIFFICULTY_MODS:
+                if beatmap_data is None:
+                    raise ValueError("Star rating with DT, HT, HR or EZ needs the parsed beatmap")
+                stars = catch_difficulty(beatmap_data, mods, summary.beatmap_id).star_rating
+            return stars
+
+        @staticmethod
+        def approach_rate(summary, mods=0, beatmap_data=None):
+            if mods & CATCH_DIFFICULTY_MODS:
+                if beatmap_data is None:
+                    raise ValueError("Approach rate with DT, HT, HR or EZ needs the parsed beatmap")
+                return catch_difficulty(beatmap_data, mods, summary.beatmap_id).approach_rate
+            return summary.approach_rate
+
+        @staticmethod
+        def calculate_pp(summary, mods=0, acc=1., player_combo=None, miss=0, beatmap_data=None):
+            stars = Osu.CatchTheBeat.star_rating(summary, mods, beatmap_data)
 
-            max_combo = int(beatmap_data_api.max_combo)
-            player_combo = int(beatmap_data_api.max_combo) if player_combo is None else player_combo
-            ar = float(beatmap_data.approach_rate)
+            max_combo = summary.max_combo
+            player_combo = summary.max_combo if player_combo is None else player_combo
+            ar = Osu.CatchTheBeat.approach_rate(summary, mods, beatmap_data)
 
             final_pp = pow(((5 * max(1.0, stars / 0.0049)) - 4), 2) / 100000
             final_pp *= 0.95 + 0.4 * min(1.0, max_combo / 3000.0) \
@@ -244,13 +435,43 @@ class Osu(Module):
 
             return final_pp
 
+        @staticmethod
+        def calculate_pp_batch(summary, mods=0, acc=1., player_combo=None, miss=0, beatmap_data=None):
+            # same operations in the same order as calculate_pp, so results are identical
+            stars = Osu.CatchTheBeat.star_rating(summary, mods, beatmap_data)
+
+            max_combo = summary.max_combo
+            player_combo = summary.max_combo if player_combo is None else player_combo
+            acc, player_combo, miss = numpy.broadcast_arrays(*(numpy.asarray(i, dtype=numpy.float64)
+                                                               for i in (acc, player_combo, miss)))
+            ar = Osu.CatchTheBeat.approach_rate(summary, mods, beatmap_data)
+
+            final_pp = pow(((5 * max(1.0, stars / 0.0049)) - 4), 2) / 100000
+            final_pp *= 0.95 + 0.4 * min(1.0, max_combo / 3000.0) \
+                        + (math.log(max_combo / 3000.0, 10) * 0.5 if max_combo > 3000 else 0.0)
+            final_pp = final_pp * numpy.power(0.97, miss)
+            final_pp *= numpy.power(player_combo / max_combo, 0.8)
+            if ar > 9:
+                final_pp *= 1 + 0.1 * (ar - 9.0)
+            elif ar < 8:
+                final_pp *= 1 + 0.025 * (8.0 - ar)
+            final_pp *= numpy.power(acc, 5.5)
+
+            if mods & slider.Mod.hidden:
+                final_pp *= 1.05 + 0.075 * (10.0 - min(10.0, ar))
+            elif mods & slider.Mod.flashlight:
+                final_pp *= 1.35 * (0.95 + 0.4 * min(1.0, max_combo / 3000.0) +
+                                    (math.log(max_combo / 3000.0, 10) * 0.5 if max_combo > 3000 else 0.0))
+
+            return final_pp
+
     class Mania:
         @staticmethod
-        def calculate_pp(beatmap_data, beatmap_data_api, mods=0, score=1000000):
+        def calculate_pp(summary, mods=0, score=1000000):
             #  Thanks Error- for the formula
-            stars = float(beatmap_data_api.star_rating)
-            od = float(beatmap_data.overall_difficulty)
-            object_count = len(beatmap_data.hit_objects)
+            stars = summary.star_rating
+            od = summary.overall_difficulty
+            object_count = summary.object_count
 
             if mods & slider.Mod.key_mod:
                 mod_key_count = int(
@@ -258,7 +479,7 @@ class Osu(Module):
                         k for k, v in slider.Mod.unpack(mods & slider.Mod.key_mod).items() if v
                     )[0][-1]
                 )
-                score_multiplier = slider.mod.score_multiplier(slider.mod.key_count(beatmap_data), mod_key_count)
+                score_multiplier = slider.mod.score_multiplier(summary.key_count, mod_key_count)
                 score *= score_multiplier
 
             perfect_window = 64 - 3 * od
@@ -288,12 +509,52 @@ class Osu(Module):
 
             return final_pp
 
+        @staticmethod
+        def calculate_pp_batch(summary, mods=0, score=1000000):
+            # same operations in the same order as calculate_pp, so results are identical
+            stars = summary.star_rating
+            od = summary.overall_difficulty
+            object_count = summary.object_count
+            score = numpy.asarray(score, dtype=numpy.float64)
+
+            if mods & slider.Mod.key_mod:
+                mod_key_count = int(
+                    list(
+                        k for k, v in slider.Mod.unpack(mods & slider.Mod.key_mod).items() if v
+                    )[0][-1]
+                )
+                score = score * slider.mod.score_multiplier(summary.key_count, mod_key_count)
+
+            perfect_window = 64 - 3 * od
+            base_strain = math.pow(5 * max(1.0, stars / 0.2) - 4, 2.2) / 135
+            base_strain *= 1 + 0.1 * min(1.0, object_count / 1500)
+            base_strain = base_strain * numpy.select(
+                (score < 500000, score < 600000, score < 700000, score < 800000, score < 900000),
+                (0, (score - 500000) / 100000 * 0.3, (score - 600000) / 100000 * 0.25 + 0.3,
+                 (score - 700000) / 100000 * 0.2 + 0.55, (score - 800000) / 100000 * 0.15 + 0.75),
+                (score - 900000) / 100000 * 0.1 + 0.90
+            )
+            window_factor = max(0.0, 0.2 - ((perfect_window - 34) * 0.006667))
+            score_factor = numpy.power((numpy.maximum(0, (score - 960000)) / 40000.0), 1.1)
+            base_acc = window_factor * base_strain * score_factor
+            acc_factor = numpy.power(base_acc, 1.1)
+            strain_factor = numpy.power(base_strain, 1.1)
+            final_pp = numpy.power(acc_factor + strain_factor, 1 / 1.1)
+            if mods & slider.Mod.easy:
+                final_pp *= 0.5
+            elif mods & slider.Mod.no_fail:
+                final_pp *= 0.9
+            else:
+                final_pp *= 0.8
+
+            return final_pp
+
     class Taiko:
         @staticmethod
-        def calculate_pp(beatmap_data, beatmap_data_api, mods=0, acc=1., miss=0):
-            stars = float(beatmap_data_api.star_rating)
-            max_combo = int(beatmap_data.max_combo)
-            od = float(beatmap_data.overall_difficulty)
+        def calculate_pp(summary, mods=0, acc=1., miss=0):
+            stars = summary.star_rating
+            max_combo = summary.map_max_combo
+            od = summary.overall_difficulty
             perfect_hits = max_combo - miss
 
             try:
@@ -333,22 +594,62 @@ class Osu(Module):
             final_pp = math.pow(math.pow(strain, 1.1) + math.pow(acc_factor, 1.1), 1.0 / 1.1) * mod_multiplier
             return final_pp
 
+        @staticmethod
+        def calculate_pp_batch(summary, mods=0, acc=1., miss=0):
+            # same operations in the same order as calculate_pp, so results are identical
+            stars = summary.star_rating
+            max_combo = summary.map_max_combo
+            od = summary.overall_difficulty
+            acc, miss = numpy.broadcast_arrays(*(numpy.asarray(i, dtype=numpy.float64) for i in (acc, miss)))
+            perfect_hits = max_combo - miss
+
+            if mods & slider.Mod.easy:
+                od *= 0.5
+            elif mods & slider.Mod.hard_rock:
+                od *= 1.4
+
+            max_od = 20
+            min_od = 50
+            result = min_od + (max_od - min_od) * od / 10
+            result = math.floor(result) - 0.5
+            perfect_window = round(result, 2)
+
+            strain = (math.pow(max(float(1), stars / 0.0075) * 5 - 4, 2) / 100000) * \
+                     (min(float(1), max_combo / 1500) * 0.1 + 1)
+            strain = strain * numpy.power(0.985, miss)
+            strain *= numpy.minimum(numpy.power(perfect_hits, 0.5) / math.pow(max_combo, 0.5), 1)
+            strain *= acc
+            acc_factor = math.pow(150 / perfect_window, 1.1) * numpy.power(acc / 100, 15) * 22
+            acc_factor *= min(math.pow(max_combo / 1500, 0.3), 1.15)
+
+            mod_multiplier = 1.1
+            if mods & slider.Mod.hidden:
+                mod_multiplier *= 1.1
+                strain *= 1.025
+            elif mods & slider.Mod.no_fail:
+                mod_multiplier *= 0.9
+            elif mods & slider.Mod.flashlight:
+                strain *= 1.05 * min(1, max_combo / 1500) * 0.1 + 1
+
+            final_pp = numpy.power(numpy.power(strain, 1.1) + numpy.power(acc_factor, 1.1), 1.0 / 1.1) * mod_multiplier
+            return final_pp
+
     # endregion
 
     # Osu! ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     @command(aliases=["r"])
+    @requires_library
     def recommend(self, e):
-        if not self.osu_library:
-            return self.bot.msg(e.source.nick, tl("osu.loading", self.bot.user_pref[e.source.nick].locale))
-
         user = self.bot.users.setdefault(e.source.nick, OsuUser(e.source.nick))
         try:
-            logger.debug(f"Osu.recommend | check for arguments? {len(e.arguments) >= 2}")
+            logger.debug("Osu.recommend | check for arguments? %s", len(e.arguments) >= 2)
             if len(e.arguments) >= 2:
                 if e.arguments[1] == "reset":
                     logger.debug("Osu.recommend | recommend reset incurred")
                     del self.recommend_redis[e.source.nick, self.bot.user_pref[e.source.nick].mode, "rec_list"]
+                    threads.blockingCallFromThread(reactor, self.cancel_recommendation, e.source.nick,
+                                                   self.bot.user_pref[e.source.nick].mode)
                     self.bot.msg(e.source.nick, "Reset your recommendations!")
                 elif e.arguments[1] == "reload":
                     logger.debug("Osu.recommend | recommend reload incurred")
@@ -364,14 +665,15 @@ class Osu(Module):
         self._recommend(user, e)
 
     def _recommend(self, osu_user, e):
-        """'What the fuck is this', you ask? I don't know either."""
+        """Answer with the user's next recommendation, generating their list first if they have none."""
 
-        # christ, deprecate this function ASAP
         # https://github.com/Tyrrrz/OsuHelper/blob/master/OsuHelper/Services/RecommendationService.cs#L34
 
         rec_num = 20
-        min_threads = 5
-        max_threads = 10
+        # top plays to hear back from before the first recommendation; at least one, or there never is a first
+        first_after = max(1, self.bot.Config().osu.get("recommend_first_after", 5))
+
+        import dill
 
         def obj_decode(obj):
             return dill.loads(zlib.decompress(bytes(obj))) if obj is not None else None
@@ -390,13 +692,13 @@ class Osu(Module):
 
             # start parsing data
             try:
-                beatmap_data, beatmap_data_api, mode = self.get_data(e, recommended[0])
+                summary, mode = self.get_data(e, recommended[0])
 
                 if mode == slider.GameMode.taiko:
                     pp_args = tuple(OrderedDict(acc=i, miss=0)
                                     for i in numpy.arange(1., .97, -0.01))
                 elif mode == slider.GameMode.ctb:
-                    pp_args = tuple(OrderedDict(acc=i, player_combo=beatmap_data_api.max_combo, miss=0)
+                    pp_args = tuple(OrderedDict(acc=i, player_combo=summary.max_combo, miss=0)
                                     for i in numpy.arange(1., .98, -0.005))
                 elif mode == slider.GameMode.mania:
                     pp_args = tuple(OrderedDict(score=i)
@@ -404,94 +706,75 @@ class Osu(Module):
                 else:
                     return tl("osu.mode_invalid", self.bot.user_pref[e.source.nick].locale)
 
-                osu_user.last_beatmap = (beatmap_data, beatmap_data_api, mode, recommended[0])
+                osu_user.last_beatmap = recommended[0]
 
                 self.bot.msg(e.source.nick,
-                             self.format_message(
-                                 beatmap_data, beatmap_data_api, mode, pp_args, recommend=f"Confidence {recommended[1]}"
-                             ))
+                             self.format_message(summary, pp_args, recommend=f"Confidence {recommended[1]}",
+                                                 pp_tables=self.pp_tables))
             except:
                 logger.exception("")
                 self.bot.msg(e.source.nick, "ParseError: contact the bot author")
 
             self.recommend_redis.incr((e.source.nick, user_mode, "i"))
 
-        def iterate_maps_callback(result):
-            _temp_list.extend(result)
-
-            # progress tracker lmao
-            finish_deferred.append(0)
-            logger.debug(f"*finished: {len(finish_deferred)} / {len(user_top_plays)}")
-            if len(finish_deferred) % 3 == 0:
+        def progress(finished, total):
+            # until the first recommendation is in
+            if finished % 3 == 0 and finished < min(first_after, total):
                 self.bot.msg(e.source.nick, "Progress: " +
-                             ("█" * (len(finish_deferred) // 3)) + ("░" * ((rec_num - len(finish_deferred)) // 3)))
-
-            if len(finish_deferred) == len(user_top_plays):
-                # count instances
-                map_counter.update(_temp_list)
-                logger.debug(f"Osu.iterate_maps_callback | count {map_counter}")
-                # convert to ordered dict and then sort
-                map_ordered_dict = OrderedDict(sorted(map_counter.items(), key=operator.itemgetter(1), reverse=True))
-                logger.debug(f"Osu.iterate_maps_callback | convert {map_ordered_dict}")
-                # cull those already played
-                for i in user_top_plays:
-                    map_ordered_dict.pop(i.beatmap_id, None)
-                logger.debug(f"Osu.iterate_maps_callback | cull played {map_ordered_dict}")
-                # retain 200 maps
-                map_ordered_dict = OrderedDict(islice(map_ordered_dict.items(), 200))
-                logger.debug(f"Osu.iterate_maps_callback | retain 200 {map_ordered_dict}")
-
-                self.recommend_redis.set((e.source.nick, user_mode, "rec_list"), obj_encode(map_ordered_dict),
-                                         ex=60 * 60 * 24 * 30)
-                self.recommend_redis.set((e.source.nick, user_mode, "i"), 0)
+                             ("█" * (finished // 3)) + ("░" * ((total - finished) // 3)), priority=PROGRESS)
+
+        def store_recommendations(map_ordered_dict):
+            logger.debug("Osu._recommend | ranked %s", map_ordered_dict)
+            self.recommend_redis.set((e.source.nick, user_mode, "rec_list"), obj_encode(map_ordered_dict),
+                                     ex=60 * 60 * 24 * 30)
+            self.recommend_redis.set((e.source.nick, user_mode, "i"), 0)
+
+        def refine_recommendations(map_ordered_dict):
+            # what the user has already been shown stays where it is
+            current = obj_decode(self.recommend_redis.get((e.source.nick, user_mode, "rec_list"))) or OrderedDict()
+            shown = islice(current.items(), int(self.recommend_redis.get((e.source.nick, user_mode, "i")) or 0))
+            self.recommend_redis.set((e.source.nick, user_mode, "rec_list"),
+                                     obj_encode(refine(shown, map_ordered_dict)), ex=60 * 60 * 24 * 30)
+
+        def first_recommendation(map_ordered_dict):
+            store_recommendations(map_ordered_dict)
+            get_recommendation()
+
+        def background_failed(failure):
+            # get_recommendation has already told the user
+            if not failure.check(IndexError):
+                logger.error("Rec Exception", exc_info=failure.value)
+
+        def in_background(f, map_ordered_dict):
+            # redis and map lookups, so off the reactor, one after another so refinements never overtake
+            # the first recommendation
+            background[0] = background[0].addCallback(
+                lambda __: self.bot.dispatcher.defer_to_pool(f, map_ordered_dict)).addErrback(background_failed)
+            return background[0]
+
+        def partial_callback(map_ordered_dict, finished, total):
+            in_background(first_recommendation if finished == first_after else refine_recommendations,
+                          map_ordered_dict)
+
+        def recommend_callback(map_ordered_dict):
+            return in_background(refine_recommendations if len(user_top_plays) > first_after
+                                 else first_recommendation, map_ordered_dict)
+
+        def recommend_errback(failure):
+            if failure.check(defer.CancelledError):
+                return
+            logger.error("Rec Exception", exc_info=failure.value)
+            self.bot.msg(e.source.nick, "RecommendError: Unknown")
 
-                get_recommendation()
+        background = [defer.succeed(None)]
 
-        def iterate_maps_errback(failure):
-            try:
-                failure.raiseException()
-            except:
-                logger.exception("IterMap Exception")
-
-        def gen_rec_from_top_play(top_play, pp_limits):
-            pp_limit_lower, pp_limit_upper = pp_limits
-            client = self.osu_api_client.copy()
-
-            # progress tracker lmao
-            start_deferred.append(0)
-            logger.debug(f"started: {len(start_deferred)} / {len(user_top_plays)}")
-
-            beatmap_high_scores = sorted(client.beatmap_best(beatmap_id=top_play.beatmap_id, game_mode=game_mode),
-                                         key=lambda x: abs(x.pp - top_play.pp))[:20]
-            # through map top plays
-            total_scores = []
-            for beatmap_high_score in beatmap_high_scores:
-                # get user who got high score's top plays and filter, if rank S or better and within pp tolerances
-                user_high_scores = \
-                    sorted(
-                        filter(
-                            lambda k: (k.rank in ["S", "X", "SH", "XH"]) and (pp_limit_lower <= k.pp <= pp_limit_upper),
-                            client.user_best(user_id=beatmap_high_score.user_id, game_mode=game_mode)
-                        ),
-                        key=lambda x: abs(x.pp - top_play.pp)
-                    )[:20]
-                total_scores.extend([k.beatmap_id for k in user_high_scores])
-
-            logger.debug(f"Osu.gen_rec_from_top_play | result: {total_scores}")
-            return total_scores
-
-        def iterate_map(pp_limits):
-            rec_thread_pool = threadpool.ThreadPool(min_threads, max_threads, "recommendations: " + e.source.nick)
-            for top_play in user_top_plays:
-                # single thread
-                # iterate_maps_callback(gen_rec_from_top_play(top_play))
-
-                # multi-thread
-                d = threads.deferToThreadPool(reactor, rec_thread_pool, gen_rec_from_top_play, top_play, pp_limits)
-                d.addCallback(iterate_maps_callback)
-                d.addErrback(iterate_maps_errback)
-            rec_thread_pool.start()
-            rec_thread_pool.stop()
+        def start_job(top_plays):
+            # on the reactor, which owns recommend_jobs and the job's deferred
+            job = self.recommend_jobs[e.source.nick, user_mode] = \
+                self.recommender.recommend(top_plays, user_mode, progress=progress, partial=partial_callback,
+                                           first_after=first_after)
+            job.deferred.addBoth(self._recommend_job_done, e.source.nick, user_mode, job)
+            job.deferred.addCallbacks(recommend_callback, recommend_errback)
 
         # ---
 
@@ -502,14 +785,10 @@ class Osu(Module):
             if obj_decode(self.recommend_redis.get((e.source.nick, user_mode, "rec_list"))):
                 get_recommendation()
                 return
+            elif (e.source.nick, user_mode) in self.recommend_jobs:
+                self.bot.msg(e.source.nick, "Still generating your recommendations, please wait.")
+                return
             else:
-                # progress tracker (I was lazy, OK?)
-                start_deferred = []
-                finish_deferred = []
-
-                _temp_list = []  # sometimes i hate how assignment and mutation works
-                map_counter = Counter()
-
                 game_mode = slider.GameMode(user_mode)
                 osu_user.user_client = self.osu_api_client.user(user_name=e.source.nick, game_mode=game_mode)
 
@@ -519,21 +798,41 @@ class Osu(Module):
                     self.bot.msg(e.source.nick, "You have no top plays.")
                     return
 
-                pp_list = [i.pp for i in user_top_plays]
+                # players already fetched for other users usually know enough maps to skip the fan-out
+                map_ordered_dict = self.coplay.query([i.beatmap_id for i in user_top_plays], user_mode,
+                                                     pp_band(user_top_plays)[0])
+                if len(map_ordered_dict) >= self.bot.Config().osu.get("coplay_min_results", 20):
+                    store_recommendations(map_ordered_dict)
+                    get_recommendation()
+                    return
 
                 try:
                     logger.debug("Generating recommendations")
                     self.bot.msg(e.source.nick, "Generating recommendations, this may take a while...")
-                    iterate_map((sum(pp_list) / float(len(pp_list)), (sum(pp_list) / float(len(pp_list)) * 1.25)))
+                    threads.blockingCallFromThread(reactor, start_job, user_top_plays)
                 except:
                     logger.exception("Rec Exception")
                     self.bot.msg(e.source.nick, "RecommendError: Unknown")
         except Exception:
             logger.exception("")
 
+    def _recommend_job_done(self, result, nick, mode, job):
+        if self.recommend_jobs.get((nick, mode)) is job:
+            del self.recommend_jobs[nick, mode]
+        return result
+
+    def cancel_recommendation(self, nick, mode):
+        """Stop generating a user's recommendations, if they are; call on the reactor."""
+        job = self.recommend_jobs.get((nick, mode))
+        if job is not None:
+            job.cancel()
+
     @command(aliases=["action"])
     @requires_args
+    @requires_library
     def np(self, e):
+        import urlextract
+
         osu_user = self.bot.users.setdefault(e.source.nick, OsuUser(e.source.nick))
         osu_user.last_mod = False
         osu_user.last_kwargs = False
@@ -553,7 +852,7 @@ class Osu(Module):
             return tl("osu.beatmapset", self.bot.user_pref[e.source.nick].locale)
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         try:
-            beatmap_data, beatmap_data_api, mode = self.get_data(e, beatmap_id, np=True)
+            summary, mode = self.get_data(e, beatmap_id, np=True)
         except ValueError:
             return tl("osu.no_beatmap", self.bot.user_pref[e.source.nick].locale)
         except MissingPreferenceError:
@@ -568,7 +867,7 @@ class Osu(Module):
             pp_args = tuple(OrderedDict(acc=i, miss=0)
                             for i in numpy.arange(1., .97, -0.01))
         elif mode == slider.GameMode.ctb:
-            pp_args = tuple(OrderedDict(acc=i, player_combo=beatmap_data_api.max_combo, miss=0)
+            pp_args = tuple(OrderedDict(acc=i, player_combo=summary.max_combo, miss=0)
                             for i in numpy.arange(1., .98, -0.005))
         elif mode == slider.GameMode.mania:
             pp_args = tuple(OrderedDict(score=i)
@@ -576,9 +875,10 @@ class Osu(Module):
         else:
             return tl("osu.mode_invalid", self.bot.user_pref[e.source.nick].locale)
 
-        return self.format_message(beatmap_data, beatmap_data_api, mode, pp_args)
+        return self.format_message(summary, pp_args, pp_tables=self.pp_tables)
 
     @command(aliases=["recent", "lastplay"])
+    @requires_library
     def replay(self, e):
         osu_user = self.bot.users.setdefault(e.source.nick, OsuUser(e.source.nick))
         osu_user.last_mod = False
@@ -599,16 +899,14 @@ class Osu(Module):
                                                           game_mode=mode,
                                                           limit=1))
 
-        logger.debug(f"Osu.replay | recent plays: {recent}")
+        logger.debug("Osu.replay | recent plays: %s", recent)
         if not recent:
             return self.bot.msg(e.source.nick, tl("osu.no_recent", self.bot.user_pref[e.source.nick].locale))
 
         recent = sorted(recent, key=lambda beatmap: beatmap.date, reverse=True)[0]
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-        beatmap_data, beatmap_data_api, mode = self.get_data(e, recent.beatmap_id)
-        if not beatmap_data:
-            return
+        summary, mode = self.get_data(e, recent.beatmap_id)
         if mode == slider.GameMode.standard:
             return self.bot.msg(e.source.nick, tl("osu.mode_invalid", self.bot.user_pref[e.source.nick].locale))
 
@@ -629,9 +927,12 @@ class Osu(Module):
         osu_user.last_beatmap = recent.beatmap_id
         self.bot.users[e.source.nick] = osu_user
 
-        self.bot.msg(e.source.nick, Osu.format_message(beatmap_data, beatmap_data_api, mode, (pp_args,)))
+        beatmap_data = self.get_difficulty_beatmap(summary, pp_args["mods"])
+        self.bot.msg(e.source.nick, Osu.format_message(summary, (pp_args,), beatmap_data=beatmap_data,
+                                                       pp_tables=self.pp_tables))
 
     @command(aliases=["with"], include_funcname=False)
+    @requires_library
     def cmd_with(self, e):
         if e.source.nick not in self.bot.users:
             return self.bot.msg(e.source.nick, tl("osu.no_np", self.bot.user_pref[e.source.nick].locale))
@@ -639,7 +940,7 @@ class Osu(Module):
         osu_user = self.bot.users[e.source.nick]
 
         beatmap_id = osu_user.last_beatmap
-        beatmap_data, beatmap_data_api, mode = self.get_data(e, beatmap_id)
+        summary, mode = self.get_data(e, beatmap_id)
         if mode == slider.GameMode.standard:
             return self.bot.msg(e.source.nick, tl("osu.mode_invalid", self.bot.user_pref[e.source.nick].locale))
 
@@ -661,8 +962,8 @@ class Osu(Module):
         osu_user.last_mod = mods
 
         # checks if mods are supported
-        sup_mods = ["", "nfezhdhrfl", "hdfl", "nfez"]
-        if beatmap_data.mode == 0:
+        sup_mods = list(SUPPORTED_MODS)
+        if summary.map_mode == 0:
             sup_mods[3] = "nfez1k2k3k4k5k6k7k8k9k"
         uns_mod = mods & ~numpy.uint32(slider.Mod.parse(sup_mods[mode]))
         if uns_mod:
@@ -676,16 +977,19 @@ class Osu(Module):
             if mode == slider.GameMode.taiko:  # all mods as of now
                 pp_args = OrderedDict(acc=1., miss=0, mods=mods)
             elif mode == slider.GameMode.ctb:  # hd and fl
-                pp_args = OrderedDict(acc=1., player_combo=beatmap_data_api.max_combo, miss=0, mods=mods)
+                pp_args = OrderedDict(acc=1., player_combo=summary.max_combo, miss=0, mods=mods)
             elif mode == slider.GameMode.mania:  # nf and ez only
                 pp_args = OrderedDict(score=1000000, mods=mods)
             else:
                 return self.bot.msg(e.source.nick, tl("osu.mode_invalid", self.bot.user_pref[e.source.nick].locale))
         # endregion
 
-        self.bot.msg(e.source.nick, Osu.format_message(beatmap_data, beatmap_data_api, mode, (pp_args,)))
+        beatmap_data = self.get_difficulty_beatmap(summary, pp_args["mods"])
+        self.bot.msg(e.source.nick, Osu.format_message(summary, (pp_args,), beatmap_data=beatmap_data,
+                                                       pp_tables=self.pp_tables))
 
     @command
+    @requires_library
     def acc(self, e):
         if e.source.nick not in self.bot.users:
             return self.bot.msg(e.source.nick, tl("osu.no_np", self.bot.user_pref[e.source.nick].locale))
@@ -693,11 +997,11 @@ class Osu(Module):
         osu_user = self.bot.users[e.source.nick]
 
         beatmap_id = osu_user.last_beatmap
-        beatmap_data, beatmap_data_api, mode = self.get_data(e, beatmap_id)
+        summary, mode = self.get_data(e, beatmap_id)
         if mode == slider.GameMode.standard:
             return self.bot.msg(e.source.nick, tl("osu.mode_invalid", self.bot.user_pref[e.source.nick].locale))
 
-        max_combo = int(beatmap_data_api.max_combo) if beatmap_data_api.max_combo else int(beatmap_data.max_combo)
+        max_combo = summary.max_combo or summary.map_max_combo
 
         # region acc_header
         # reads args of message
@@ -748,7 +1052,9 @@ class Osu(Module):
         pp_args["mods"] = 0 if not osu_user.last_mod else osu_user.last_mod
         osu_user.last_kwargs = pp_args
 
-        self.bot.msg(e.source.nick, Osu.format_message(beatmap_data, beatmap_data_api, mode, (pp_args,)))
+        beatmap_data = self.get_difficulty_beatmap(summary, pp_args["mods"])
+        self.bot.msg(e.source.nick, Osu.format_message(summary, (pp_args,), beatmap_data=beatmap_data,
+                                                       pp_tables=self.pp_tables))
 
     @command(aliases=["u"])
     def update(self, e):
@@ -759,6 +1065,17 @@ class Osu(Module):
         # r = requests.get(f'https://ameobea.me/osutrack/api/get_changes.php'
         #                  f'?user={user}&mode={bot.user_pref[e.source.nick].mode}')
 
+    @is_owner
+    @command
+    def apistats(self, e):
+        metrics = self.limiter.metrics()
+        parts = [f"queued {metrics.pop('queued')}"]
+        for priority, waits in metrics.items():
+            name = "interactive" if priority == INTERACTIVE else "background"
+            parts.append(f"{name}: {waits['count']} waited p50 {waits['p50']:.2f}s p99 {waits['p99']:.2f}s "
+                         f"max {waits['max']:.2f}s")
+        self.bot.msg(e.source.nick, " | ".join(parts))
+
     @staticmethod
     def check_arg(pp_args, min_max, defaults, key):
         if pp_args[key] is None:
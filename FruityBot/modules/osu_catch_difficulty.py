@@ -0,0 +1,408 @@
+"""osu!catch star rating, following osu!lazer's catch difficulty calculator.
+
+Fruits and droplets of a map are laid out as NumPy arrays of positions and times once per map; everything that
+doesn't depend on the previous object's outcome (deltas, strain times, decays, section peaks) is computed on
+whole arrays. Only the three recurrences of the algorithm (hyperdash excess, the catcher's position and the
+strain level) walk the arrays in order, over plain floats.
+"""
+import logging
+import math
+
+import numpy
+import slider
+
+from ..utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+STAR_SCALING_FACTOR = 0.153
+
+PLAYFIELD_WIDTH = 512
+CATCHER_SIZE = 106.75
+ALLOWED_CATCH_RANGE = 0.8
+NORMALIZED_HITOBJECT_RADIUS = 41.0
+ABSOLUTE_PLAYER_POSITIONING_ERROR = 16.0
+DIRECTION_CHANGE_BONUS = 21.0
+
+SKILL_MULTIPLIER = 900
+STRAIN_DECAY_BASE = 0.2
+DECAY_WEIGHT = 0.94
+SECTION_LENGTH = 750
+
+RNG_SEED = 1337
+
+# mods that change a catch map's star rating
+DIFFICULTY_MODS = slider.Mod.double_time | slider.Mod.half_time | slider.Mod.hard_rock | slider.Mod.easy
+
+
+def clock_rate(mods):
+    if mods & slider.Mod.double_time:
+        return 1.5
+    if mods & slider.Mod.half_time:
+        return 0.75
+    return 1.
+
+
+def difficulty_range(difficulty, minimum, middle, maximum):
+    if difficulty > 5:
+        return middle + (maximum - middle) * (difficulty - 5) / 5
+    if difficulty < 5:
+        return middle - (middle - minimum) * (5 - difficulty) / 5
+    return middle
+
+
+class LegacyRandom:
+    """osu!stable's xorshift generator, which decides hard rock's fruit offsets."""
+    INT_MASK = 0x7FFFFFFF
+    UINT_TO_REAL = 1.0 / (INT_MASK + 1.0)
+
+    def __init__(self, seed):
+        self.x = seed & 0xFFFFFFFF
+        self.y = 842502087
+        self.z = 3579807591
+        self.w = 273326509
+        self.bit_buffer = 0
+        self.bit_index = 32
+
+    def next_uint(self):
+        t = (self.x ^ (self.x << 11)) & 0xFFFFFFFF
+        self.x, self.y, self.z = self.y, self.z, self.w
+        self.w = self.w ^ (self.w >> 19) ^ t ^ (t >> 8)
+        return self.w
+
+    def skip(self, n):
+        for __ in range(n):
+            self.next_uint()
+
+    def next_double(self):
+        return self.UINT_TO_REAL * self.next_uint()
+
+    def next_range(self, lower, upper):
+        return int(lower + self.next_double() * (upper - lower))
+
+    def next_bool(self):
+        if self.bit_index == 32:
+            self.bit_buffer = self.next_uint()
+            self.bit_index = 1
+            return (self.bit_buffer & 1) == 1
+        self.bit_index += 1
+        self.bit_buffer >>= 1
+        return (self.bit_buffer & 1) == 1
+
+
+def _ms(time):
+    return time.total_seconds() * 1000
+
+
+def _hit_objects(beatmap):
+    hit_objects = beatmap.hit_objects
+    # newer slider releases take stacking options; catch has no stacking
+    return hit_objects(stacking=False) if callable(hit_objects) else hit_objects
+
+
+def _tiny_droplet_count(event_times):
+    """Tiny droplets between consecutive juice stream events, which only matter for how far HR's RNG advances."""
+    since = numpy.diff(numpy.asarray(event_times, dtype=numpy.int64))
+    halvings = numpy.ceil(numpy.log2(numpy.maximum(since, 1) / 100)).clip(0)
+    return int(numpy.where(since > 80, 2 ** halvings - 1, 0).sum())
+
+
+class CatchObjects:
+    """The fruits and droplets of a catch map (the objects that give combo) in time order.
+
+    Slider paths are evaluated once here; positions(hard_rock) then lays the objects out with or without
+    HR's offsets as (x in osu! pixels, start time in ms of the unmodified map, whether it's a fruit).
+    """
+
+    def __init__(self, beatmap):
+        # per hit object: ("fruit", x, time), ("stream", x, time, fruit, rng calls, last x, time) or ("bananas", n)
+        self.layout = []
+        for hit_object in _hit_objects(beatmap):
+            start = _ms(hit_object.time)
+            if isinstance(hit_object, slider.beatmap.Slider):
+                self.layout.append(("stream", *self._juice_stream(hit_object), hit_object.curve.points[-1].x, start))
+            elif isinstance(hit_object, slider.beatmap.Spinner):
+                self.layout.append(("bananas", self._banana_count(start, _ms(hit_object.end_time))))
+            else:
+                self.layout.append(("fruit", hit_object.position.x, start))
+        self._length = sum(1 if entry[0] == "fruit" else len(entry[1]) for entry in self.layout
+                           if entry[0] != "bananas")
+
+    def positions(self, hard_rock=False):
+        x, time, fruit = [], [], []
+        rng = LegacyRandom(RNG_SEED) if hard_rock else None
+        last_position = last_time = None
+
+        for kind, *entry in self.layout:
+            if kind == "stream":
+                stream_x, stream_time, stream_fruit, rng_calls, end_position, start = entry
+                x.append(stream_x)
+                time.append(stream_time)
+                fruit.append(stream_fruit)
+                if rng is not None:
+                    rng.skip(rng_calls)
+                    last_position, last_time = end_position, start
+            elif kind == "bananas":
+                if rng is not None:
+                    # each banana drew its offset, type, rotation and colour
+                    rng.skip(4 * entry[0])
+            else:
+                position, start = entry
+                if rng is not None:
+                    position, last_position, last_time = self._hard_rock_offset(position, start, last_position,
+                                                                                last_time, rng)
+                x.append([position])
+                time.append([start])
+                fruit.append([True])
+
+        if not x:
+            return numpy.empty(0), numpy.empty(0), numpy.empty(0, dtype=bool)
+        time = numpy.concatenate(time).astype(numpy.float64)
+        order = numpy.argsort(time, kind="stable")
+        return numpy.concatenate(x).astype(numpy.float64)[order], time[order], \
+            numpy.concatenate(fruit).astype(bool)[order]
+
+    def __len__(self):
+        return self._length
+
+    @staticmethod
+    def _juice_stream(hit_object):
+        """Fruits at the head, repeats and tail, droplets at the ticks; returns (x, time, fruit, HR RNG calls)."""
+        start, end = _ms(hit_object.time), _ms(hit_object.end_time)
+        spans = hit_object.repeat
+        span_duration = (end - start) / spans
+        tick_spacing = hit_object.ms_per_beat / hit_object.tick_rate
+        # ticks closer than 10ms to a span's end are dropped
+        tick_offsets = numpy.arange(tick_spacing, span_duration - 10, tick_spacing) if tick_spacing > 0 \
+            else numpy.empty(0)
+        tick_x = numpy.fromiter((hit_object.curve(p).x for p in tick_offsets / span_duration), numpy.float64,
+                                len(tick_offsets))
+        head_x, end_x = hit_object.position.x, hit_object.curve(1).x
+
+        span_starts = start + numpy.arange(spans) * span_duration
+        forward = numpy.arange(spans) % 2 == 0
+        # reversed spans pass the same ticks backwards
+        times = numpy.where(forward[:, None], span_starts[:, None] + tick_offsets,
+                            span_starts[:, None] + span_duration - tick_offsets[::-1])
+        xs = numpy.where(forward[:, None], tick_x, tick_x[::-1])
+        ends_x = numpy.where(forward, end_x, head_x)
+
+        # per span: its ticks then the repeat (or tail) fruit
+        x = numpy.concatenate([xs, ends_x[:, None]], axis=1).ravel()
+        time = numpy.concatenate([times, (span_starts + span_duration)[:, None]], axis=1).ravel()
+        fruit = numpy.zeros((spans, len(tick_offsets) + 1), dtype=bool)
+        fruit[:, -1] = True
+
+        x = numpy.concatenate([[head_x], x]).clip(0, PLAYFIELD_WIDTH)
+        time = numpy.concatenate([[start], time])
+        fruit = numpy.concatenate([[True], fruit.ravel()])
+
+        # osu! also places a legacy last tick before the tail; it holds nothing but spaces tiny droplets
+        legacy_last_tick = max(start + (end - start) / 2, end - 36)
+        event_times = numpy.concatenate([time[:-1], [legacy_last_tick, time[-1]]])
+        rng_calls = _tiny_droplet_count(event_times) + int((~fruit).sum())
+        return x, time, fruit, rng_calls
+
+    @staticmethod
+    def _banana_count(start, end):
+        duration = end - start
+        if duration <= 0:
+            return 0
+        spacing = duration
+        while spacing > 100:
+            spacing /= 2
+        return int(duration // spacing) + 1
+
+    @staticmethod
+    def _hard_rock_offset(position, start, last_position, last_time, rng):
+        """A fruit's position under HR; returns (position, last_position, last_time) for the next fruit."""
+        if last_position is None:
+            return position, position, start
+
+        position_diff = position - last_position
+        # stable used whole milliseconds here
+        time_diff = int(start - last_time)
+        if time_diff > 1000:
+            return position, position, start
+
+        if position_diff == 0:
+            right = rng.next_bool()
+            offset = min(20, rng.next_range(0, max(0, time_diff / 4)))
+            if right:
+                position = position + offset if position + offset <= PLAYFIELD_WIDTH else position - offset
+            else:
+                position = position - offset if position - offset >= 0 else position + offset
+            return position, last_position, last_time
+
+        if abs(position_diff) < time_diff // 3:
+            if position_diff > 0:
+                if position + position_diff < PLAYFIELD_WIDTH:
+                    position += position_diff
+            elif position + position_diff > 0:
+                position += position_diff
+        return position, position, start
+
+
+class CatchDifficulty:
+    """Star rating and approach rate of a catch map with mods."""
+
+    def __init__(self, beatmap, mods=0, objects=None):
+        """objects is the map's CatchObjects, when already built for other mods."""
+        self.mods = mods = int(mods)
+        circle_size, approach_rate = float(beatmap.circle_size), float(beatmap.approach_rate)
+        if mods & slider.Mod.hard_rock:
+            circle_size = min(circle_size * 1.3, 10.)
+            approach_rate = min(approach_rate * 1.4, 10.)
+        elif mods & slider.Mod.easy:
+            circle_size *= 0.5
+            approach_rate *= 0.5
+        self.clock_rate = clock_rate(mods)
+
+        preempt = difficulty_range(approach_rate, 1800, 1200, 450) / self.clock_rate
+        self.approach_rate = -(preempt - 1800) / 120 if preempt > 1200 else -(preempt - 1200) / 150 + 5
+
+        objects = CatchObjects(beatmap) if objects is None else objects
+        x, time, __ = objects.positions(hard_rock=bool(mods & slider.Mod.hard_rock))
+        self.max_combo = len(objects)
+        self.star_rating = self._star_rating(x, time, circle_size) if len(objects) > 1 else 0.
+
+    @staticmethod
+    def _hyperdashes(x, time, circle_size):
+        """Whether each object is a hyperdash to the next, and how far from being one it is (osu! pixels)."""
+        scale = 1 - 0.7 * (circle_size - 5) / 5
+        # hyperdashes are decided with the full catcher, like in stable
+        half_catcher_width = CATCHER_SIZE * abs(scale) * ALLOWED_CATCH_RANGE / 2 / ALLOWED_CATCH_RANGE
+
+        direction = numpy.where(numpy.diff(x) > 0, 1, -1).tolist()
+        distance = numpy.abs(numpy.diff(x)).tolist()
+        # a quarter frame of grace time
+        time_to_next = (numpy.diff(time) - 1000 / 60 / 4).tolist()
+
+        hyper = [False] * len(x)
+        distance_to_hyper = [0.] * len(x)
+        last_direction, last_excess = 0, half_catcher_width
+        for i in range(len(x) - 1):
+            this_direction = direction[i]
+            distance_to_next = distance[i] - (last_excess if last_direction == this_direction else half_catcher_width)
+            to_hyper = time_to_next[i] - distance_to_next
+            if to_hyper < 0:
+                hyper[i] = True
+                last_excess = half_catcher_width
+            else:
+                distance_to_hyper[i] = to_hyper
+                last_excess = min(max(to_hyper, 0), half_catcher_width)
+            last_direction = this_direction
+        return numpy.array(hyper), numpy.array(distance_to_hyper)
+
+    def _star_rating(self, x, time, circle_size):
+        hyper, distance_to_hyper = self._hyperdashes(x, time, circle_size)
+
+        scale = 1 - 0.7 * (circle_size - 5) / 5
+        half_catch_width = CATCHER_SIZE * abs(scale) * ALLOWED_CATCH_RANGE * 0.5
+        # circle sizes above 5.5 shrink it further, to simulate imperfect play
+        half_catch_width *= 1 - max(0., circle_size - 5.5) * 0.0625
+        position = x * (NORMALIZED_HITOBJECT_RADIUS / half_catch_width)
+
+        # difficulty objects: each fruit/droplet after the first, against the one before it
+        time = time / self.clock_rate
+        delta_time = numpy.diff(time)
+        strain_time = numpy.maximum(40, delta_time)
+        weighted_strain_time = strain_time + 13 + 3 / self.clock_rate
+        sqrt_strain = numpy.sqrt(weighted_strain_time)
+        # about the last object, which the edge dash checks are about
+        last_hyper = hyper[:-1]
+        edge_dash = distance_to_hyper[:-1] <= 20
+        edge_dash_factor = (20 - distance_to_hyper[:-1]) / 20 * \
+            (numpy.minimum(strain_time * self.clock_rate, 265) / 265) ** 1.5
+        direction_time_factor = numpy.maximum(1 - (weighted_strain_time / 1000) ** 3, 0)
+        last_strain_time = numpy.concatenate([[0.], strain_time[:-1]])
+        direction_change_scale = DIRECTION_CHANGE_BONUS / numpy.sqrt(last_strain_time + 16) * direction_time_factor
+
+        margin = NORMALIZED_HITOBJECT_RADIUS - ABSOLUTE_PLAYER_POSITIONING_ERROR
+        values = self._movement(position[1:].tolist(), float(position[0]), margin, weighted_strain_time.tolist(),
+                                sqrt_strain.tolist(), direction_change_scale.tolist(), edge_dash.tolist(),
+                                last_hyper.tolist(), edge_dash_factor.tolist())
+
+        strains = self._strains(numpy.asarray(values) * SKILL_MULTIPLIER, delta_time)
+        peaks = self._section_peaks(strains, time[1:])
+        difficulty = (numpy.sort(peaks)[::-1] * DECAY_WEIGHT ** numpy.arange(len(peaks))).sum()
+        return math.sqrt(difficulty) * STAR_SCALING_FACTOR
+
+    @staticmethod
+    def _movement(position, last_player_position, margin, weighted_strain_time, sqrt_strain, direction_change_scale,
+                  edge_dash, last_hyper, edge_dash_factor):
+        """Movement strain of each difficulty object, before SKILL_MULTIPLIER."""
+        values = []
+        last_distance_moved = 0.
+        for i, current in enumerate(position):
+            player_position = min(max(last_player_position, current - margin), current + margin)
+            distance_moved = player_position - last_player_position
+            abs_distance_moved = abs(distance_moved)
+
+            distance_addition = abs_distance_moved ** 1.3 / 510
+            if abs_distance_moved > 0.1:
+                if abs(last_distance_moved) > 0.1 and (distance_moved > 0) != (last_distance_moved > 0):
+                    bonus_factor = min(50., abs_distance_moved) / 50
+                    antiflow_factor = max(min(70., abs(last_distance_moved)) / 70, 0.38)
+                    distance_addition += direction_change_scale[i] * bonus_factor * antiflow_factor
+                # base bonus for every movement, giving some weight to streams
+                distance_addition += 12.5 * min(abs_distance_moved, NORMALIZED_HITOBJECT_RADIUS * 2) \
+                    / (NORMALIZED_HITOBJECT_RADIUS * 6) / sqrt_strain[i]
+
+            if edge_dash[i]:
+                if last_hyper[i]:
+                    # after a hyperdash the catcher is exactly in place
+                    player_position = current
+                else:
+                    distance_addition *= 1 + 5.7 * edge_dash_factor[i]
+
+            last_player_position = player_position
+            last_distance_moved = distance_moved
+            values.append(distance_addition / weighted_strain_time[i])
+        return values
+
+    @staticmethod
+    def _strains(values, delta_time):
+        """Strain level after each object: decayed since the previous one, plus its own strain (starting at 1)."""
+        decay = (STRAIN_DECAY_BASE ** (delta_time / 1000)).tolist()
+        strains = []
+        strain = 1.
+        for d, value in zip(decay, values.tolist()):
+            strain = strain * d + value
+            strains.append(strain)
+        return numpy.array(strains)
+
+    @staticmethod
+    def _section_peaks(strains, time):
+        """Peak strain of every SECTION_LENGTH section between the first and last object, empty ones included."""
+        section = numpy.ceil(time / SECTION_LENGTH).astype(numpy.int64)
+        sections = numpy.arange(section[0], section[-1] + 1)
+
+        starts = numpy.searchsorted(section, sections)
+        occupied = starts < numpy.searchsorted(section, sections, side="right")
+        object_peaks = numpy.full(len(sections), -numpy.inf)
+        object_peaks[occupied] = numpy.maximum.reduceat(strains, starts[occupied])
+
+        # a section starts at the strain left over from the last object before it, decayed until its start
+        previous = starts[1:] - 1
+        since_previous = (sections[1:] - 1) * SECTION_LENGTH - time[previous]
+        initial = numpy.concatenate([[1.], strains[previous] * STRAIN_DECAY_BASE ** (since_previous / 1000)])
+        return numpy.maximum(object_peaks, initial)
+
+
+# parsed layouts are shared by a map's mod combinations
+_objects = LRUCache(64)
+_difficulties = LRUCache(1024)
+
+
+def difficulty(beatmap, mods=0, beatmap_id=None):
+    """CatchDifficulty of a map, memoized per (beatmap_id, mods that change it)."""
+    beatmap_id = int(beatmap_id if beatmap_id is not None else beatmap.beatmap_id)
+    mods = int(mods) & DIFFICULTY_MODS
+    result = _difficulties.get((beatmap_id, mods))
+    if result is None:
+        objects = _objects.get(beatmap_id)
+        if objects is None:
+            objects = _objects[beatmap_id] = CatchObjects(beatmap)
+        result = _difficulties[(beatmap_id, mods)] = CatchDifficulty(beatmap, mods, objects)
+    return result
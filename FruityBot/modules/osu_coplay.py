@@ -0,0 +1,227 @@
+"""Beatmap co-play index: which maps the same players passed within the same pp band.
+
+Every user_best result the bot fetches is added to the index, split by mode and by pp band (bands are
+25% wide, like the band recommendations are picked from). For each (mode, band) the index keeps the
+sparse beatmap x beatmap matrix of how many players passed both maps, so a user's recommendations are
+the rows of their top plays summed, instead of a few hundred API calls.
+
+Rebuild the matrices of an osu library directory from its stored scores with:
+    python -m FruityBot.modules.osu_coplay path/to/osulib
+"""
+import argparse
+import logging
+import pathlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy
+import scipy.sparse
+
+logger = logging.getLogger(__name__)
+
+# lower edges of the pp bands; each is 25% above the one before, the first takes everything below 50pp
+BAND_EDGES = 50 * 1.25 ** numpy.arange(20)
+
+SCORES_DTYPE = numpy.dtype([("user_id", "<u4"), ("mode", "u1"), ("beatmap_id", "<u4"), ("band", "u1")])
+
+
+def band(pp):
+    """The pp band (an index into BAND_EDGES) of each of pp."""
+    return numpy.maximum(numpy.searchsorted(BAND_EDGES, pp, side="right") - 1, 0)
+
+
+class CoPlayIndex:
+    """Players' passing scores and the co-play matrices built from them, by (mode, band).
+
+    add_user replaces a player's scores and queues the change to the matrices, which is applied on the
+    next query, so adding the scores of a recommendation fan-out stays cheap. Thread-safe.
+    """
+    FILE = "coplay.npz"
+
+    def __init__(self, directory=None):
+        self.directory = None if directory is None else pathlib.Path(directory)
+        self.users = {}  # (user_id, mode): (beatmap ids, bands) of their passing scores
+        self.beatmap_ids = []  # matrix row/column: beatmap id
+        self.positions = {}  # beatmap id: matrix row/column
+        self.matrices = {}  # (mode, band): csr co-play counts, without the diagonal
+        self.pending = {}  # (mode, band): ([rows], [columns], [counts]) not in matrices yet
+        self.dirty = False
+        self.mutex = threading.Lock()
+
+    def _position(self, beatmap_ids):
+        for beatmap_id in beatmap_ids.tolist():
+            if beatmap_id not in self.positions:
+                self.positions[beatmap_id] = len(self.beatmap_ids)
+                self.beatmap_ids.append(beatmap_id)
+        return numpy.fromiter((self.positions[beatmap_id] for beatmap_id in beatmap_ids), numpy.int64,
+                              len(beatmap_ids))
+
+    def _queue(self, mode, positions, bands, count):
+        for b in numpy.unique(bands):
+            columns = positions[bands == b]
+            rows, cols = numpy.meshgrid(columns, columns, indexing="ij")
+            off_diagonal = rows != cols
+            pending = self.pending.setdefault((mode, int(b)), ([], [], []))
+            pending[0].append(rows[off_diagonal])
+            pending[1].append(cols[off_diagonal])
+            pending[2].append(numpy.full(off_diagonal.sum(), count, dtype=numpy.int32))
+
+    def add_user(self, user_id, mode, scores):
+        """Replace a player's scores in a mode with scores, (beatmap_id, pp) pairs of their passes."""
+        scores = list(scores)
+        beatmap_ids = numpy.array([beatmap_id for beatmap_id, __ in scores], dtype=numpy.int64)
+        bands = band(numpy.array([pp for __, pp in scores], dtype=numpy.float64))
+        key = (int(user_id), int(mode))
+        with self.mutex as __:
+            old = self.users.get(key)
+            if old is not None:
+                if numpy.array_equal(old[0], beatmap_ids) and numpy.array_equal(old[1], bands):
+                    return
+                self._queue(key[1], self._position(old[0]), old[1], -1)
+            self._queue(key[1], self._position(beatmap_ids), bands, 1)
+            self.users[key] = (beatmap_ids, bands)
+            self.dirty = True
+
+    def _flush(self):
+        """Apply pending changes and size every matrix to the maps seen so far; holds the mutex."""
+        size = len(self.beatmap_ids)
+        for matrix in self.matrices.values():
+            # maps first seen since the last flush, in this band or any other
+            if matrix.shape != (size, size):
+                matrix.resize((size, size))
+        for key, (rows, cols, counts) in self.pending.items():
+            delta = scipy.sparse.coo_matrix((numpy.concatenate(counts), (numpy.concatenate(rows),
+                                                                         numpy.concatenate(cols))),
+                                            shape=(size, size)).tocsr()
+            matrix = self.matrices.get(key)
+            matrix = delta if matrix is None else matrix + delta
+            matrix.eliminate_zeros()
+            self.matrices[key] = matrix
+        self.pending = {}
+
+    def build(self):
+        """Recompute every matrix from the stored scores, as incidence^T x incidence per (mode, band)."""
+        with self.mutex as __:
+            self.matrices, self.pending = {}, {}
+            if not self.users:
+                return
+            player = numpy.repeat(numpy.arange(len(self.users)), [len(ids) for ids, __ in self.users.values()])
+            mode = numpy.repeat([mode for __, mode in self.users], [len(ids) for ids, __ in self.users.values()])
+            positions = numpy.concatenate([self._position(ids) for ids, __ in self.users.values()])
+            bands = numpy.concatenate([bands for __, bands in self.users.values()])
+            size = len(self.beatmap_ids)
+
+            order = numpy.lexsort((bands, mode))
+            keys = numpy.stack([mode[order], bands[order]], axis=1)
+            starts = numpy.flatnonzero(numpy.r_[True, (numpy.diff(keys, axis=0) != 0).any(axis=1)])
+            for group in numpy.split(order, starts[1:]):
+                incidence = scipy.sparse.csr_matrix(
+                    (numpy.ones(len(group), dtype=numpy.int32), (player[group], positions[group])),
+                    shape=(len(self.users), size))
+                matrix = (incidence.T @ incidence).tocsr()
+                matrix.setdiag(0)
+                matrix.eliminate_zeros()
+                self.matrices[int(mode[group[0]]), int(bands[group[0]])] = matrix
+
+    def query(self, played, mode, pp, k=200):
+        """Up to k (beatmap_id, players) most co-played with the maps of played in pp's band, most first.
+
+        played are the beatmap ids of a user's top plays, which are left out of the result.
+        """
+        with self.mutex as __:
+            self._flush()
+            matrix = self.matrices.get((int(mode), int(band(pp))))
+            played = [self.positions[beatmap_id] for beatmap_id in played if beatmap_id in self.positions]
+            if matrix is None or not played:
+                return OrderedDict()
+            scores = numpy.asarray(matrix[played].sum(axis=0)).ravel()
+            beatmap_ids = self.beatmap_ids
+
+        scores[played] = 0
+        candidates = numpy.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            # everything tied with the k-th, so ties are cut by beatmap id below
+            kth = -numpy.partition(-scores[candidates], k - 1)[k - 1]
+            candidates = candidates[scores[candidates] >= kth]
+        # most players first, ties by beatmap id
+        candidate_ids = numpy.array([beatmap_ids[i] for i in candidates], dtype=numpy.int64)
+        candidates = candidates[numpy.lexsort((candidate_ids, -scores[candidates]))][:k]
+        return OrderedDict((beatmap_ids[i], int(scores[i])) for i in candidates)
+
+    def __len__(self):
+        return len(self.users)
+
+    def save(self):
+        """Write the stored scores and the matrices to directory."""
+        with self.mutex as __:
+            self._flush()
+            scores = numpy.zeros(sum(len(beatmap_ids) for beatmap_ids, __ in self.users.values()), SCORES_DTYPE)
+            i = 0
+            for (user_id, mode), (beatmap_ids, bands) in self.users.items():
+                rows = scores[i:i + len(beatmap_ids)]
+                rows["user_id"], rows["mode"], rows["beatmap_id"], rows["band"] = user_id, mode, beatmap_ids, bands
+                i += len(beatmap_ids)
+            arrays = {"scores": scores, "beatmap_ids": numpy.array(self.beatmap_ids, dtype=numpy.int64)}
+            for (mode, b), matrix in self.matrices.items():
+                for part in ("data", "indices", "indptr"):
+                    arrays[f"{mode}_{b}_{part}"] = getattr(matrix, part)
+            self.dirty = False
+
+        tmp = self.directory / (self.FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            numpy.savez(f, **arrays)
+        tmp.replace(self.directory / self.FILE)
+        logger.debug(f"CoPlayIndex.save | {len(scores)} scores of {len(self.users)} players")
+
+    @classmethod
+    def open(cls, directory):
+        """The index saved in directory, or an empty one."""
+        index = cls(directory)
+        try:
+            arrays = numpy.load(index.directory / cls.FILE)
+        except FileNotFoundError:
+            return index
+
+        scores = arrays["scores"]
+        order = numpy.lexsort((scores["mode"], scores["user_id"]))
+        scores = scores[order]
+        starts = numpy.flatnonzero(numpy.r_[True, (numpy.diff(scores["user_id"].astype(numpy.int64)) != 0) |
+                                            (numpy.diff(scores["mode"].astype(numpy.int64)) != 0)])
+        for user_scores in numpy.split(scores, starts[1:]):
+            if len(user_scores):
+                index.users[int(user_scores["user_id"][0]), int(user_scores["mode"][0])] = \
+                    (user_scores["beatmap_id"].astype(numpy.int64), user_scores["band"].astype(numpy.int64))
+
+        index.beatmap_ids = arrays["beatmap_ids"].tolist()
+        index.positions = {beatmap_id: i for i, beatmap_id in enumerate(index.beatmap_ids)}
+        size = len(index.beatmap_ids)
+        for name in arrays.files:
+            if name.endswith("_data"):
+                mode, b = map(int, name.split("_")[:2])
+                indptr = arrays[f"{mode}_{b}_indptr"]
+                # a matrix is saved with the shape it had, which files written before every matrix was resized
+                # on flush may have left smaller than the maps seen
+                matrix = scipy.sparse.csr_matrix((arrays[name], arrays[f"{mode}_{b}_indices"], indptr),
+                                                 shape=(len(indptr) - 1, len(indptr) - 1))
+                matrix.resize((size, size))
+                index.matrices[mode, b] = matrix
+        return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the co-play index of an osu library directory.")
+    parser.add_argument("library", type=pathlib.Path)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    index = CoPlayIndex.open(args.library)
+    start = time.perf_counter()
+    index.build()
+    index.save()
+    logger.info(f"{len(index)} players, {len(index.beatmap_ids)} beatmaps, {len(index.matrices)} matrices "
+                f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
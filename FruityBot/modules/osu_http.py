@@ -0,0 +1,210 @@
+"""Shared, connection-pooled HTTP for the osu! API and beatmap downloads.
+
+requests.get opens a new connection (and TLS handshake) for every call, which is what slider's client
+and library do. One Session keeps connections alive between calls and across threads instead;
+SessionClient and SessionLibrary are slider's client and library sending their requests through it.
+"""
+import json
+import logging
+import pathlib
+import threading
+import time
+
+import requests
+import slider
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_URL = "https://osu.ppy.sh/osu"
+
+
+def create_session(pool_connections=4, pool_maxsize=16):
+    """A Session keeping up to pool_maxsize connections per host alive, for pool_connections hosts."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip", "User-Agent": "FruityBot"})
+    return session
+
+
+class SessionClient(slider.client.Client):
+    """slider's osu! API client, sending its requests through session.
+
+    slider calls requests.get inline, so the endpoints are requested here and parsed the way slider does.
+    """
+
+    def __init__(self, library, api_key, api_url="https://osu.ppy.sh/api", *, session=None):
+        super().__init__(library, api_key, api_url)
+        self.session = session if session is not None else create_session()
+
+    def copy(self):
+        return type(self)(self.library.copy(), self.api_key, self.api_url, session=self.session)
+
+    def _get(self, endpoint, params, aliases):
+        response = self.session.get(f"{self.api_url}/{endpoint}", params=params)
+        response.raise_for_status()
+        return [{aliases.get(k, k): v for k, v in row.items()} for row in response.json()]
+
+    @staticmethod
+    def _convert(row, conversions):
+        return {k: conversions[k](v) for k, v in row.items() if k in conversions}
+
+    def beatmap(self, *, since=None, beatmap_set_id=None, beatmap_id=None, beatmap_md5=None, user_id=None,
+                user_name=None, game_mode=None, include_converted_beatmaps=False, limit=500):
+        identifiers = {k: v for k, v in {"beatmap_set_id": beatmap_set_id, "beatmap_id": beatmap_id,
+                                         "beatmap_md5": beatmap_md5}.items() if v is not None}
+        if len(identifiers) > 1:
+            raise ValueError(f"only one of beatmap_set_id, beatmap_id, or beatmap_md5 can be passed, "
+                             f"got {identifiers!r}")
+        if limit > 500:
+            raise ValueError("only 500 beatmaps can be requested at one time")
+
+        params = {"k": self.api_key, "a": int(bool(include_converted_beatmaps)), "limit": limit}
+        if since is not None:
+            params["since"] = since.isoformat()
+        if beatmap_set_id is not None:
+            params["s"] = beatmap_set_id
+        elif beatmap_id is not None:
+            params["b"] = beatmap_id
+        elif beatmap_md5 is not None:
+            params["h"] = beatmap_md5
+        user_info = self._user_and_type(user_name, user_id, required=False)
+        if user_info is not None:
+            params["u"], params["t"] = user_info
+        if game_mode is not None:
+            params["m"] = int(game_mode)
+
+        beatmaps = [slider.client.BeatmapResult(library=self.library, **self._convert(row, self._beatmap_conversions))
+                    for row in self._get("get_beatmaps", params, self._beatmap_aliases)]
+        if beatmap_id is None and beatmap_md5 is None:
+            return beatmaps
+        if len(beatmaps) != 1:
+            kind, id_ = ("id", beatmap_id) if beatmap_id is not None else ("md5", beatmap_md5)
+            raise slider.client.UnknownBeatmap(kind, id_)
+        return beatmaps[0]
+
+    def user(self, *, user_name=None, user_id=None, game_mode=slider.GameMode.standard, event_days=1):
+        user, type_ = self._user_and_type(user_name, user_id, required=True)
+        if not 1 <= event_days <= 31:
+            raise ValueError(f"event_days must be in range [1, 31], got {event_days!r}")
+
+        (row,) = self._get("get_user", {"k": self.api_key, "u": user, "t": type_, "m": int(game_mode),
+                                        "event_days": event_days}, self._user_aliases)
+        for event in row["events"]:
+            event["library"] = self.library
+        return slider.client.User(client=self, **self._convert(row, self._user_conversions), game_mode=game_mode)
+
+    def user_best(self, *, user_name=None, user_id=None, game_mode=slider.GameMode.standard, limit=10, _user_ob=None):
+        user, type_ = self._user_and_type(user_name, user_id, required=True)
+        if not 1 <= limit <= 100:
+            raise ValueError(f"limit must be in the range [1, 100], got: {limit!r}")
+
+        rows = self._get("get_user_best", {"k": self.api_key, "u": user, "t": type_, "m": int(game_mode),
+                                           "limit": limit}, self._user_best_aliases)
+        return [slider.client.HighScore(client=self, **self._convert(row, self._user_best_conversions), _user=_user_ob)
+                for row in rows]
+
+
+class SessionLibrary(slider.library.Library):
+    """slider's beatmap library, downloading maps through session."""
+
+    def __init__(self, path, *, cache=2048, download_url=DOWNLOAD_URL, session=None):
+        super().__init__(path, cache=cache, download_url=download_url)
+        self.cache_size = cache
+        self.download_url = download_url
+        self.session = session if session is not None else create_session()
+
+    @classmethod
+    def create_db(cls, path, *, session=None, **kwargs):
+        library = super().create_db(path, **kwargs)
+        if session is not None:
+            library.session = session
+        return library
+
+    def copy(self):
+        return type(self)(self.path, cache=self.cache_size, download_url=self.download_url, session=self.session)
+
+    def download(self, beatmap_id, *, save=False):
+        response = self.session.get(f"{self.download_url}/{beatmap_id}")
+        response.raise_for_status()
+        data = response.content
+        beatmap = slider.Beatmap.parse(data.decode("utf-8-sig"))
+        if save:
+            self.save(data, beatmap=beatmap)
+        return beatmap
+
+    def paths(self, beatmap_id):
+        """The files saved for a beatmap id, relative to path as slider stores them."""
+        return {path for path, in self._db.execute("SELECT path FROM beatmaps WHERE id = ?", (beatmap_id,))}
+
+
+class BeatmapDownloader:
+    """Downloads .osu files, revalidating ones already downloaded with their ETag/Last-Modified.
+
+    Validators are kept in path (a JSON file) with the time each map was last checked, so maps are only
+    revalidated once they are revalidate_after seconds old, and then usually get a bodiless 304. Changes are
+    written at most every save_interval seconds, and by save().
+    """
+
+    def __init__(self, session, path=None, download_url=DOWNLOAD_URL, revalidate_after=60 * 60 * 24,
+                 save_interval=60):
+        self.session = session
+        self.path = None if path is None else pathlib.Path(path)
+        self.download_url = download_url
+        self.revalidate_after = revalidate_after
+        self.save_interval = save_interval
+        self.mutex = threading.Lock()
+        self.validators = {}  # beatmap id (str): {"etag", "last_modified", "checked"}
+        self.dirty = False
+        self.saved = time.monotonic()
+        if self.path is not None and self.path.exists():
+            try:
+                self.validators = json.loads(self.path.read_text())
+            except ValueError:
+                logger.warning(f"BeatmapDownloader | {self.path} is unreadable, starting over")
+
+    def stale(self, beatmap_id):
+        """Whether a downloaded map is due for revalidation."""
+        validator = self.validators.get(str(beatmap_id))
+        return validator is None or validator["checked"] + self.revalidate_after <= time.time()
+
+    def fetch(self, beatmap_id, revalidate=False):
+        """The .osu file of a beatmap as bytes; None if revalidating and it hasn't changed."""
+        headers = {}
+        validator = self.validators.get(str(beatmap_id)) if revalidate else None
+        if validator is not None:
+            if validator.get("etag"):
+                headers["If-None-Match"] = validator["etag"]
+            if validator.get("last_modified"):
+                headers["If-Modified-Since"] = validator["last_modified"]
+
+        response = self.session.get(f"{self.download_url}/{beatmap_id}", headers=headers)
+        if response.status_code == 304 and validator is not None:
+            logger.debug(f"BeatmapDownloader.fetch | {beatmap_id} unchanged")
+            self._update(beatmap_id, dict(validator, checked=time.time()))
+            return None
+        response.raise_for_status()
+        self._update(beatmap_id, {"etag": response.headers.get("ETag"),
+                                  "last_modified": response.headers.get("Last-Modified"), "checked": time.time()})
+        return response.content
+
+    def _update(self, beatmap_id, validator):
+        with self.mutex as __:
+            self.validators[str(beatmap_id)] = validator
+            self.dirty = True
+            if time.monotonic() - self.saved < self.save_interval:
+                return
+        self.save()
+
+    def save(self):
+        """Write the validators to path if any changed since they last were."""
+        with self.mutex as __:
+            if self.path is None or not self.dirty:
+                return
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.validators))
+            tmp.replace(self.path)
+            self.dirty = False
+            self.saved = time.monotonic()
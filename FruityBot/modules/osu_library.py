@@ -0,0 +1,86 @@
+import logging
+import threading
+from hashlib import md5
+
+from ..utils import LRUCache, SingleFlight
+from .osu_http import SessionLibrary
+
+logger = logging.getLogger(__name__)
+
+
+class BeatmapCache:
+    """Parsed beatmaps by id, shared by every command thread.
+
+    Recently used maps stay parsed in a bounded LRU, so follow-ups on the same map (!with, !acc) never
+    touch disk. Misses read through a Library handle owned by the calling thread, since slider's SQLite
+    handles can't be used from another thread; each thread opens its handle once instead of once per call.
+    Concurrent misses on the same map share one lookup, so it is downloaded and saved once.
+
+    With a BeatmapDownloader, missing maps are downloaded through its pooled session, and maps on disk are
+    revalidated once they are stale, replacing the saved file if the map was updated.
+    """
+
+    def __init__(self, path, maxsize=256, downloader=None):
+        self.path = path
+        self.beatmaps = LRUCache(maxsize)
+        self.downloader = downloader
+        self.flight = SingleFlight()
+        self._local = threading.local()
+
+    def open_library(self):
+        # parsed maps are kept here, not in every handle's own lru_cache
+        return SessionLibrary(self.path, cache=0, session=None if self.downloader is None else self.downloader.session)
+
+    @property
+    def library(self):
+        library = getattr(self._local, "library", None)
+        if library is None:
+            logger.debug(f"BeatmapCache.library | opening library handle for {threading.current_thread().name}")
+            library = self._local.library = self.open_library()
+        return library
+
+    def get(self, beatmap_id):
+        """Look a beatmap up by id, downloading and saving it to the library if it isn't there."""
+        beatmap_id = int(beatmap_id)
+        beatmap = self.beatmaps.get(beatmap_id)
+        if beatmap is None:
+            beatmap = self.flight.do(beatmap_id, self._load, beatmap_id)
+        return beatmap
+
+    def _load(self, beatmap_id):
+        # an earlier flight may have finished between the miss and getting here
+        beatmap = self.beatmaps.get(beatmap_id)
+        if beatmap is None:
+            if self.downloader is None:
+                beatmap = self.library.lookup_by_id(beatmap_id, download=True, save=True)
+            else:
+                beatmap = self._lookup(beatmap_id)
+            self.beatmaps[beatmap_id] = beatmap
+        return beatmap
+
+    def _lookup(self, beatmap_id):
+        try:
+            beatmap = self.library.lookup_by_id(beatmap_id)
+        except KeyError:
+            beatmap = None
+        if beatmap is not None and not self.downloader.stale(beatmap_id):
+            return beatmap
+
+        data = self.downloader.fetch(beatmap_id, revalidate=beatmap is not None)
+        if data is None or (beatmap is not None and self.library.beatmap_cached(beatmap_md5=md5(data).hexdigest())):
+            return beatmap
+        if beatmap is None:
+            return self.library.save(data)
+
+        logger.debug(f"BeatmapCache._lookup | {beatmap_id} was updated, replacing it")
+        old_paths = self.library.paths(beatmap_id)
+        # save overwrites the file, unless the update renamed the map
+        self.library.delete(beatmap, remove_file=False)
+        beatmap = self.library.save(data)
+        for path in old_paths - self.library.paths(beatmap_id):
+            logger.debug(f"BeatmapCache._lookup | removing {path}, renamed by the update")
+            (self.path / path).unlink(missing_ok=True)
+        return beatmap
+
+    def clear(self):
+        self.beatmaps.clear()
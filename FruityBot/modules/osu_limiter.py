@@ -0,0 +1,169 @@
+"""One rate limiter for all osu! API traffic, handing out requests in priority order.
+
+Interactive commands (!np, !with, ...) take INTERACTIVE and go ahead of anything queued at BACKGROUND,
+like a recommendation fan-out. Waiting is done with Deferreds scheduled on the reactor, so nothing sleeps
+or polls; threads that need a token park on blockingCallFromThread until theirs is handed out.
+
+With a Redis bucket, every bot process using the same key shares the budget; priorities still only order
+each process's own queue. Its round-trips run off the reactor, which carries on while the answer is pending.
+"""
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from functools import wraps
+
+import numpy
+from twisted.internet import defer, threads
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, BACKGROUND = 0, 1
+
+
+class TokenBucket:
+    """rate tokens a second, saving up to capacity; clock gives the current time in seconds."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def take(self):
+        """Take a token and return 0, or return how many seconds until there is one."""
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.
+        return (1 - self.tokens) / self.rate
+
+
+class RedisTokenBucket:
+    """A TokenBucket kept in a Redis hash, shared by every process using key.
+
+    take returns a Deferred, running the script in a thread (with defer_to_thread) so the reactor never waits
+    on Redis.
+    """
+    SCRIPT = """
+local rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = math.min(capacity, (tonumber(state[1]) or capacity) + (now - (tonumber(state[2]) or now)) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, redis, key, rate, capacity, defer_to_thread=threads.deferToThread):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.script = redis.register_script(self.SCRIPT)
+        self.defer_to_thread = defer_to_thread
+
+    def _take(self):
+        return float(self.script(keys=[self.key], args=[self.rate, self.capacity]))
+
+    def take(self):
+        return self.defer_to_thread(self._take)
+
+
+class PriorityLimiter:
+    """Hands out a bucket's tokens to waiters, lowest priority value first, in arrival order within one.
+
+    acquire must be called on the reactor; wait and limited are for threads. The bucket's take may return
+    the seconds to wait or a Deferred of them. Wait times are recorded per priority for metrics.
+    """
+    RETRY = 1.  # seconds until a bucket that failed is asked again
+
+    def __init__(self, bucket, reactor=None, samples=1000):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.bucket = bucket
+        self.queue = []  # (priority, arrival, queued at, Deferred)
+        self.arrivals = itertools.count()
+        self.drain_call = None
+        self.waits = {}  # priority: deque of recent wait times
+        self.samples = samples
+
+    def acquire(self, priority=INTERACTIVE):
+        """A Deferred fired once the caller may make one request."""
+        d = defer.Deferred()
+        heapq.heappush(self.queue, (priority, next(self.arrivals), self.reactor.seconds(), d))
+        if self.drain_call is None:
+            self._drain()
+        return d
+
+    def _drain(self):
+        self.drain_call = None
+        while self.queue:
+            wait = self.bucket.take()
+            if isinstance(wait, defer.Deferred):
+                # only one take in flight; acquire doesn't drain while drain_call is set
+                self.drain_call = wait
+                wait.addCallbacks(self._taken, self._take_failed)
+                return
+            if not self._grant(wait):
+                return
+
+    def _grant(self, wait):
+        """Hand the next waiter the token taken, or drain again once there is one; True if handed out."""
+        if wait > 0:
+            self.drain_call = self.reactor.callLater(wait, self._drain)
+            return False
+        priority, __, queued, d = heapq.heappop(self.queue)
+        self.waits.setdefault(priority, deque(maxlen=self.samples)).append(self.reactor.seconds() - queued)
+        d.callback(None)
+        return True
+
+    def _taken(self, wait):
+        self.drain_call = None
+        if self._grant(wait):
+            self._drain()
+
+    def _take_failed(self, failure):
+        logger.error("PriorityLimiter._drain | taking a token failed, retrying in %.0fs", self.RETRY,
+                     exc_info=failure.value)
+        self.drain_call = self.reactor.callLater(self.RETRY, self._drain)
+
+    def wait(self, priority=INTERACTIVE):
+        """Block the calling thread (never the reactor) until it may make one request."""
+        threads.blockingCallFromThread(self.reactor, self.acquire, priority)
+
+    def limited(self, f, priority=INTERACTIVE):
+        """f, waiting for a token before each call; for threads."""
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            self.wait(priority)
+            return f(*args, **kwargs)
+        return wrapper
+
+    def metrics(self):
+        """Per priority: requests recently handed out, and their queue wait p50/p99/max in seconds."""
+        result = {"queued": len(self.queue)}
+        for priority, waits in sorted(self.waits.items()):
+            p50, p99 = numpy.percentile(waits, [50, 99])
+            result[priority] = {"count": len(waits), "p50": float(p50), "p99": float(p99), "max": max(waits)}
+        return result
+
+
+def limit_client(client, limiter, priority=INTERACTIVE):
+    """Route a slider client's API calls through limiter; copies of it aren't limited."""
+    for name in ("beatmap", "user", "user_best", "user_recent", "beatmap_best"):
+        method = getattr(client, name, None)
+        if method is not None:
+            setattr(client, name, limiter.limited(method, priority))
+    return client
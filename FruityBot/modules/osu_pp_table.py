@@ -0,0 +1,175 @@
+"""Precomputed pp curves per beatmap and supported mod combination, stored as memory-mapped arrays.
+
+Build offline from the summaries in an osu library directory with:
+    python -m FruityBot.modules.osu_pp_table path/to/osulib
+"""
+import argparse
+import itertools
+import logging
+import os
+import pathlib
+
+import numpy
+import slider
+
+logger = logging.getLogger(__name__)
+
+# mods Osu.cmd_with accepts, by mode
+SUPPORTED_MODS = ["", "nfezhdhrfl", "hdfl", "nfez"]
+
+# the column each mode's curve runs along, from best to worst
+GRIDS = {
+    slider.GameMode.taiko: ("acc", numpy.round(numpy.linspace(1., .9, 101), 6)),
+    slider.GameMode.ctb:   ("acc", numpy.round(numpy.linspace(1., .9, 101), 6)),
+    slider.GameMode.mania: ("score", numpy.linspace(1_000_000, 500_000, 101)),
+}
+
+INDEX_DTYPE = numpy.dtype([("beatmap_id", "<u4"), ("digest", "<u8")])
+
+
+def mod_sets(mode):
+    """Every combination of a mode's supported mods, without contradicting ones (EZ and HR)."""
+    mods = [1 << bit for bit in range(32) if slider.Mod.parse(SUPPORTED_MODS[mode]) & (1 << bit)] \
+        if SUPPORTED_MODS[mode] else []
+    combinations = (sum(c) for n in range(len(mods) + 1) for c in itertools.combinations(mods, n))
+    easy_hard_rock = slider.Mod.easy | slider.Mod.hard_rock
+    return tuple(sorted(c for c in combinations if c & easy_hard_rock != easy_hard_rock))
+
+
+class PPTable:
+    """pp of full combo, no miss plays along GRIDS, for one mode.
+
+    Stored in a directory as pp_<mode>.npy, shape (beatmaps, mod sets, grid points), and
+    pp_<mode>.index.npy, the beatmap ids (sorted) with the BeatmapSummary.digest each row was computed from,
+    so rows for maps whose API data or difficulty settings changed since are ignored.
+    """
+
+    def __init__(self, mode, index, values):
+        self.mode = slider.GameMode(mode)
+        self.column, self.grid = GRIDS[self.mode]
+        self.mod_sets = mod_sets(self.mode)
+        self.mod_positions = {mods: i for i, mods in enumerate(self.mod_sets)}
+        self.index = index
+        self.values = values
+
+    @staticmethod
+    def paths(directory, mode):
+        directory = pathlib.Path(directory)
+        return directory / f"pp_{int(mode)}.npy", directory / f"pp_{int(mode)}.index.npy"
+
+    @classmethod
+    def open(cls, directory, mode):
+        values_path, index_path = cls.paths(directory, mode)
+        try:
+            index = numpy.load(index_path)
+            values = numpy.load(values_path, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        if values.shape[1:] != (len(mod_sets(mode)), len(GRIDS[mode][1])) or len(values) != len(index) \
+                or index.dtype != INDEX_DTYPE:
+            logger.warning(f"PPTable.open | {values_path} doesn't match the current grid, ignoring it")
+            return None
+        return cls(mode, index, values)
+
+    @classmethod
+    def build(cls, directory, mode, summaries, calculate_pp_batch):
+        """Compute the table for summaries of a mode and replace the stored one; returns the new table.
+
+        calculate_pp_batch is Osu.calculate_pp_batch; maps it fails on are left out.
+        """
+        mode = slider.GameMode(mode)
+        column, grid = GRIDS[mode]
+        sets = mod_sets(mode)
+        summaries = sorted({s.beatmap_id: s for s in summaries if s.mode == mode}.values(),
+                           key=lambda s: s.beatmap_id)
+
+        values_path, index_path = cls.paths(directory, mode)
+        tmp_values_path = values_path.with_suffix(".tmp.npy")
+        values = numpy.lib.format.open_memmap(tmp_values_path, mode="w+", dtype=numpy.float64,
+                                              shape=(len(summaries), len(sets), len(grid)))
+        index = numpy.zeros(len(summaries), dtype=INDEX_DTYPE)
+        rows = 0
+        for summary in summaries:
+            try:
+                values[rows] = [calculate_pp_batch(summary, mods=mods, **{column: grid}) for mods in sets]
+            except Exception:
+                logger.exception(f"PPTable.build | skipping {summary}")
+                continue
+            index[rows] = (summary.beatmap_id, summary.digest())
+            rows += 1
+        values.flush()
+        del values
+
+        if rows != len(summaries):
+            # drop the rows of skipped maps
+            full = numpy.load(tmp_values_path, mmap_mode="r")
+            numpy.save(values_path.with_suffix(".tmp2.npy"), full[:rows])
+            del full
+            os.replace(values_path.with_suffix(".tmp2.npy"), tmp_values_path)
+        numpy.save(index_path.with_suffix(".tmp.npy"), index[:rows])
+        # readers keep their maps of the old files until they reopen
+        os.replace(tmp_values_path, values_path)
+        os.replace(index_path.with_suffix(".tmp.npy"), index_path)
+        logger.info(f"PPTable.build | {rows} beatmaps x {len(sets)} mod sets for {mode.name}")
+        return cls.open(directory, mode)
+
+    def lookup(self, summary, mods=0, **kwargs):
+        """pp for a play, exact on grid points and linearly interpolated between them; None if not covered."""
+        column = kwargs.pop(self.column, 1. if self.column == "acc" else 1_000_000)
+        if kwargs.pop("miss", 0) != 0:
+            return None
+        player_combo = kwargs.pop("player_combo", None)
+        if kwargs or (player_combo is not None and player_combo != summary.max_combo):
+            return None
+
+        mod_position = self.mod_positions.get(int(mods))
+        if mod_position is None:
+            return None
+        i = numpy.searchsorted(self.index["beatmap_id"], summary.beatmap_id)
+        if i == len(self.index) or self.index[i]["beatmap_id"] != summary.beatmap_id \
+                or self.index[i]["digest"] != summary.digest():
+            return None
+
+        # grid runs downwards
+        if not self.grid[-1] <= column <= self.grid[0]:
+            return None
+        curve = self.values[i, mod_position]
+        return float(numpy.interp(column, self.grid[::-1], curve[::-1]))
+
+    def __len__(self):
+        return len(self.index)
+
+
+class PPTables:
+    """The PPTable of each mode that has one built, looked up by a summary's mode."""
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.tables = {mode: PPTable.open(self.directory, mode) for mode in GRIDS}
+
+    def build(self, summaries, calculate_pp_batch):
+        summaries = list(summaries)
+        self.tables = {mode: PPTable.build(self.directory, mode, summaries, calculate_pp_batch) for mode in GRIDS}
+
+    def lookup(self, summary, mods=0, **kwargs):
+        table = self.tables.get(summary.mode)
+        if table is None:
+            return None
+        return table.lookup(summary, mods, **kwargs)
+
+
+def main():
+    from .osu import Osu
+    from .osu_summary import BeatmapSummaryStore
+
+    parser = argparse.ArgumentParser(description="Build the pp tables of an osu library directory.")
+    parser.add_argument("library", type=pathlib.Path)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    summaries = BeatmapSummaryStore(args.library / "summaries.bin", ttl=None)
+    PPTables(args.library).build(summaries, Osu.calculate_pp_batch)
+
+
+if __name__ == "__main__":
+    main()
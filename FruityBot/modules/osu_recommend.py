@@ -0,0 +1,233 @@
+"""Map recommendations from players who set scores similar to a user's top plays.
+
+For each of a user's top plays, the players whose score on that map is closest in pp are looked up
+(beatmap_best), then their own top plays within the user's pp band (user_best). Maps that come up most
+often, and that the user hasn't played, are recommended first.
+"""
+import heapq
+import logging
+import threading
+from collections import Counter, OrderedDict, namedtuple
+from itertools import islice
+
+import slider
+from twisted.internet import defer, threads
+from twisted.python import failure, threadpool
+
+from ..utils import LRUCache, SingleFlight
+from .osu_limiter import BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+# ranks that count as having properly played a map
+PASSING_RANKS = frozenset(("S", "X", "SH", "XH"))
+
+Score = namedtuple("Score", "beatmap_id user_id pp rank")
+
+
+class ScoreStore:
+    """beatmap_best and user_best results by (id, mode), shared by every user's recommendations.
+
+    Popular maps and players come up in many users' top plays, so results are kept for ttl seconds as
+    compact Score tuples, and concurrent fetches of the same key wait on one API call. Like
+    BeatmapCache, each thread makes its calls through its own copy of the client.
+
+    on_user_best(user_id, mode, scores) is called with every user_best result fetched. Fetches wait
+    their turn on limiter (a PriorityLimiter) at BACKGROUND priority.
+    """
+
+    def __init__(self, client, ttl=60 * 60 * 6, maxsize=50_000, on_user_best=None, limiter=None):
+        self.client = client
+        self.on_user_best = on_user_best
+        self.limiter = limiter
+        self.scores = LRUCache(maxsize, ttl)
+        self.flight = SingleFlight()
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def thread_client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.client.copy()
+        return client
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def _get(self, key, fetch, **kwargs):
+        scores = self.scores.get(key)
+        if scores is not None:
+            self._count("hits")
+            return scores
+        self._count("misses")
+        return self.flight.do(key, self._fetch, key, fetch, **kwargs)
+
+    def _fetch(self, key, fetch, **kwargs):
+        # a flight that ended while this one was starting may have just stored it
+        scores = self.scores.get(key)
+        if scores is None:
+            self._count("fetches")
+            if self.limiter is not None:
+                self.limiter.wait(BACKGROUND)
+            scores = tuple(Score(int(s.beatmap_id), int(s.user_id), float(s.pp), s.rank)
+                           for s in getattr(self.thread_client, fetch)(**kwargs))
+            self.scores[key] = scores
+            if fetch == "user_best" and self.on_user_best is not None:
+                self.on_user_best(key[1], key[2], scores)
+        return scores
+
+    def beatmap_best(self, beatmap_id, mode):
+        return self._get(("beatmap_best", int(beatmap_id), int(mode)), "beatmap_best",
+                         beatmap_id=int(beatmap_id), game_mode=slider.GameMode(mode))
+
+    def user_best(self, user_id, mode):
+        return self._get(("user_best", int(user_id), int(mode)), "user_best",
+                         user_id=int(user_id), game_mode=slider.GameMode(mode))
+
+    def hit_rate(self):
+        with self._stats_lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return self.stats["hits"] / lookups if lookups else 0.
+
+
+def pp_band(top_plays):
+    """The pp range recommended maps' scores should be in: the mean of the top plays, up to 25% above it."""
+    mean = sum(top_play.pp for top_play in top_plays) / len(top_plays)
+    return mean, mean * 1.25
+
+
+def candidates(store, top_play, mode, band, per_play=20, cancelled=None):
+    """Maps recommended by one top play, most similar players first; one entry per player who set a score on it.
+
+    Raises CancelledError between fetches once cancelled (a threading.Event) is set.
+    """
+    lower, upper = band
+
+    def closest(scores):
+        return sorted(scores, key=lambda score: abs(score.pp - top_play.pp))[:per_play]
+
+    def check_cancelled():
+        if cancelled is not None and cancelled.is_set():
+            raise defer.CancelledError()
+
+    check_cancelled()
+    beatmap_ids = []
+    for high_score in closest(store.beatmap_best(top_play.beatmap_id, mode)):
+        check_cancelled()
+        scores = store.user_best(high_score.user_id, mode)
+        beatmap_ids.extend(score.beatmap_id for score in closest(
+            score for score in scores if score.rank in PASSING_RANKS and lower <= score.pp <= upper))
+    return beatmap_ids
+
+
+def rank(top_plays, candidate_lists, retain=200):
+    """Recommended beatmap ids with how often they came up, most frequent first, without maps already played.
+
+    candidate_lists are the candidates of each top play, in top play order; ties keep the order maps
+    first came up in.
+    """
+    counter = Counter()
+    for beatmap_ids in candidate_lists:
+        counter.update(beatmap_ids)
+    for top_play in top_plays:
+        counter.pop(top_play.beatmap_id, None)
+    ranking = sorted(counter.items(), key=lambda item: item[1], reverse=True)
+    return OrderedDict(islice(ranking, retain))
+
+
+def refine(shown, ranking):
+    """ranking with the recommendations already shown kept first, in the order they were shown."""
+    refined = OrderedDict(shown)
+    for beatmap_id, count in ranking.items():
+        refined.setdefault(beatmap_id, count)
+    return refined
+
+
+class RecommendJob:
+    """One user's recommendations being generated; deferred fires with rank()'s result.
+
+    Candidates are counted as each top play finishes, so the ranking so far is ready at any point.
+    cancel() fires deferred with CancelledError right away; top plays still being worked on stop at
+    their next API call.
+    """
+
+    def __init__(self, top_plays):
+        self.top_plays = top_plays
+        self.played = {top_play.beatmap_id for top_play in top_plays}
+        self.cancelled = threading.Event()
+        self.deferred = defer.Deferred(canceller=lambda d: self.cancelled.set())
+        self.results = [None] * len(top_plays)
+        self.counter = Counter()
+        self.finished = 0
+
+    def cancel(self):
+        self.deferred.cancel()
+
+    def ranking(self, retain=200):
+        """The top retain maps of the top plays finished so far, like rank()."""
+        top = heapq.nlargest(retain, ((beatmap_id, count) for beatmap_id, count in self.counter.items()
+                                      if beatmap_id not in self.played), key=lambda item: item[1])
+        return OrderedDict(top)
+
+    @property
+    def done(self):
+        return self.deferred.called
+
+
+class Recommender:
+    """Generates recommendations on one bounded pool shared by every user, reading through a ScoreStore."""
+
+    def __init__(self, store, workers=8, per_play=20, retain=200, pool=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.store = store
+        self.per_play = per_play
+        self.retain = retain
+
+        if pool is None:
+            pool = threadpool.ThreadPool(workers, workers, "recommendations")
+            pool.start()
+            self.reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+        self.pool = pool
+        self.stopped = False
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.pool.stop()
+
+    def recommend(self, top_plays, mode, progress=None, partial=None, first_after=5):
+        """Start generating recommendations from top_plays; returns the RecommendJob.
+
+        progress(finished, total) is called on the reactor as each top play is done. Once first_after top
+        plays are, partial(ranking so far, finished, total) is too, until the last one fires the deferred.
+        """
+        job = RecommendJob(list(top_plays))
+        band = pp_band(job.top_plays)
+        for i, top_play in enumerate(job.top_plays):
+            d = threads.deferToThreadPool(self.reactor, self.pool, candidates, self.store, top_play, mode, band,
+                                          self.per_play, job.cancelled)
+            d.addBoth(self._play_done, job, i, progress, partial, first_after)
+        return job
+
+    def _play_done(self, result, job, i, progress, partial, first_after):
+        if job.done:
+            return
+        if isinstance(result, failure.Failure):
+            # the other top plays still make a recommendation
+            logger.error(f"Recommender._play_done | top play {job.top_plays[i].beatmap_id} failed",
+                         exc_info=result.value)
+            result = []
+        job.results[i] = result
+        job.counter.update(result)
+        job.finished += 1
+        if progress is not None:
+            progress(job.finished, len(job.top_plays))
+        if job.finished == len(job.top_plays):
+            job.deferred.callback(rank(job.top_plays, job.results, self.retain))
+        elif partial is not None and job.finished >= first_after:
+            partial(job.ranking(self.retain), job.finished, len(job.top_plays))
@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import pathlib
+import struct
+import time
+from threading import Lock
+
+import slider
+
+logger = logging.getLogger(__name__)
+
+
+class BeatmapSummary:
+    """The few numbers pp calculation and Osu.format_message need from a beatmap, for one game mode.
+
+    Extracted once from a parsed slider.Beatmap and its API data; mode-dependent values (star rating,
+    max combo) come from the API for that mode, so converted maps get one summary per mode.
+    """
+    __slots__ = ("beatmap_id", "beatmap_set_id", "mode", "map_mode", "star_rating", "approach_rate",
+                 "overall_difficulty", "max_combo", "map_max_combo", "object_count", "hit_length", "key_count",
+                 "fetched", "display_name")
+
+    # everything but display_name, which follows as utf-8; unknown ids and combos are stored as 0
+    _struct = struct.Struct("<IIBBdddIIIIBI")
+
+    def __init__(self, beatmap_id, beatmap_set_id, mode, map_mode, star_rating, approach_rate, overall_difficulty,
+                 max_combo, map_max_combo, object_count, hit_length, key_count, display_name, fetched=None):
+        self.beatmap_id = beatmap_id
+        self.beatmap_set_id = beatmap_set_id
+        self.mode = slider.GameMode(mode)
+        self.map_mode = slider.GameMode(map_mode)
+        self.star_rating = star_rating
+        self.approach_rate = approach_rate
+        self.overall_difficulty = overall_difficulty
+        self.max_combo = max_combo
+        self.map_max_combo = map_max_combo
+        self.object_count = object_count
+        self.hit_length = hit_length
+        self.key_count = key_count
+        self.display_name = display_name
+        self.fetched = int(time.time()) if fetched is None else fetched
+
+    @classmethod
+    def from_beatmap(cls, beatmap_data, beatmap_data_api, mode):
+        mode = slider.GameMode(mode)
+        try:
+            map_max_combo = int(beatmap_data.max_combo)
+        except Exception:
+            map_max_combo = None
+        return cls(
+            beatmap_id=int(beatmap_data_api.beatmap_id),
+            beatmap_set_id=beatmap_data.beatmap_set_id,
+            mode=mode,
+            map_mode=beatmap_data.mode,
+            star_rating=float(beatmap_data_api.star_rating),
+            approach_rate=float(beatmap_data.approach_rate),
+            overall_difficulty=float(beatmap_data.overall_difficulty),
+            max_combo=None if beatmap_data_api.max_combo is None else int(beatmap_data_api.max_combo),
+            map_max_combo=map_max_combo,
+            object_count=len(beatmap_data.hit_objects),
+            hit_length=int(beatmap_data_api.hit_length.seconds),
+            key_count=slider.mod.key_count(beatmap_data) if mode == slider.GameMode.mania else 0,
+            display_name=beatmap_data.display_name,
+        )
+
+    def pack(self):
+        return self._struct.pack(
+            self.beatmap_id, self.beatmap_set_id or 0, self.mode, self.map_mode, self.star_rating,
+            self.approach_rate, self.overall_difficulty, self.max_combo or 0, self.map_max_combo or 0,
+            self.object_count, self.hit_length, self.key_count, self.fetched,
+        ) + self.display_name.encode()
+
+    def digest(self):
+        """64 bits identifying everything in the summary but when it was fetched, so refetching an unchanged map
+        keeps it."""
+        fetched, self.fetched = self.fetched, 0
+        try:
+            data = self.pack()
+        finally:
+            self.fetched = fetched
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+    @classmethod
+    def unpack(cls, data):
+        (beatmap_id, beatmap_set_id, mode, map_mode, star_rating, approach_rate, overall_difficulty, max_combo,
+         map_max_combo, object_count, hit_length, key_count, fetched) = cls._struct.unpack_from(data)
+        return cls(beatmap_id, beatmap_set_id or None, mode, map_mode, star_rating, approach_rate,
+                   overall_difficulty, max_combo or None, map_max_combo or None, object_count, hit_length, key_count,
+                   bytes(data[cls._struct.size:]).decode(), fetched)
+
+    def __eq__(self, other):
+        if not isinstance(other, BeatmapSummary):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self):
+        return f"<{type(self).__qualname__}: {self.display_name} ({self.beatmap_id}, {self.mode.name})>"
+
+
+class BeatmapSummaryStore:
+    """Packed BeatmapSummary records indexed by beatmap_id, then mode.
+
+    Records are kept as bytes (around a hundred per map) and appended to a file when path is given, so
+    they survive restarts; the latest record for a (beatmap_id, mode) wins. Records older than ttl
+    seconds are treated as missing, as API values like star rating can change.
+    """
+    MAGIC = b"FBSUM\x01"
+    _length = struct.Struct("<H")
+
+    def __init__(self, path=None, ttl=60 * 60 * 24 * 7):
+        self.path = None if path is None else pathlib.Path(path)
+        self.ttl = ttl
+        self.records = {}  # beatmap_id: {mode: packed summary}
+        self.mutex = Lock()
+        if self.path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            data = b""
+        if not data.startswith(self.MAGIC):
+            if data:
+                logger.warning(f"BeatmapSummaryStore._load | {self.path} has an unknown format, starting over")
+            self.path.write_bytes(self.MAGIC)
+            return
+
+        view = memoryview(data)
+        offset, count = len(self.MAGIC), 0
+        try:
+            while offset < len(view):
+                (length,) = self._length.unpack_from(view, offset)
+                offset += self._length.size
+                record = bytes(view[offset:offset + length])
+                if len(record) < length:
+                    raise struct.error("truncated record")
+                offset += length
+                self._index(record)
+                count += 1
+        except struct.error:
+            logger.warning(f"BeatmapSummaryStore._load | {self.path} is truncated after {count} records")
+        logger.debug(f"BeatmapSummaryStore._load | {count} records, {len(self)} summaries")
+
+        # rewrite once refreshed maps leave too many dead records behind
+        if count > 2 * len(self) or offset != len(view):
+            self.compact()
+
+    def _index(self, record):
+        summary = BeatmapSummary.unpack(record)
+        self.records.setdefault(summary.beatmap_id, {})[int(summary.mode)] = record
+
+    def compact(self):
+        with self.mutex as __:
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "wb") as f:
+                f.write(self.MAGIC)
+                for modes in self.records.values():
+                    for record in modes.values():
+                        f.write(self._length.pack(len(record)) + record)
+            tmp.replace(self.path)
+
+    def add(self, summary):
+        record = summary.pack()
+        with self.mutex as __:
+            self.records.setdefault(summary.beatmap_id, {})[int(summary.mode)] = record
+            if self.path is not None:
+                with open(self.path, "ab") as f:
+                    f.write(self._length.pack(len(record)) + record)
+
+    def get(self, beatmap_id, mode):
+        record = self.records.get(int(beatmap_id), {}).get(int(mode))
+        if record is None:
+            return None
+        summary = BeatmapSummary.unpack(record)
+        if self.ttl is not None and summary.fetched + self.ttl <= time.time():
+            return None
+        return summary
+
+    def __iter__(self):
+        with self.mutex as __:
+            records = [record for modes in self.records.values() for record in modes.values()]
+        for record in records:
+            summary = BeatmapSummary.unpack(record)
+            if self.ttl is None or summary.fetched + self.ttl > time.time():
+                yield summary
+
+    def map_mode(self, beatmap_id):
+        """The mode a beatmap was made for, if any of its summaries is stored."""
+        modes = self.records.get(int(beatmap_id))
+        if not modes:
+            return None
+        return BeatmapSummary.unpack(next(iter(modes.values()))).map_mode
+
+    def __len__(self):
+        return sum(len(modes) for modes in self.records.values())
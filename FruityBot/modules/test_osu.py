@@ -1,7 +1,12 @@
+from collections import OrderedDict
+
+import numpy
 import pytest
+import slider
 from irc.client import Event, NickMask
 
 from . import osu
+from .osu_summary import BeatmapSummary
 from ..utils import Config
 from io import StringIO
 import sys
@@ -88,3 +93,50 @@ def test_mod(stuff, link, args, mods, expected):
     print(output)
     assert re.findall(r"\d+?.?\d+?pp", output[-1]) == expected
 
+
+
+SUMMARIES = {
+    1514618: BeatmapSummary(1514618, 457332, slider.GameMode.ctb, slider.GameMode.ctb, 7.1382, 9.0, 9.0,
+                            3927, 1604, 1604, 238, 0, "Camellia - Exit This Earth's Atomosphere [Overdose]"),
+    871924: BeatmapSummary(871924, 400761, slider.GameMode.taiko, slider.GameMode.taiko, 6.2811, 10.0, 6.0,
+                           None, 641, 641, 190, 0, "xi - Blue Zenith [Oni]"),
+    939698: BeatmapSummary(939698, 436217, slider.GameMode.mania, slider.GameMode.mania, 5.1183, 10.0, 8.0,
+                           None, 2420, 2020, 164, 7, "t+pazolite - Oshama Scramble! [Another]"),
+}
+
+
+# mania pp needs a slider with key mods
+MANIA = pytest.mark.skipif(not hasattr(slider.Mod, "key_mod"), reason="slider without key mods")
+
+
+@pytest.mark.parametrize("beatmap_id, columns, mods", [
+    # the !np curves and the test_acc/test_mod plays above
+    (1514618, {"acc": numpy.arange(1., .98, -0.005), "player_combo": 3927, "miss": 0}, 0),
+    (1514618, {"acc": [0.999381443298969, 0.9985567010309279], "player_combo": [3927, 3880], "miss": [0, 4]}, 0),
+    (1514618, {"acc": [0.9985567010309279], "player_combo": [3880], "miss": [4]}, slider.Mod.hidden),
+    (1514618, {"acc": numpy.arange(1., .9, -0.001), "player_combo": 3000, "miss": 2}, slider.Mod.flashlight),
+    (871924, {"acc": numpy.arange(1., .97, -0.01), "miss": 0}, 0),
+    (871924, {"acc": [0.9294755877034359], "miss": [4]}, 0),
+    (871924, {"acc": numpy.arange(1., .9, -0.001), "miss": 3}, slider.Mod.hidden | slider.Mod.hard_rock),
+    (871924, {"acc": numpy.arange(1., .9, -0.001), "miss": 0}, slider.Mod.easy | slider.Mod.flashlight),
+    pytest.param(939698, {"score": numpy.arange(1_000_000, 900_000, -25_000)}, 0, marks=MANIA),
+    pytest.param(939698, {"score": [996483]}, 0, marks=MANIA),
+    pytest.param(939698, {"score": numpy.arange(1_000_000, 400_000, -1_000)}, slider.Mod.no_fail, marks=MANIA),
+    pytest.param(939698, {"score": numpy.arange(1_000_000, 400_000, -1_000)}, slider.Mod.easy, marks=MANIA),
+])
+def test_calculate_pp_batch(beatmap_id, columns, mods):
+    summary = SUMMARIES[beatmap_id]
+    batch = osu.Osu.calculate_pp_batch(summary, mods=mods, **columns)
+    rows = zip(*(a.tolist() for a in numpy.broadcast_arrays(*map(numpy.asarray, columns.values()))))
+    scalar = [osu.Osu.calculate_pp(summary, mods=mods, **dict(zip(columns, row))) for row in rows]
+    # numpy's vectorized pow may round the last bit differently; shown pp is rounded to 2 places
+    assert numpy.allclose(batch, scalar, rtol=1e-12, atol=0)
+    assert [f"{pp:.2f}" for pp in batch] == [f"{pp:.2f}" for pp in scalar]
+
+
+def test_calculate_pp_many():
+    # !np on 1514618: pp only scales with acc ** 5.5 along the curve
+    expected = numpy.array([1002.26, 975.01, 948.36, 922.32])
+    pp_args = tuple(OrderedDict(acc=i, player_combo=3927, miss=0) for i in (1., .995, .99, .985))
+    pp_values = osu.Osu.calculate_pp_many(SUMMARIES[1514618], pp_args)
+    assert numpy.allclose(pp_values / pp_values[0], expected / expected[0], atol=1e-4)
@@ -0,0 +1,64 @@
+import logging
+import pickle
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class Serializer:
+    """Turns objects into compressed bytes and back; its name goes into cache keys so formats never mix."""
+
+    def __init__(self, name, dumps, loads, compress=None, decompress=None):
+        self.name = name
+        self._dumps = dumps
+        self._loads = loads
+        self._compress = compress
+        self._decompress = decompress
+
+    def dumps(self, obj):
+        data = self._dumps(obj)
+        return self._compress(data) if self._compress else data
+
+    def loads(self, data):
+        data = bytes(data)
+        return self._loads(self._decompress(data) if self._decompress else data)
+
+    def __repr__(self):
+        return f"<{type(self).__qualname__}: {self.name}>"
+
+
+def _dill():
+    import dill
+    return (lambda obj: dill.dumps(obj, dill.HIGHEST_PROTOCOL)), dill.loads
+
+
+def _msgpack():
+    import msgpack
+    return (lambda obj: msgpack.packb(obj, use_bin_type=True)), (lambda data: msgpack.unpackb(data, raw=False))
+
+
+def _lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+# name: function returning (dumps, loads); optional formats import their dependency only when chosen
+FORMATS = {
+    "pickle":  lambda: ((lambda obj: pickle.dumps(obj, min(5, pickle.HIGHEST_PROTOCOL))), pickle.loads),
+    "dill":    _dill,
+    "msgpack": _msgpack,  # plain data only (dicts, lists, numbers, strings)
+}
+
+COMPRESSIONS = {
+    "none": lambda: (None, None),
+    "zlib": lambda: (zlib.compress, zlib.decompress),
+    "lz4":  _lz4,
+}
+
+
+def get_serializer(serializer="pickle", compression="zlib"):
+    if serializer not in FORMATS:
+        raise ValueError(f"Unknown serializer {serializer}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}")
+    return Serializer(f"{serializer}+{compression}", *FORMATS[serializer](), *COMPRESSIONS[compression]())
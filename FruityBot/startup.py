@@ -0,0 +1,93 @@
+"""Startup profiling.
+
+Run the bot with --profile-startup (python -m FruityBot.bot --profile-startup) and, once it has signed on,
+the log gets how long each startup phase and each import took.
+"""
+import builtins
+import importlib.util
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfile:
+    """Times phases (with phase) and, once enabled, every module imported through an import statement.
+
+    Import times are kept inclusive (with what the module imported) and exclusive, by module name. Until
+    enable is called, phase does nothing, so it can stay on the startup path for good.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.start = time.perf_counter()
+        self.phases = []  # (name, seconds since start, seconds taken)
+        self.imports = {}  # module name: [inclusive seconds, exclusive seconds]
+        self.reported = False
+        self._import = None
+        self._local = threading.local()
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            self._import = builtins.__import__
+            builtins.__import__ = self._timed_import
+
+    def disable(self):
+        if self.enabled:
+            self.enabled = False
+            builtins.__import__ = self._import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        full_name = name
+        if level:
+            try:
+                full_name = importlib.util.resolve_name("." * level + name, (globals or {}).get("__package__"))
+            except (ImportError, ValueError):
+                pass
+        if full_name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.)
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            times = self.imports.setdefault(full_name, [0., 0.])
+            times[0] += elapsed
+            times[1] += elapsed - children
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start - self.start, time.perf_counter() - start))
+
+    def report(self, event, top=20):
+        """Log the phases and the slowest imports up to event, the first time it is called."""
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+        logger.info("Startup profile | %s after %.3fs", event, time.perf_counter() - self.start)
+        for name, started, seconds in self.phases:
+            logger.info("Startup profile | phase %-32s at %7.3fs took %7.3fs", name, started, seconds)
+        slowest = sorted(self.imports.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        for name, (inclusive, exclusive) in slowest:
+            logger.info("Startup profile | import %-40s %7.3fs (%7.3fs itself)", name, inclusive, exclusive)
+        self.disable()
+
+
+profile = StartupProfile()
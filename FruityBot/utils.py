@@ -6,21 +6,23 @@ import logging.config
 import pathlib
 import sqlite3
 import sys
+import time
 import zlib
-from collections import MutableMapping, OrderedDict
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from string import Formatter
+from threading import Event, Lock
 from types import ModuleType
 
 import box
-import dill
-import sqlitedict
 from irc.client import NickMask
 
 from .exceptions import MissingPreferenceError
-from slider import Beatmap, GameMode
 
 logger = logging.getLogger(__name__)
 
+_missing = object()
+
 
 def reload_all(top_module, max_depth=20):
     """
@@ -99,6 +101,7 @@ def check_mode_in_db(source: NickMask, bot, beatmap_mode: int, np: bool = False)
         if np:
             mode_db = bot.user_pref.get(source.nick).mode
             if mode_db is None:
+                from slider import GameMode
                 bot.msg(
                     source.nick, f"Automatically setting mode to {GameMode(beatmap_mode).name}... "
                     f"use \"!set mode [catch|mania|taiko]\" to change"
@@ -119,6 +122,9 @@ def set_pref(source: NickMask, bot, pref: str, arg):
 
 
 def load_db(db: str or pathlib.Path, table: str):
+    import dill
+    import sqlitedict
+
     def encode(obj):
         return sqlite3.Binary(zlib.compress(dill.dumps(obj, dill.HIGHEST_PROTOCOL)))
 
@@ -233,7 +239,90 @@ class RecentDict(MutableMapping):
         )
 
 
-class ThreadDict(RecentDict):
-    def __check_size_limit(self):
-        if len(self.d) == self.maxlen:
-            self.d.popitem(last=False)[1].stop()
+class LRUCache:
+    """A thread-safe mapping holding at most maxsize keys, evicting the least recently used one.
+
+    If ttl is given, keys also expire ttl seconds after they were set.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._d = OrderedDict()  # key: (value, expiry time or None)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._d.move_to_end(key)
+            except KeyError:
+                return default
+            value, expires = self._d[key]
+            if expires is not None and expires <= time.monotonic():
+                del self._d[key]
+                return default
+            return value
+
+    def __setitem__(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._d[key] = (value, expires)
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._d.pop(key, (default, None))[0]
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._d)
+
+    def __repr__(self):
+        return f'<{type(self).__qualname__}: {len(self)}/{self.maxsize}>'
+
+
+class SingleFlight:
+    """Lets concurrent callers of the same key share one call instead of each making their own."""
+
+    class _Call:
+        def __init__(self):
+            self.done = Event()
+            self.result = None
+            self.exc = None
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, f, *args, **kwargs):
+        """Call f, unless a call for key is already running; then wait for it and share its result or exception."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.exc is not None:
+                raise call.exc
+            return call.result
+
+        try:
+            call.result = f(*args, **kwargs)
+        except BaseException as exc:
+            call.exc = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
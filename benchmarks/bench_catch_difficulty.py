@@ -0,0 +1,86 @@
+"""Time to compute catch star ratings natively, on a generated map of a few thousand objects.
+
+Run from the repository root: python -m benchmarks.bench_catch_difficulty
+"""
+import random
+import timeit
+
+import slider
+
+from FruityBot.modules.osu_catch_difficulty import CatchDifficulty, CatchObjects
+
+HEADER = """osu file format v14
+
+[General]
+AudioFilename: audio.mp3
+Mode: 2
+
+[Metadata]
+Title:generated
+TitleUnicode:generated
+Artist:FruityBot
+ArtistUnicode:FruityBot
+Creator:FruityBot
+Version:{version}
+BeatmapID:{beatmap_id}
+BeatmapSetID:-1
+
+[Difficulty]
+HPDrainRate:5
+CircleSize:{circle_size}
+OverallDifficulty:8
+ApproachRate:{approach_rate}
+SliderMultiplier:1.8
+SliderTickRate:1
+
+[TimingPoints]
+0,{ms_per_beat},4,2,0,60,1,0
+
+[HitObjects]
+"""
+
+
+def generate(objects=3500, seed=0, beatmap_id=0, circle_size=4, approach_rate=9, bpm=180):
+    """The text of a catch map with about `objects` fruits and droplets: jumps, streams, sliders and spinners."""
+    rng = random.Random(seed)
+    ms_per_beat = 60000 / bpm
+    lines = []
+    time, count, x = 1000, 0, 256
+    while count < objects:
+        kind = rng.random()
+        if kind < 0.5:
+            # a jump or a walk, a quarter or half beat later
+            x = rng.randrange(512) if rng.random() < 0.5 else max(0, min(512, x + rng.randrange(-60, 61)))
+            lines.append(f"{x},192,{time},1,0,0:0:0:0:")
+            time += int(ms_per_beat / rng.choice((2, 4)))
+            count += 1
+        elif kind < 0.95:
+            beats = rng.choice((1, 2))
+            repeat = rng.choice((1, 1, 2))
+            length = beats * 1.8 * 100
+            end_x = max(0, min(512, x + rng.choice((-1, 1)) * int(length * 0.9)))
+            curve = f"L|{end_x}:192" if rng.random() < 0.5 else f"B|{(x + end_x) // 2}:100|{end_x}:192"
+            lines.append(f"{x},192,{time},2,0,{curve},{repeat},{length}")
+            time += int(beats * ms_per_beat * repeat + ms_per_beat / 2)
+            count += beats * repeat + 1
+            x = end_x if repeat % 2 else x
+        else:
+            lines.append(f"256,192,{time},12,0,{time + int(ms_per_beat * 4)},0:0:0:0:")
+            time += int(ms_per_beat * 5)
+    return HEADER.format(version=f"{objects} objects", beatmap_id=beatmap_id, circle_size=circle_size,
+                         approach_rate=approach_rate, ms_per_beat=ms_per_beat) + "\n".join(lines) + "\n"
+
+
+def main(number=5):
+    beatmap = slider.Beatmap.parse(generate())
+    seconds = timeit.timeit(lambda: CatchObjects(beatmap), number=number) / number
+    objects = CatchObjects(beatmap)
+    print(f"{len(objects)} fruits and droplets laid out in {seconds * 1e3:.1f}ms")
+
+    for name, mods in (("nomod", 0), ("DT", slider.Mod.double_time), ("HR", slider.Mod.hard_rock)):
+        stars = CatchDifficulty(beatmap, mods, objects).star_rating
+        seconds = timeit.timeit(lambda: CatchDifficulty(beatmap, mods, objects), number=number) / number
+        print(f"{name:>5}: {stars:.4f}* in {seconds * 1e3:.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Co-play index build time, query latency and incremental updates, on generated players.
+
+Run from the repository root: python -m benchmarks.bench_coplay
+"""
+import time
+import timeit
+
+import numpy
+
+from FruityBot.modules.osu_coplay import CoPlayIndex
+
+CTB = 2
+
+
+def generate(players, maps=30_000, per_player=50, seed=0):
+    """(user_id, scores) of players whose passes follow a power law over maps, with pp around 250."""
+    rng = numpy.random.default_rng(seed)
+    popularity = 1 / numpy.arange(1, maps + 1) ** 0.9
+    popularity /= popularity.sum()
+    for user_id in range(1, players + 1):
+        beatmap_ids = rng.choice(maps, per_player, replace=False, p=popularity) + 100_000
+        yield user_id, zip(beatmap_ids.tolist(), rng.normal(250, 30, per_player).tolist())
+
+
+def main(players=20_000, number=200):
+    index = CoPlayIndex()
+    for user_id, scores in generate(players):
+        index.add_user(user_id, CTB, scores)
+    start = time.perf_counter()
+    index.build()
+    print(f"build: {players} players, {len(index.beatmap_ids)} maps in {time.perf_counter() - start:.2f}s")
+
+    top_plays = list(range(100_000, 100_020))
+    seconds = timeit.timeit(lambda: index.query(top_plays, CTB, 250), number=number) / number
+    print(f"query: 20 top plays in {seconds * 1e3:.2f}ms")
+
+    start = time.perf_counter()
+    for user_id, scores in generate(400, seed=1):
+        # a recommendation fan-out's worth of refreshed players
+        index.add_user(user_id, CTB, scores)
+    queued = time.perf_counter() - start
+    start = time.perf_counter()
+    index.query(top_plays, CTB, 250)
+    print(f"update: 400 players queued in {queued * 1e3:.1f}ms, applied on the next query in "
+          f"{(time.perf_counter() - start) * 1e3:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Per-command latency of the user_pref accesses FruityBot.before_command makes, on each database backend.
+
+Run from the repository root: python -m benchmarks.bench_database [--mariadb USER PASSWORD DATABASE]
+SQLite always runs (in a temporary directory); MariaDB only when credentials are given.
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from FruityBot import database
+from FruityBot.utils import convert_time
+
+USER_PREF_TABLE = """CREATE TABLE IF NOT EXISTS bench_user_pref(
+                       username VARCHAR(64) PRIMARY KEY,
+                       last_command DATETIME,
+                       mode TINYINT,
+                       locale TINYTEXT
+                     )"""
+LAST_UPDATE = convert_time("1970-01-31 12:00:00")
+USERS = [f"user{i}" for i in range(200)]
+
+
+def before_command(user_pref, nick):
+    # the same table accesses as FruityBot.before_command
+    if nick not in user_pref:
+        user_pref.get(nick)
+        user_pref[nick] = {}
+    if convert_time(user_pref[nick].last_command) < LAST_UPDATE:
+        user_pref.update_last_command(nick)
+
+
+def run(backend, cache_size, rounds=5):
+    user_pref = database.UserPrefTable(database.DatabaseFile(backend), "bench_user_pref", USER_PREF_TABLE,
+                                       ['1970-01-01 00:00:00', None, 'en'], cache_size=cache_size)
+    user_pref.create()
+    for nick in USERS:
+        before_command(user_pref, nick)
+    user_pref.flush()
+
+    timings = []
+    for __ in range(rounds):
+        for nick in USERS:
+            start = time.perf_counter()
+            before_command(user_pref, nick)
+            timings.append(time.perf_counter() - start)
+        user_pref.flush()
+    user_pref.execute("DROP TABLE bench_user_pref")
+    user_pref.database.close()
+
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mariadb", nargs=3, metavar=("USER", "PASSWORD", "DATABASE"))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = {"sqlite": lambda: database.SQLiteBackend(Path(directory) / "bench.db")}
+        if args.mariadb:
+            backends["mariadb"] = lambda: database.MariaDBBackend(*args.mariadb)
+
+        for name, backend in backends.items():
+            for cache_size in (0, 1024):
+                p50, p99 = run(backend(), cache_size)
+                print(f"{name:>8} cache={cache_size:<5}: p50 {p50 * 1e6:>9.1f}us | p99 {p99 * 1e6:>9.1f}us")
+
+
+if __name__ == "__main__":
+    main()
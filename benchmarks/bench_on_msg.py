@@ -0,0 +1,95 @@
+"""Messages/sec through CoreBot.on_msg with DEBUG logging on and off, logging straight to the handler or
+through the queue set up from logging.json, to /dev/null and to a terminal that takes 50us a write.
+
+The command and the pool are stand-ins, so this measures the bot's own per-message overhead: routing,
+dispatch, the outbound queue and logging. Run from the repository root: python -m benchmarks.bench_on_msg
+"""
+import logging
+import os
+import time
+
+from irc.client import Event, NickMask
+
+import FruityBot.core_bot.core
+from FruityBot.core_bot.core import CoreBot
+from FruityBot.core_bot.dispatcher import CommandDispatcher
+from FruityBot.core_bot.outbound import OutboundQueue
+from FruityBot.core_bot.router import CommandRouter
+from FruityBot.logger import ColorFormatter, start_queue
+
+FORMAT = "%(asctime)s.%(msecs)03d | $BGCOLOR$COLOR %(levelname)s $RESET %(name)s: %(message)s"
+
+
+class FakeReactor:
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+    def seconds(self):
+        return time.monotonic()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        raise AssertionError("the flood budget is unlimited here")
+
+
+class SlowTerminal:
+    def write(self, text):
+        time.sleep(50e-6)
+
+    def flush(self):
+        pass
+
+
+class FakePool:
+    def callInThreadWithCallback(self, on_result, f, *args, **kwargs):
+        on_result(True, f(*args, **kwargs))
+
+
+class Osu:
+    def np(self, e):
+        logging.getLogger("FruityBot.modules.osu").debug("Osu.get_data | data = %s", e.arguments)
+        return "Camellia - Exit This Earth's Atomosphere [Overdose] | 98%: 512pp | 99%: 530pp | 100%: 551pp"
+    np.cmd_on_reactor = True
+
+
+def bot():
+    bot = CoreBot.__new__(CoreBot)
+    bot.nickname = "FruityBot"
+    bot.router = CommandRouter("!", {"np": Osu().np})
+    bot.dispatcher = CommandDispatcher(pool=FakePool(), reactor=FakeReactor())
+    bot.outbound = OutboundQueue(lambda user, message, length: 1, rate=1e12, burst=1e12, reactor=FakeReactor())
+    return bot
+
+
+def run(number, event, stream, queued, level):
+    root = logging.getLogger()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(ColorFormatter(FORMAT))
+    root.handlers = [handler]
+    root.setLevel(level)
+    listener = start_queue(root) if queued else None
+
+    b = bot()
+    start = time.perf_counter()
+    for __ in range(number):
+        b.on_msg(event)
+    seconds = time.perf_counter() - start
+    if listener is not None:
+        listener.stop()
+    return number / seconds
+
+
+def main(number=20_000):
+    # CoreBot.msg hands messages to the reactor thread
+    FruityBot.core_bot.core.reactor = FakeReactor()
+    event = Event("privmsg", NickMask("de/odex!cho@ppy.sh"), "FruityBot", "!np 1514618".split())
+    with open(os.devnull, "w") as devnull:
+        for name, stream in (("devnull", devnull), ("terminal", SlowTerminal())):
+            for queued in (False, True):
+                for level in (logging.DEBUG, logging.INFO):
+                    print(f"{name:>8} {'queued' if queued else 'direct':>6} {logging.getLevelName(level):>5}: "
+                          f"{run(number, event, stream, queued, level):>10,.0f} messages/s")
+    logging.getLogger().handlers = []
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""Time to evaluate a pp curve per beatmap, one calculate_pp call per point vs one calculate_pp_batch.
+
+Run from the repository root: python -m benchmarks.bench_pp
+"""
+import timeit
+
+import numpy
+import slider
+
+from FruityBot.modules.osu import Osu
+from FruityBot.modules.osu_summary import BeatmapSummary
+
+CATCH = BeatmapSummary(1514618, 457332, slider.GameMode.ctb, slider.GameMode.ctb, 7.1382, 9.0, 9.0, 3927, 1604,
+                       1604, 238, 0, "Camellia - Exit This Earth's Atomosphere [Overdose]")
+TAIKO = BeatmapSummary(871924, 400761, slider.GameMode.taiko, slider.GameMode.taiko, 6.2811, 10.0, 6.0, None, 641,
+                       641, 190, 0, "xi - Blue Zenith [Oni]")
+
+
+def main(number=2_000):
+    for summary, step in ((CATCH, 0.005), (TAIKO, 0.01), (CATCH, 0.001), (TAIKO, 0.001)):
+        acc = numpy.arange(1., .9, -step)
+        scalar = timeit.timeit(lambda: [Osu.calculate_pp(summary, acc=i) for i in acc], number=number)
+        batch = timeit.timeit(lambda: Osu.calculate_pp_batch(summary, acc=acc), number=number)
+        print(f"{summary.mode.name:>5} {len(acc):>3} points: scalar {scalar / number * 1e6:>8.1f}us | "
+              f"batch {batch / number * 1e6:>8.1f}us")
+
+
+if __name__ == "__main__":
+    main()
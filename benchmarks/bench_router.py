@@ -0,0 +1,46 @@
+"""Lines/sec of CoreBot's message parsing, before and after the CommandRouter.
+
+Run from the repository root: python -m benchmarks.bench_router
+"""
+import timeit
+
+import box
+
+from FruityBot.core_bot.router import CommandRouter
+
+PREFIX = "!"
+CONFIG = box.Box({"main": {"prefix": PREFIX}})
+ALIASES = {alias: (lambda e: None) for alias in ("np", "action", "r", "recommend", "with", "acc", "h", "help", "set")}
+
+LINES = {
+    "plain":    "!np https://osu.ppy.sh/beatmapsets/457332#fruits/1514618",
+    "compound": "!np https://osu.ppy.sh/beatmapsets/457332#fruits/1514618; acc 99.5 3900x 1m; with hd",
+    "invalid":  "!notacommand with some arguments",
+}
+
+
+def legacy_parse(arguments):
+    # what on_msg, message_to_commands, do_command and run_module_command used to do per line
+    if ' '.join(arguments)[len(CONFIG.main.prefix) - 1] == CONFIG.main.prefix and len(' '.join(arguments)) > 1:
+        commands = []
+        for full_command in ' '.join(arguments).split(CONFIG.main.prefix)[1].split(";"):
+            full_command = full_command.strip()
+            command = full_command.split()[0]
+            if ALIASES.get(command, None):
+                commands.append((full_command.split()[0], ALIASES.get(full_command.split()[0])))
+            else:
+                commands.append((command, CONFIG.main.prefix))
+        return commands
+
+
+def main(number=100_000):
+    router = CommandRouter(PREFIX, ALIASES)
+    for kind, line in LINES.items():
+        arguments = line.split()
+        legacy = timeit.timeit(lambda: legacy_parse(arguments), number=number)
+        routed = timeit.timeit(lambda: router.parse(' '.join(arguments)), number=number)
+        print(f"{kind:>8}: legacy {number / legacy:>12,.0f} lines/s | router {number / routed:>12,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Encode/decode time and payload size of a cached osu! API beatmap, for each cache serializer.
+
+Run from the repository root: python -m benchmarks.bench_serializer
+The old format (dill + zlib) is what cached stored before serializers became configurable.
+"""
+import timeit
+
+import slider.client
+
+from FruityBot import serializers
+
+# get_beatmaps response for 1514618, trimmed to the fields slider converts
+RESPONSE = {
+    "beatmapset_id": "457332", "beatmap_id": "1514618", "approved": "1", "total_length": "240",
+    "hit_length": "238", "version": "Overdose", "file_md5": "1b1b5f7a0c4f1e7a3e0f6b8f0f6a6b42",
+    "diff_size": "4", "diff_overall": "9", "diff_approach": "9", "diff_drain": "6", "mode": "2",
+    "approved_date": "2018-01-21 20:40:26", "last_update": "2018-01-13 13:07:55", "artist": "Camellia",
+    "title": "Exit This Earth's Atomosphere", "creator": "Ascendance", "creator_id": "5474", "bpm": "180",
+    "source": "", "tags": "camellia kamelcamellia ctb catch the beat", "genre_id": "10", "language_id": "5",
+    "favourite_count": "289", "playcount": "145224", "passcount": "12883", "max_combo": "2081",
+    "difficultyrating": "7.1382",
+}
+RESULT_FIELDS = ("title", "version", "beatmap_id", "approved", "approved_date", "last_update", "star_rating",
+                 "hit_length", "genre", "language", "total_length", "beatmap_md5", "favourite_count",
+                 "play_count", "pass_count", "max_combo")
+
+
+def api_beatmap():
+    # what Client.beatmap builds, minus the request; get_api_data drops the library before caching
+    fields = {slider.client.Client._beatmap_aliases.get(k, k): v for k, v in RESPONSE.items()}
+    converted = {k: slider.client.Client._beatmap_conversions[k](v)
+                 for k, v in fields.items() if k in slider.client.Client._beatmap_conversions}
+    beatmap = slider.client.BeatmapResult(library=None, **{k: converted.get(k) for k in RESULT_FIELDS})
+    del beatmap._library
+    return beatmap
+
+
+def main(number=20_000):
+    beatmap = api_beatmap()
+    candidates = [("dill", "zlib"), ("pickle", "none"), ("pickle", "zlib"), ("pickle", "lz4")]
+    for serializer, compression in candidates:
+        try:
+            cache_serializer = serializers.get_serializer(serializer, compression)
+            data = cache_serializer.dumps(beatmap)
+        except ImportError as error:
+            print(f"{serializer}+{compression:<5}: skipped ({error})")
+            continue
+        dumps = timeit.timeit(lambda: cache_serializer.dumps(beatmap), number=number)
+        loads = timeit.timeit(lambda: cache_serializer.loads(data), number=number)
+        print(f"{cache_serializer.name:>12}: dumps {dumps / number * 1e6:>7.1f}us | "
+              f"loads {loads / number * 1e6:>7.1f}us | {len(data):>5} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Calls/sec of localize.tl against the i18n lookup it replaced, and load_locales time against loading every
+pycountry language.
+
+Run from the repository root: python -m benchmarks.bench_tl
+"""
+import pathlib
+import tempfile
+import timeit
+
+import i18n
+import pycountry
+
+from FruityBot import localize
+
+KEYS = [("osu.no_np", "en"), ("set.setting", None), ("general.help", "fr")]
+ALPHA_2_LANGS = [lang.alpha_2 for lang in pycountry.languages if hasattr(lang, 'alpha_2')]
+
+
+def legacy_tl(tl_namespace, locale):
+    # what tl used to do: set i18n's process-wide locale, look up, then scan the list of languages
+    locale = 'en' if not locale else locale
+    i18n.set('locale', locale)
+    i18n.set('fallback', 'en')
+    result = i18n.t(tl_namespace)
+    if locale and locale.lower() not in ALPHA_2_LANGS:
+        raise localize.LocaleException("Invalid locale")
+    if result == tl_namespace:
+        raise localize.LocaleException("No translation in any locale")
+    return result
+
+
+def legacy_load_locales():
+    # what load_locales used to do: list and search the directory once per language
+    for directory in i18n.config.get('load_path'):
+        for locale in ALPHA_2_LANGS:
+            try:
+                i18n.resource_loader.load_directory(directory, locale)
+            except i18n.resource_loader.I18nFileLoadError:
+                pass
+
+
+def main(number=100_000, loads=20):
+    i18n.load_path.append(str(pathlib.Path(localize.__file__).parent / "locale"))
+    legacy = timeit.timeit(legacy_load_locales, number=loads) / loads
+    scanned = timeit.timeit(localize.load_locales, number=loads) / loads
+    with tempfile.TemporaryDirectory() as directory:
+        cache = pathlib.Path(directory) / "locale_cache.json"
+        localize.load_locales(cache)
+        cached = timeit.timeit(lambda: localize.load_locales(cache), number=loads) / loads
+    print(f"load_locales: legacy {legacy * 1e3:.1f}ms | scanned {scanned * 1e3:.1f}ms | cached {cached * 1e3:.1f}ms")
+
+    for key, locale in KEYS:
+        assert localize.tl(key, locale) == legacy_tl(key, locale)
+        legacy = timeit.timeit(lambda: legacy_tl(key, locale), number=number)
+        compiled = timeit.timeit(lambda: localize.tl(key, locale), number=number)
+        print(f"{key:>12} {locale or '-':>2}: legacy {number / legacy:>12,.0f} calls/s | "
+              f"compiled {number / compiled:>12,.0f} calls/s")
+
+
+if __name__ == "__main__":
+    main()
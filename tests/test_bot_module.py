@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+import slider
+
+from FruityBot.core_bot.bot_module import cache_key, cached, command
+from FruityBot.serializers import get_serializer
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append("get")
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.calls.append("set")
+        self.data[key] = value
+
+
+class FakeBot:
+    def __init__(self):
+        self.cache_redis = FakeRedis()
+        self.cache_serializer = get_serializer()
+        self.cache_version = 0
+
+
+class Beatmaps:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.fetches = 0
+
+    @cached(ttl=60)
+    def lookup(self, beatmap_id):
+        self.fetches += 1
+        time.sleep(0.05)
+        return {"beatmap_id": beatmap_id}
+
+
+def test_cached_tiers():
+    beatmaps = Beatmaps()
+    assert beatmaps.lookup(1514618) == {"beatmap_id": 1514618}
+    assert beatmaps.bot.cache_redis.calls == ["get", "set"]
+
+    # in-process hit, no redis round-trip
+    beatmaps.lookup(1514618)
+    assert beatmaps.bot.cache_redis.calls == ["get", "set"]
+
+    # another bot process only shares redis: a single GET
+    Beatmaps.lookup.local.clear()
+    other = Beatmaps()
+    other.bot.cache_redis = beatmaps.bot.cache_redis
+    assert other.lookup(1514618) == {"beatmap_id": 1514618}
+    assert other.bot.cache_redis.calls == ["get", "set", "get"]
+    assert other.fetches == 0
+
+
+def test_cached_version():
+    beatmaps = Beatmaps()
+    beatmaps.lookup(400761)
+    beatmaps.bot.cache_version += 1
+    beatmaps.lookup(400761)
+    assert beatmaps.fetches == 2
+
+
+@pytest.mark.parametrize("a, b", [
+    ((1514618, slider.GameMode.ctb), (1514618, 2)),
+    ({"acc": 99.5, "mods": 16}, {"mods": 16, "acc": 99.5}),
+])
+def test_cache_key_stable(a, b):
+    assert repr(cache_key(a)) == repr(cache_key(b))
+
+
+def test_cached_single_flight():
+    beatmaps = Beatmaps()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(beatmaps.lookup(871924))) for __ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert beatmaps.fetches == 1
+    assert results == [{"beatmap_id": 871924}] * 8
+
+
+def test_command_on_reactor():
+    @command
+    def np(self, e):
+        pass
+
+    @command(aliases=["r"])
+    async def recommend(self, e):
+        pass
+
+    assert np.cmd_on_reactor is False
+    assert recommend.cmd_on_reactor is True
+    assert recommend.cmd_aliases == ("recommend", "r")
@@ -0,0 +1,89 @@
+import json
+from types import SimpleNamespace
+
+import redis
+
+from FruityBot.core_bot import core
+from FruityBot.core_bot.core import CoreBot
+
+
+class FakeReactor:
+    def callInThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class Closable:
+    def __init__(self, calls, name):
+        self.calls, self.name = calls, name
+
+    def close(self):
+        self.calls.append(self.name)
+        if self.name == "broken":
+            raise RuntimeError("already closed")
+
+    stop = close
+
+
+def test_connection_lost_releases_bot(monkeypatch):
+    monkeypatch.setattr(core, "reactor", FakeReactor())
+    calls = []
+    bot = CoreBot.__new__(CoreBot)
+    bot.modules = {"Broken": (Closable(calls, "broken"), None), "Osu": (Closable(calls, "osu"), None)}
+    bot.outbound, bot.dispatcher = Closable(calls, "outbound"), Closable(calls, "dispatcher")
+
+    bot.connectionLost(None)
+    assert calls == ["broken", "osu", "outbound", "dispatcher"]
+
+
+class DownRedis:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get(self, key):
+        raise redis.ConnectionError("Connection refused")
+
+    incr = get
+
+
+def test_bump_cache_version_without_redis():
+    bot = CoreBot.__new__(CoreBot)
+    bot.cache_redis, bot.cache_version = DownRedis(), 3
+    bot.bump_cache_version()
+    assert bot.cache_version == 4
+    assert bot.get_cache_version() == 4
+
+
+def test_reload_closes_running_modules(monkeypatch):
+    from FruityBot.modules import admin
+
+    monkeypatch.setattr(admin, "reload_all", lambda package, depth: None)
+    monkeypatch.setattr(admin.importlib, "reload", lambda module: module)
+    calls = []
+    bot = CoreBot.__new__(CoreBot)
+    bot.Config = lambda: SimpleNamespace(main=SimpleNamespace(owner="de/odex"))
+    bot.msg = lambda nick, message: None
+    bot.bump_cache_version = lambda: None
+    bot.reload_init = lambda: bot.close_modules()
+    osu = Closable(calls, "osu")
+    bot.modules = {"Osu": (osu, None)}
+
+    admin.Admin({}, bot).reload(SimpleNamespace(source=SimpleNamespace(nick="de/odex")))
+    # the instance that was running, and only it
+    assert calls == ["osu"] and bot.modules["Osu"][0] is osu
+
+
+def test_reload_keeps_bumped_cache_version(monkeypatch, tmp_path):
+    (tmp_path / "config.json").write_text(json.dumps({"main": {
+        "nick": "FruityBot", "password": "", "prefix": "!", "modules": [], "owner": "de/odex", "server": "irc.ppy.sh"
+    }}))
+    monkeypatch.setattr(core.redis, "Redis", DownRedis)
+    bot = CoreBot.__new__(CoreBot)
+    bot.root_dir = tmp_path
+    bot.dispatcher = bot.outbound = SimpleNamespace(configure=lambda *args: None)
+    bot.reload_init()
+    assert bot.cache_version == 0
+
+    # what Admin.reload does, while redis is down
+    bot.bump_cache_version()
+    bot.reload_init()
+    assert bot.cache_version == 1
@@ -1,4 +1,5 @@
 import logging
+import queue
 from datetime import datetime
 
 from box import Box
@@ -37,9 +38,9 @@ def logger_obj(request):
     request.addfinalizer(logger_teardown)
 
 
-@pytest.fixture(scope='module')
-def database_obj(request):
-    print(f"setup_resource    resource:database")
+@pytest.fixture(scope='module', params=["sqlite", "mariadb"])
+def database_obj(request, tmp_path_factory):
+    print(f"setup_resource    resource:database ({request.param})")
 
     user_pref_table = """CREATE TABLE IF NOT EXISTS user_prefs(
                                    username VARCHAR(255) PRIMARY KEY,
@@ -47,7 +48,12 @@ def database_obj(request):
                                    mode TINYINT,
                                    locale TINYTEXT
                                  )"""
-    database_file = database.DatabaseFile('root', 'asterism', 'fruitybot_test')
+    if request.param == "sqlite":
+        backend = database.SQLiteBackend(tmp_path_factory.mktemp("database") / "fruitybot_test.db")
+    else:
+        pytest.importorskip("MySQLdb")
+        backend = database.MariaDBBackend('root', 'asterism', 'fruitybot_test')
+    database_file = database.DatabaseFile(backend)
     user_pref = database.UserPrefTable(database_file, "user_prefs", user_pref_table,
                                        ['1970-01-01 00:00:00', None, 'en'])
     user_pref.create()
@@ -76,10 +82,210 @@ def test_database_modify_set(database_obj):
 def test_database_contains_true(database_obj):
     assert ("de/odex" in database_obj) == True
 
+def test_database_deferred_update(database_obj):
+    database_obj.defer_update("de/odex", "last_command", datetime(2018, 8, 1, 12, 0))
+    # visible before the flush, in the database after it
+    assert database_obj["de/odex"].last_command == datetime(2018, 8, 1, 12, 0)
+    assert database_obj.flush() == 1
+    database_obj.cache.clear()
+    assert database_obj["de/odex"].last_command == datetime(2018, 8, 1, 12, 0)
+
+def test_database_many(database_obj):
+    database_obj.set_many({"de/odex": {"mode": 1}, "aEverr": {"mode": 2, "locale": "ja"}})
+    rows = database_obj.get_many(["de/odex", "aEverr", "nobody"])
+    assert set(rows) == {"de/odex", "aEverr"}
+    assert (rows["de/odex"].mode, rows["de/odex"].locale) == (1, "ja")
+    assert (rows["aEverr"].mode, rows["aEverr"].locale) == (2, "ja")
+    del database_obj["aEverr"]
+
 def test_database_delete(database_obj):
     del database_obj["de/odex"]
-    with pytest.raises(IndexError):
+    with pytest.raises(KeyError):
         database_obj["de/odex"]
 
 def test_database_contains_false(database_obj):
-    assert ("de/odex" in database_obj) == False
\ No newline at end of file
+    assert ("de/odex" in database_obj) == False
+
+def test_database_failed_flush_keeps_updates(database_obj, monkeypatch):
+    database_obj["Motion"] = {"mode": 2}
+    database_obj.defer_update("Motion", "last_command", datetime(2018, 8, 1, 12, 0))
+    database_obj.defer_update("Motion", "mode", 3)
+
+    def lost_connection(*args):
+        # and an update made while the flush runs
+        database_obj.defer_update("Motion", "mode", 1)
+        raise ConnectionError
+
+    with monkeypatch.context() as m:
+        m.setattr(database_obj, "_executemany", lost_connection)
+        with pytest.raises(ConnectionError):
+            database_obj.flush()
+    assert database_obj.pending == {"Motion": {"last_command": datetime(2018, 8, 1, 12, 0), "mode": 1}}
+    assert database_obj.flush() == 1
+    database_obj.cache.clear()
+    assert (database_obj["Motion"].last_command, database_obj["Motion"].mode) == (datetime(2018, 8, 1, 12, 0), 1)
+    del database_obj["Motion"]
+
+def test_database_write_supersedes_deferred(database_obj):
+    database_obj["Motion"] = {"mode": 2}
+    database_obj.defer_update("Motion", "mode", 3)
+    database_obj.defer_update("Motion", "last_command", datetime(2018, 8, 1, 12, 0))
+    database_obj.set_many({"Motion": {"mode": 1}})
+    # the deferred mode is older than set_many's; the deferred last_command still goes out
+    assert database_obj.pending == {"Motion": {"last_command": datetime(2018, 8, 1, 12, 0)}}
+    assert database_obj.flush() == 1
+    database_obj.cache.clear()
+    assert (database_obj["Motion"].last_command, database_obj["Motion"].mode) == (datetime(2018, 8, 1, 12, 0), 1)
+
+    database_obj.defer_update("Motion", "mode", 3)
+    database_obj.modify_row("Motion", "mode", 0)
+    assert not database_obj.pending
+    del database_obj["Motion"]
+
+def test_database_rows_not_shared(database_obj):
+    database_obj["Motion"] = {"mode": 2}
+    row, many = database_obj["Motion"], database_obj.get_many(["Motion"])["Motion"]
+    database_obj.defer_update("Motion", "mode", 3)
+    row.locale = "ja"
+    # what a caller holds doesn't change under it, and what it changes isn't cached
+    assert (row.mode, many.mode) == (2, 2)
+    assert (database_obj["Motion"].mode, database_obj["Motion"].locale) == (3, "en")
+    database_obj.flush()
+    del database_obj["Motion"]
+
+def test_database_lookup_during_write(database_obj, monkeypatch):
+    database_obj["Motion"] = {"mode": 2}
+    execute = database_obj._execute
+
+    def slow_select(cmd, args=tuple()):
+        rows = execute(cmd, args)
+        # another thread's write lands between the SELECT and filling the cache
+        monkeypatch.setattr(database_obj, "_execute", execute)
+        database_obj.modify_row("Motion", "mode", 3)
+        return rows
+
+    monkeypatch.setattr(database_obj, "_execute", slow_select)
+    assert database_obj["Motion"].mode == 2
+    assert database_obj["Motion"].mode == 3
+    del database_obj["Motion"]
+
+
+class FakeDriver:
+    """Stands in for MySQLdb; records statements and can fail a connection's next query."""
+
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    def __init__(self):
+        self.connections = []
+        self.statements = []
+
+    def connect(self, **kwargs):
+        conn = FakeConnection(self)
+        self.connections.append(conn)
+        return conn
+
+
+class FakeConnection:
+    def __init__(self, driver):
+        self.driver = driver
+        self.closed = False
+        self.fail_next = None
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+    def ping(self):
+        if self.closed:
+            raise self.driver.OperationalError(2006, "MySQL server has gone away")
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, cmd, args=None):
+        if self.conn.fail_next:
+            exc, self.conn.fail_next = self.conn.fail_next, None
+            raise exc
+        self.conn.driver.statements.append((cmd, args))
+
+    executemany = execute
+
+    def fetchall(self):
+        return ()
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_database():
+    backend = database.MariaDBBackend('root', 'asterism', 'fruitybot_test', driver=FakeDriver())
+    return database.DatabaseFile(backend, min_size=1, max_size=2)
+
+
+def test_pool_max_size(fake_database):
+    pool = fake_database.pool
+    conns = [pool.acquire(), pool.acquire()]
+    with pytest.raises(queue.Empty):
+        pool.acquire(timeout=0.01)
+    pool.release(conns[0])
+    assert pool.acquire(timeout=0.01) is conns[0]
+
+
+def test_pool_reconnect(fake_database):
+    conn = fake_database.pool.acquire()
+    conn.fail_next = fake_database.backend.driver.OperationalError(2006, "MySQL server has gone away")
+    fake_database.pool.release(conn)
+
+    fake_database.execute("SELECT 1")
+    assert conn.closed
+    assert fake_database.backend.driver.statements[-1] == ("SELECT 1", None)
+
+
+def test_pool_transaction(fake_database):
+    with fake_database.transaction():
+        fake_database.execute("INSERT 1")
+        fake_database.execute("INSERT 2")
+    conn = fake_database.pool.acquire()
+    assert conn.commits == 1
+
+    fake_database.pool.release(conn)
+    with pytest.raises(ValueError):
+        with fake_database.transaction():
+            fake_database.execute("INSERT 3")
+            raise ValueError
+    assert conn.rollbacks == 1
+
+
+def test_pool_reconnect_fails(fake_database):
+    driver = fake_database.backend.driver
+    gone_away = driver.OperationalError(2006, "MySQL server has gone away")
+    conn = fake_database.pool.acquire()
+    conn.fail_next = gone_away
+    fake_database.pool.release(conn)
+
+    def still_down(**kwargs):
+        raise driver.OperationalError(2003, "Can't connect to MySQL server")
+
+    driver.connect = still_down
+    # the dead connection is discarded once, and the error reconnecting is what's raised
+    with pytest.raises(FakeDriver.OperationalError, match="Can't connect"):
+        fake_database.execute("SELECT 1")
+    assert fake_database.pool.size == 0
+    assert conn.closed and conn.rollbacks == 0
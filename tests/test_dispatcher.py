@@ -0,0 +1,89 @@
+import pytest
+from twisted.internet import defer
+
+from FruityBot.core_bot.dispatcher import CommandDispatcher, QueueFull
+
+
+class FakeReactor:
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class FakePool:
+    """Holds work until run() is called, so tests decide when "threads" finish."""
+
+    def __init__(self):
+        self.work = []
+
+    def callInThreadWithCallback(self, on_result, f, *args, **kwargs):
+        self.work.append((on_result, f, args, kwargs))
+
+    def run(self, index=0):
+        on_result, f, args, kwargs = self.work.pop(index)
+        try:
+            on_result(True, f(*args, **kwargs))
+        except Exception as exc:
+            on_result(False, exc)
+
+
+@pytest.fixture
+def dispatcher():
+    return CommandDispatcher(max_queue=3, pool=FakePool(), reactor=FakeReactor())
+
+
+def test_dispatcher_user_order(dispatcher):
+    ran = []
+    for i in range(3):
+        dispatcher.submit("de/odex", dispatcher.defer_to_pool, ran.append, i)
+
+    # only one job per user may be in flight
+    assert len(dispatcher.pool.work) == 1
+    while dispatcher.pool.work:
+        dispatcher.pool.run()
+    assert ran == [0, 1, 2]
+    assert dispatcher.pending("de/odex") == 0
+
+
+def test_dispatcher_users_share_pool(dispatcher):
+    ran = []
+    dispatcher.submit("de/odex", dispatcher.defer_to_pool, ran.append, "a")
+    dispatcher.submit("aEverr", dispatcher.defer_to_pool, ran.append, "b")
+    assert len(dispatcher.pool.work) == 2
+
+    dispatcher.pool.run(1)
+    assert ran == ["b"]
+
+
+def test_dispatcher_queue_full(dispatcher):
+    for i in range(3):
+        dispatcher.submit("de/odex", dispatcher.defer_to_pool, lambda: None)
+    with pytest.raises(QueueFull):
+        dispatcher.submit("de/odex", dispatcher.defer_to_pool, lambda: None)
+
+    dispatcher.pool.run()
+    dispatcher.submit("de/odex", dispatcher.defer_to_pool, lambda: None)
+
+
+def test_dispatcher_result(dispatcher):
+    results = []
+    dispatcher.submit("de/odex", dispatcher.defer_to_pool, lambda: 5).addCallback(results.append)
+    dispatcher.submit("de/odex", dispatcher.defer_to_pool, lambda: 1 / 0).addErrback(lambda f: results.append(f.type))
+    dispatcher.pool.run()
+    dispatcher.pool.run()
+    assert results == [5, ZeroDivisionError]
+
+
+def test_dispatcher_reactor_jobs(dispatcher):
+    results = []
+
+    async def job():
+        return 3 * 2
+
+    d = defer.Deferred()
+    dispatcher.submit("de/odex", lambda: d)
+    dispatcher.submit("de/odex", job).addCallback(results.append)
+    # the coroutine waits behind the unfinished Deferred
+    assert results == []
+    d.callback(None)
+    assert results == [6]
+    assert dispatcher.pool.work == []
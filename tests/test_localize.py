@@ -0,0 +1,61 @@
+import os
+import pathlib
+
+import i18n
+import pytest
+
+from FruityBot import localize
+from FruityBot.localize import LocaleException, get_locales, tl
+
+LOCALE_DIR = str(pathlib.Path(localize.__file__).parent / "locale")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def locales():
+    if LOCALE_DIR not in i18n.load_path:
+        i18n.load_path.append(LOCALE_DIR)
+    localize.load_locales()
+
+
+def test_tl():
+    assert tl("osu.no_np", "en") == "You haven't /np'd me anything yet!"
+    # format templates are left to the caller
+    assert tl("set.setting", None) == 'Setting "{}" was successfully set to "{}"!'
+    assert "en" in get_locales()
+
+
+def test_tl_fallback():
+    # a real language without its own translations gets English
+    assert tl("osu.no_np", "fr") == tl("osu.no_np", "en")
+    with pytest.raises(LocaleException, match="Invalid locale"):
+        tl("osu.no_np", "xx")
+    with pytest.raises(LocaleException, match="No translation"):
+        tl("osu.does_not_exist", "en")
+
+
+def test_load_locales_cache(tmp_path, monkeypatch):
+    locale_file = tmp_path / "osu.en.yml"
+    locale_file.write_text("en:\n  no_np: Nothing /np'd.\n  error:\n    miss: 100%% sure\n")
+    (tmp_path / "notes.txt").write_text("not a locale file")
+    monkeypatch.setitem(i18n.config.settings, "load_path", [str(tmp_path)])
+    # put the real translations back afterwards
+    monkeypatch.setattr(localize, "translations", localize.translations)
+    monkeypatch.setattr(localize, "locales", localize.locales)
+    cache = tmp_path / "locale_cache.json"
+
+    localize.load_locales(cache)
+    assert tl("osu.error.miss", "en") == "100% sure"
+    assert get_locales() == ["en"]
+
+    # reused while the files stay the same
+    with monkeypatch.context() as m:
+        m.setattr(localize, "compile_translations", None)
+        localize.load_locales(cache)
+    assert tl("osu.no_np", "en") == "Nothing /np'd."
+
+    locale_file.write_text("en:\n  no_np: Still nothing.\n")
+    os.utime(locale_file, ns=(0, 0))
+    localize.load_locales(cache)
+    assert tl("osu.no_np", "en") == "Still nothing."
+    with pytest.raises(LocaleException):
+        tl("osu.error.miss", "en")
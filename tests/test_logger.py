@@ -0,0 +1,28 @@
+import logging
+
+from FruityBot.logger import ColorFormatter, start_queue
+
+
+def test_color_formatter():
+    formatter = ColorFormatter("$BGCOLOR$COLOR %(levelname)s $RESET$BGRED$RED%(message)s")
+    record = logging.LogRecord("test", logging.ERROR, __file__, 1, "lost %s", ("connection",), None)
+    color, bg_color = ColorFormatter.COLORS["ERROR"]
+    assert formatter.format(record) == (bg_color + color + " ERROR " + ColorFormatter.Style.RESET_ALL +
+                                        "\033[1;41m\033[1;31mlost connection" + ColorFormatter.Style.RESET_ALL)
+
+
+def test_start_queue():
+    records = []
+    handler = logging.Handler(logging.INFO)
+    handler.emit = lambda record: records.append(record.getMessage())
+    logger = logging.getLogger("test_start_queue")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    listener = start_queue(logger)
+    logger.debug("dropped by the handler's level")
+    logger.info("lost %s", "connection")
+    listener.stop()
+
+    assert handler not in logger.handlers
+    assert records == ["lost connection"]
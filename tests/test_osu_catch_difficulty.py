@@ -0,0 +1,89 @@
+import pathlib
+
+import pytest
+import slider
+
+from FruityBot.modules import osu_catch_difficulty
+from FruityBot.modules.osu import Osu
+from FruityBot.modules.osu_catch_difficulty import CatchDifficulty, CatchObjects, LegacyRandom, difficulty
+from FruityBot.modules.osu_summary import BeatmapSummary
+
+# generated with benchmarks.bench_catch_difficulty.generate(400, seed=1, beatmap_id=1, circle_size=4.2,
+# approach_rate=8.5)
+BEATMAP = slider.Beatmap.from_path(pathlib.Path(__file__).parent / "fixtures" / "catch.osu")
+SUMMARY = BeatmapSummary(1, None, slider.GameMode.ctb, slider.GameMode.ctb, 3.0916, 8.5, 8.0, 400, 400, 241, 60, 0,
+                         "FruityBot - generated [400 objects]")
+
+
+@pytest.mark.parametrize("mods, star_rating, approach_rate", [
+    (0, 3.0916120324241545, 8.5),
+    (slider.Mod.double_time, 4.121413228883143, 10.),
+    (slider.Mod.half_time, 2.5937678058456113, 7.),
+    (slider.Mod.hard_rock, 3.8670422437553538, 10.),
+    (slider.Mod.easy, 2.6649310835012567, 4.25),
+    (slider.Mod.hard_rock | slider.Mod.double_time, 5.140429432379078, 11.),
+])
+def test_catch_difficulty(mods, star_rating, approach_rate):
+    result = CatchDifficulty(BEATMAP, mods)
+    assert result.star_rating == pytest.approx(star_rating, rel=1e-9)
+    assert result.approach_rate == pytest.approx(approach_rate)
+    assert result.max_combo == 400
+
+
+# Three fruits, x 100 -> 300 -> 100 every 500ms at CS5, worked through by hand from osu!lazer's catch calculator.
+# - 200px in 500ms is no hyperdash (349px to spare), no edge dash, and too far for HR to move the fruits.
+# - Positions are scaled by 41 / 42.7 (fruit radius / half catch width): 96.02, 288.06, 96.02. The catcher stops
+#   25 short of each fruit, so it moves 167.04, then -142.04.
+# - Weighted strain time is 500 + 13 + 3 = 516. Movement: 167.04^1.3 / 510 = 1.5209 and 142.04^1.3 / 510 = 1.2318,
+#   plus 12.5 * 82 / 246 / sqrt(516) = 0.1834 each, plus a direction change of 21 / sqrt(516) * (1 - 0.516^3)
+#   = 0.7975 on the second. Divided by 516, times 900: 2.9726 and 3.8594.
+# - Strains start at 1 and decay by 0.2^0.5 between objects: 3.4198, then 5.3888, in consecutive 750ms sections.
+#   Stars are sqrt(5.3888 + 0.94 * 3.4198) * 0.153.
+# - DT runs the same steps on 333.33ms gaps (weighted 348.33). Both objects then fall in one section, so stars are
+#   sqrt(9.5172) * 0.153. HR is CS 6.5 and EZ CS 2.5, which only change the catch width.
+THREE_FRUITS = slider.Beatmap.from_path(pathlib.Path(__file__).parent / "fixtures" / "catch_three_fruits.osu")
+
+
+@pytest.mark.parametrize("mods, star_rating", [
+    (0, 0.44877276685548184),
+    (slider.Mod.double_time, 0.4720032617507116),
+    (slider.Mod.hard_rock, 0.5309814652991313),
+    (slider.Mod.easy, 0.38475219713551284),
+])
+def test_catch_difficulty_reference(mods, star_rating):
+    assert CatchDifficulty(THREE_FRUITS, mods).star_rating == pytest.approx(star_rating, rel=1e-9)
+
+
+def test_catch_objects():
+    objects = CatchObjects(BEATMAP)
+    x, time, fruit = objects.positions()
+    assert len(x) == len(time) == len(fruit) == len(objects) == 400
+    assert (time[1:] >= time[:-1]).all()
+    assert ((0 <= x) & (x <= 512)).all()
+
+    hard_rock_x, hard_rock_time, hard_rock_fruit = objects.positions(hard_rock=True)
+    assert (hard_rock_time == time).all() and (hard_rock_fruit == fruit).all()
+    # only fruits that aren't part of a juice stream move
+    assert (hard_rock_x != x).any()
+    assert (hard_rock_x[~fruit] == x[~fruit]).all()
+
+
+def test_legacy_random():
+    rng = LegacyRandom(1337)
+    assert [rng.next_uint() for __ in range(3)] == [274941776, 2661595948, 3085529888]
+
+
+def test_difficulty_memoized(monkeypatch):
+    monkeypatch.setattr(osu_catch_difficulty, "_difficulties", osu_catch_difficulty.LRUCache(4))
+    monkeypatch.setattr(osu_catch_difficulty, "_objects", osu_catch_difficulty.LRUCache(4))
+    nomod = difficulty(BEATMAP, 0)
+    # mods that don't change the star rating share its entry
+    assert difficulty(BEATMAP, slider.Mod.hidden | slider.Mod.flashlight) is nomod
+    assert difficulty(BEATMAP, slider.Mod.double_time).star_rating > nomod.star_rating
+    assert len(osu_catch_difficulty._objects) == 1
+
+
+def test_catch_pp_with_mods():
+    assert Osu.calculate_pp(SUMMARY, mods=slider.Mod.double_time, beatmap_data=BEATMAP) > Osu.calculate_pp(SUMMARY)
+    with pytest.raises(ValueError):
+        Osu.calculate_pp(SUMMARY, mods=slider.Mod.hard_rock)
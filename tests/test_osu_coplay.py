@@ -0,0 +1,112 @@
+import random
+
+import numpy
+import pytest
+
+from FruityBot.modules.osu_coplay import CoPlayIndex, band
+
+CTB = 2
+
+
+def players(seed=0, count=200):
+    """Players with 30 passes each, mostly on a few popular maps, all within 230-280pp."""
+    rng = random.Random(seed)
+    maps = list(range(1000, 1300))
+    weights = [1 / (i + 1) for i in range(len(maps))]
+    result = {}
+    for user_id in range(1, count + 1):
+        beatmap_ids = set()
+        while len(beatmap_ids) < 30:
+            beatmap_ids.add(rng.choices(maps, weights)[0])
+        result[user_id] = [(beatmap_id, rng.uniform(230, 280)) for beatmap_id in sorted(beatmap_ids)]
+    return result
+
+
+def brute_force(scores, played, pp):
+    """Players who passed both a played map and each other map in pp's band, summed over played maps."""
+    counts = {}
+    for user_scores in scores.values():
+        in_band = {beatmap_id for beatmap_id, score_pp in user_scores if band(score_pp) == band(pp)}
+        for beatmap_id in in_band - set(played):
+            counts[beatmap_id] = counts.get(beatmap_id, 0) + len(in_band & set(played))
+    return {beatmap_id: count for beatmap_id, count in counts.items() if count}
+
+
+@pytest.fixture
+def scores():
+    return players()
+
+
+def test_band():
+    assert list(band(numpy.array([0, 49.9, 50, 62.5, 250]))) == [0, 0, 0, 1, 7]
+
+
+def test_coplay_query(scores):
+    index = CoPlayIndex()
+    for user_id, user_scores in scores.items():
+        index.add_user(user_id, CTB, user_scores)
+
+    played = [1000, 1001, 1005]
+    result = index.query(played, CTB, 240, k=20)
+    expected = brute_force(scores, played, 240)
+    assert len(result) == 20
+    assert not set(played) & set(result)
+    assert all(expected[beatmap_id] == count for beatmap_id, count in result.items())
+    assert list(result.values()) == sorted(expected.values(), reverse=True)[:20]
+
+    assert index.query(played, CTB, 1000) == {}
+    assert index.query([1], CTB, 240) == {}
+
+
+def test_coplay_incremental(scores):
+    index = CoPlayIndex()
+    for user_id, user_scores in scores.items():
+        index.add_user(user_id, CTB, user_scores)
+    index.query([1000], CTB, 240)
+
+    # players improve and new maps show up between queries
+    updated = players(seed=1, count=50)
+    updated[201] = [(2000, 250.), (2001, 250.), (1000, 250.)]
+    for user_id, user_scores in updated.items():
+        index.add_user(user_id, CTB, user_scores)
+        scores[user_id] = user_scores
+
+    rebuilt = CoPlayIndex()
+    rebuilt.users, rebuilt.beatmap_ids, rebuilt.positions = index.users, index.beatmap_ids, index.positions
+    rebuilt.build()
+    for played in ([1000], [1003, 1010], [2000]):
+        assert index.query(played, CTB, 240) == rebuilt.query(played, CTB, 240) == \
+            dict(sorted(brute_force(scores, played, 240).items(), key=lambda item: (-item[1], item[0]))[:200])
+
+
+def test_coplay_save(scores, tmp_path):
+    index = CoPlayIndex(tmp_path)
+    for user_id, user_scores in scores.items():
+        index.add_user(user_id, CTB, user_scores)
+    index.save()
+    assert not index.dirty
+
+    reopened = CoPlayIndex.open(tmp_path)
+    assert len(reopened) == len(index)
+    assert reopened.query([1000, 1002], CTB, 250) == index.query([1000, 1002], CTB, 250)
+    reopened.build()
+    assert reopened.query([1000, 1002], CTB, 250) == index.query([1000, 1002], CTB, 250)
+
+
+def test_coplay_new_maps_in_another_band(tmp_path):
+    index = CoPlayIndex(tmp_path)
+    index.add_user(1, CTB, [(1000, 100.), (1001, 100.), (1002, 100.)])
+    index.add_user(2, CTB, [(1000, 100.), (1002, 100.)])
+    index.query([1000], CTB, 100)
+
+    # maps first seen in a band whose matrix doesn't change
+    index.add_user(3, CTB, [(2000, 250.), (2001, 250.), (1000, 250.)])
+    assert index.query([1000, 2000], CTB, 100) == {1002: 2, 1001: 1}
+    assert index.query([2000], CTB, 250) == {1000: 1, 2001: 1}
+    index.save()
+
+    reopened = CoPlayIndex.open(tmp_path)
+    for played, pp in (([1000, 2000], 100), ([2000], 250)):
+        assert reopened.query(played, CTB, pp) == index.query(played, CTB, pp)
+    reopened.add_user(4, CTB, [(3000, 100.), (1001, 100.)])
+    assert reopened.query([3000, 2001], CTB, 100) == {1001: 1}
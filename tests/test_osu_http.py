@@ -0,0 +1,162 @@
+import gzip
+import json
+import pathlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import slider
+
+from FruityBot.modules.osu_http import BeatmapDownloader, SessionClient, SessionLibrary, create_session
+from FruityBot.modules.osu_library import BeatmapCache
+
+CATCH = (pathlib.Path(__file__).parent / "fixtures" / "catch.osu").read_bytes()
+
+
+class StubServer(ThreadingHTTPServer):
+    """Serves /osu/<id> with an ETag and an empty /api/<endpoint>, counting connections and requests."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.connections = 0
+        self.requests = []  # (path, headers)
+        self.beatmaps = {}  # id: (etag, data)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers))
+        if self.path.startswith("/api/"):
+            data = json.dumps([]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        beatmap = self.server.beatmaps.get(self.path.rsplit("/", 1)[-1])
+        if beatmap is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag, data = beatmap
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    server.beatmaps["1"] = ('"v1"', CATCH)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(server, tmp_path):
+    host, port = server.server_address
+    return BeatmapDownloader(create_session(), tmp_path / "validators.json", download_url=f"http://{host}:{port}/osu")
+
+
+def test_keep_alive_and_gzip(server, downloader):
+    for __ in range(5):
+        assert downloader.fetch(1) == CATCH
+    assert server.connections == 1
+    assert all(headers["Accept-Encoding"] == "gzip" for __, headers in server.requests)
+
+
+def test_slider_through_session(server, tmp_path):
+    host, port = server.server_address
+    session = create_session()
+    library = SessionLibrary(tmp_path, download_url=f"http://{host}:{port}/osu", session=session)
+    client = SessionClient(library, "key", f"http://{host}:{port}/api", session=session)
+    assert client.user_best(user_name="de/odex") == []
+    assert client.copy().beatmap(beatmap_set_id=1) == []
+    assert library.copy().download(1).version == slider.Beatmap.parse(CATCH.decode()).version
+    assert [path.split("?")[0] for path, __ in server.requests] == ["/api/get_user_best", "/api/get_beatmaps", "/osu/1"]
+    # the copies share the session, so everything went over one connection
+    assert server.connections == 1
+
+
+def test_revalidate(server, downloader, tmp_path):
+    downloader.fetch(1)
+    assert downloader.fetch(1, revalidate=True) is None
+    assert server.requests[-1][1]["If-None-Match"] == '"v1"'
+
+    # validators survive a restart
+    downloader.save()
+    downloader = BeatmapDownloader(downloader.session, tmp_path / "validators.json",
+                                   download_url=downloader.download_url)
+    assert not downloader.stale(1)
+    server.beatmaps["1"] = ('"v2"', CATCH.replace(b"Version:", b"Version:New "))
+    assert downloader.fetch(1, revalidate=True) != CATCH
+
+
+def test_validators_batched(server, downloader, tmp_path):
+    # not written on every fetch, but once save_interval has passed or on save
+    for __ in range(3):
+        downloader.fetch(1)
+    assert downloader.dirty and not (tmp_path / "validators.json").exists()
+    downloader.save()
+    assert not downloader.dirty
+    assert BeatmapDownloader(downloader.session, tmp_path / "validators.json").validators["1"]["etag"] == '"v1"'
+
+    downloader.save_interval = 0
+    server.beatmaps["1"] = ('"v2"', CATCH)
+    downloader.fetch(1)
+    assert not downloader.dirty
+    assert BeatmapDownloader(downloader.session, tmp_path / "validators.json").validators["1"]["etag"] == '"v2"'
+
+
+def test_beatmap_cache(server, downloader, tmp_path):
+    library_dir = tmp_path / "osulib"
+    library_dir.mkdir()
+    slider.library.Library.create_db(library_dir)
+    cache = BeatmapCache(library_dir, downloader=downloader)
+    assert cache.get(1).version == slider.Beatmap.parse(CATCH.decode()).version
+    assert len(server.requests) == 1
+
+    # on disk and fresh: no request
+    cache.clear()
+    cache.get(1)
+    assert len(server.requests) == 1
+
+    # stale and unchanged: a 304, and the same map
+    downloader.revalidate_after = 0
+    cache.clear()
+    version = cache.get(1).version
+    assert len(server.requests) == 2 and cache.get(1).version == version
+
+    # stale and updated: replaced
+    server.beatmaps["1"] = ('"v2"', CATCH.replace(b"Version:", b"Version:New "))
+    cache.clear()
+    assert cache.get(1).version == "New " + version
+    assert cache.library.lookup_by_id(1).version == "New " + version
+    # the version is in the file name, so the old file is gone
+    assert [path.name for path in library_dir.glob("*.osu")] == list(cache.library.paths(1))
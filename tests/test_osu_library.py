@@ -0,0 +1,82 @@
+import threading
+import time
+
+from FruityBot.modules.osu_library import BeatmapCache
+
+
+class FakeLibrary:
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.lookups = 0
+
+    def lookup_by_id(self, beatmap_id, *, download=False, save=False):
+        assert threading.current_thread() is self.thread
+        self.lookups += 1
+        return {"beatmap_id": beatmap_id}
+
+
+class FakeBeatmapCache(BeatmapCache):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.libraries = []
+
+    def open_library(self):
+        library = FakeLibrary()
+        self.libraries.append(library)
+        return library
+
+
+def test_beatmap_cache(tmp_path):
+    cache = FakeBeatmapCache(tmp_path, maxsize=2)
+    assert cache.get("1514618") == {"beatmap_id": 1514618}
+    assert cache.get(1514618) is cache.get(1514618)
+    assert cache.library.lookups == 1
+
+    cache.get(871924)
+    cache.get(939698)
+    cache.get(1514618)  # evicted
+    assert cache.library.lookups == 4
+    assert len(cache.libraries) == 1
+
+
+def test_beatmap_cache_threads(tmp_path):
+    cache = FakeBeatmapCache(tmp_path)
+    threads = [threading.Thread(target=cache.get, args=(beatmap_id,)) for beatmap_id in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # a handle per thread, each used only from its own
+    assert len(cache.libraries) == 4
+    assert len(cache.beatmaps) == 4
+
+
+class SlowLibrary(FakeLibrary):
+    lookups = 0
+
+    def lookup_by_id(self, beatmap_id, *, download=False, save=False):
+        SlowLibrary.lookups += 1
+        time.sleep(.1)
+        return {"beatmap_id": beatmap_id}
+
+
+def test_beatmap_cache_single_flight(tmp_path):
+    cache = BeatmapCache(tmp_path)
+    cache.open_library = SlowLibrary
+    barrier = threading.Barrier(8)
+    results = []
+
+    def get():
+        barrier.wait()
+        results.append(cache.get(1514618))
+
+    threads = [threading.Thread(target=get) for __ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # one download and save, shared by every thread
+    assert SlowLibrary.lookups == 1
+    assert len(results) == 8 and all(result is results[0] for result in results)
@@ -0,0 +1,109 @@
+from twisted.internet import defer, task
+
+from FruityBot.modules.osu_limiter import BACKGROUND, INTERACTIVE, PriorityLimiter, RedisTokenBucket, TokenBucket
+
+
+def limiter(rate=1., capacity=2):
+    clock = task.Clock()
+    return PriorityLimiter(TokenBucket(rate, capacity, clock=clock.seconds), reactor=clock), clock
+
+
+def test_token_bucket():
+    clock = task.Clock()
+    bucket = TokenBucket(2., 2, clock=clock.seconds)
+    assert bucket.take() == bucket.take() == 0
+    assert bucket.take() == 0.5
+    clock.advance(0.5)
+    assert bucket.take() == 0
+    clock.advance(10)
+    # saves up no more than capacity
+    assert [bucket.take() for __ in range(3)] == [0, 0, 0.5]
+
+
+def test_limiter_priority():
+    limits, clock = limiter()
+    granted = []
+    for i in range(4):
+        limits.acquire(BACKGROUND).addCallback(lambda __, i=i: granted.append(f"background {i}"))
+    # the burst goes out straight away
+    assert granted == ["background 0", "background 1"]
+
+    limits.acquire(INTERACTIVE).addCallback(lambda __: granted.append("interactive"))
+    clock.advance(1)
+    # jumps the background queue
+    assert granted[2:] == ["interactive"]
+    clock.advance(1)
+    clock.advance(1)
+    assert granted[3:] == ["background 2", "background 3"]
+    assert not clock.getDelayedCalls()
+
+
+def test_limiter_metrics():
+    limits, clock = limiter()
+    for __ in range(4):
+        limits.acquire(BACKGROUND)
+    limits.acquire(INTERACTIVE)
+    assert limits.metrics()["queued"] == 3
+    for __ in range(3):
+        clock.advance(1)
+
+    metrics = limits.metrics()
+    assert metrics["queued"] == 0
+    assert metrics[INTERACTIVE] == {"count": 1, "p50": 1., "p99": 1., "max": 1.}
+    assert metrics[BACKGROUND]["count"] == 4
+    assert metrics[BACKGROUND]["max"] == 3.
+
+
+class DeferredBucket:
+    """A TokenBucket answering later, like RedisTokenBucket does."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.takes = []
+
+    def take(self):
+        d = defer.Deferred()
+        self.takes.append(d)
+        return d
+
+    def answer(self):
+        self.takes.pop(0).callback(self.bucket.take())
+
+
+def test_limiter_deferred_bucket():
+    clock = task.Clock()
+    bucket = DeferredBucket(TokenBucket(1., 1, clock=clock.seconds))
+    limits = PriorityLimiter(bucket, reactor=clock)
+    granted = []
+    for i in range(3):
+        limits.acquire(BACKGROUND).addCallback(lambda __, i=i: granted.append(i))
+    # acquire returns straight away and only one take is in flight
+    assert granted == [] and len(bucket.takes) == 1
+    bucket.answer()
+    assert granted == [0] and len(bucket.takes) == 1
+    bucket.answer()
+    assert granted == [0] and not bucket.takes
+    clock.advance(1)
+    bucket.answer()
+    assert granted == [0, 1]
+
+    # a failed take is retried
+    bucket.takes.pop(0).errback(ConnectionError("redis is down"))
+    assert not bucket.takes
+    clock.advance(PriorityLimiter.RETRY)
+    clock.advance(1)
+    bucket.answer()
+    assert granted == [0, 1, 2]
+
+
+def test_redis_bucket_off_the_reactor():
+    calls = []
+
+    class FakeRedis:
+        def register_script(self, script):
+            return lambda keys, args: calls.append(keys) or "0.5"
+
+    bucket = RedisTokenBucket(FakeRedis(), "bucket", 1., 2, defer_to_thread=defer.maybeDeferred)
+    result = []
+    bucket.take().addCallback(result.append)
+    assert result == [0.5] and calls == [["bucket"]]
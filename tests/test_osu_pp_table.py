@@ -0,0 +1,44 @@
+import slider
+
+from FruityBot.modules.osu import Osu
+from FruityBot.modules.osu_pp_table import PPTables, mod_sets
+from FruityBot.modules.osu_summary import BeatmapSummary
+
+CATCH = BeatmapSummary(1514618, 457332, slider.GameMode.ctb, slider.GameMode.ctb, 7.1382, 9.0, 9.0, 3927, 1604,
+                       1604, 238, 0, "Camellia - Exit This Earth's Atomosphere [Overdose]")
+TAIKO = BeatmapSummary(871924, 400761, slider.GameMode.taiko, slider.GameMode.taiko, 6.2811, 10.0, 6.0, None, 641,
+                       641, 190, 0, "xi - Blue Zenith [Oni]")
+
+
+def test_mod_sets():
+    assert mod_sets(slider.GameMode.ctb) == (0, slider.Mod.hidden, slider.Mod.flashlight,
+                                             slider.Mod.hidden | slider.Mod.flashlight)
+    assert len(mod_sets(slider.GameMode.taiko)) == 24  # no EZ with HR
+
+
+def test_pp_table(tmp_path):
+    PPTables(tmp_path).build([CATCH, TAIKO], Osu.calculate_pp_batch)
+    tables = PPTables(tmp_path)  # reopened from disk
+
+    # on the grid
+    assert tables.lookup(CATCH, acc=.99) == Osu.calculate_pp_batch(CATCH, acc=[.99])[0]
+    assert tables.lookup(TAIKO, mods=slider.Mod.hidden, acc=1.) == \
+        Osu.calculate_pp_batch(TAIKO, mods=slider.Mod.hidden, acc=[1.])[0]
+    # between grid points
+    assert abs(tables.lookup(CATCH, acc=.9935, player_combo=3927) - Osu.calculate_pp(CATCH, acc=.9935)) < 0.01
+
+    # not covered: plays with misses or combo breaks, DT, maps not in (or changed since) the table
+    assert tables.lookup(CATCH, acc=.99, miss=1) is None
+    assert tables.lookup(CATCH, acc=.99, player_combo=3000) is None
+    assert tables.lookup(CATCH, acc=.99, mods=slider.Mod.double_time) is None
+    assert tables.lookup(CATCH, acc=.5) is None
+    for attribute, change in (("star_rating", 1), ("approach_rate", -1), ("max_combo", 10), ("object_count", 10)):
+        value = getattr(CATCH, attribute)
+        setattr(CATCH, attribute, value + change)
+        try:
+            assert tables.lookup(CATCH, acc=.99) is None
+        finally:
+            setattr(CATCH, attribute, value)
+    # refetched, unchanged
+    CATCH.fetched += 60
+    assert tables.lookup(CATCH, acc=.99) is not None
@@ -0,0 +1,128 @@
+import json
+import pathlib
+from collections import Counter, OrderedDict
+from types import SimpleNamespace
+
+import pytest
+from twisted.internet import defer
+
+from FruityBot.modules.osu_recommend import Recommender, ScoreStore, refine
+
+# a recorded top play set with the beatmap_best/user_best responses it leads to, and the ranking
+# Osu._recommend made from them
+FIXTURE = json.loads((pathlib.Path(__file__).parent / "fixtures" / "recommend.json").read_text())
+TOP_PLAYS = [SimpleNamespace(beatmap_id=beatmap_id, pp=pp) for beatmap_id, pp in FIXTURE["top_plays"]]
+
+
+class FakeReactor:
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class FakePool:
+    def __init__(self):
+        self.work = []
+
+    def callInThreadWithCallback(self, on_result, f, *args, **kwargs):
+        self.work.append((on_result, f, args, kwargs))
+
+    def run(self):
+        on_result, f, args, kwargs = self.work.pop(0)
+        try:
+            on_result(True, f(*args, **kwargs))
+        except Exception as exc:
+            on_result(False, exc)
+
+    def run_all(self):
+        while self.work:
+            self.run()
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = Counter()
+
+    def copy(self):
+        return self
+
+    def beatmap_best(self, beatmap_id, game_mode):
+        self.calls["beatmap_best", beatmap_id] += 1
+        return [SimpleNamespace(beatmap_id=beatmap_id, user_id=user_id, pp=pp, rank=rank)
+                for user_id, pp, rank in FIXTURE["beatmap_best"][str(beatmap_id)]]
+
+    def user_best(self, user_id, game_mode):
+        self.calls["user_best", user_id] += 1
+        return [SimpleNamespace(beatmap_id=beatmap_id, user_id=user_id, pp=pp, rank=rank)
+                for beatmap_id, pp, rank in FIXTURE["user_best"][str(user_id)]]
+
+
+@pytest.fixture
+def recommender():
+    return Recommender(ScoreStore(FakeClient()), pool=FakePool(), reactor=FakeReactor())
+
+
+def test_recommend_ranking(recommender):
+    progress = []
+    job = recommender.recommend(TOP_PLAYS, FIXTURE["mode"], progress=lambda *args: progress.append(args))
+    results = []
+    job.deferred.addCallback(results.append)
+    recommender.pool.run_all()
+
+    assert list(results[0].items()) == [tuple(item) for item in FIXTURE["ranking"]]
+    assert progress[-1] == (20, 20)
+    # every map and player was fetched once, however many top plays they came up in
+    assert max(recommender.store.client.calls.values()) == 1
+
+
+def test_recommend_shared_store(recommender):
+    recommender.recommend(TOP_PLAYS, FIXTURE["mode"])
+    recommender.pool.run_all()
+    fetches = sum(recommender.store.client.calls.values())
+    # players come up under several of the user's own top plays too
+    assert recommender.store.hit_rate() > .5
+
+    # another user with overlapping top plays
+    recommender.recommend(TOP_PLAYS[5:] + TOP_PLAYS[:2], FIXTURE["mode"])
+    recommender.pool.run_all()
+    assert sum(recommender.store.client.calls.values()) == fetches
+    assert recommender.store.stats["misses"] == fetches
+
+
+def test_recommend_cancel(recommender):
+    job = recommender.recommend(TOP_PLAYS, FIXTURE["mode"])
+    results = []
+    job.deferred.addErrback(results.append)
+    recommender.pool.run()
+    job.cancel()
+    recommender.pool.run_all()
+
+    assert results[0].check(defer.CancelledError)
+    # the top plays that hadn't started made no API calls
+    assert sum(recommender.store.client.calls.values()) <= 21
+
+
+def test_recommend_partial(recommender):
+    partials = []
+    job = recommender.recommend(TOP_PLAYS, FIXTURE["mode"], first_after=5,
+                                partial=lambda ranking, finished, total: partials.append((finished, ranking)))
+    results = []
+    job.deferred.addCallback(results.append)
+    for __ in range(5):
+        recommender.pool.run()
+    # the first recommendation only waits for 5 of 20 top plays
+    assert [finished for finished, __ in partials] == [5]
+    first = partials[0][1]
+    assert first and not {top_play.beatmap_id for top_play in TOP_PLAYS} & set(first)
+    assert list(first.values()) == sorted(first.values(), reverse=True)
+
+    recommender.pool.run_all()
+    assert [finished for finished, __ in partials] == list(range(5, 20))
+    # refinements only ever add players
+    assert all(job.counter[beatmap_id] >= count for beatmap_id, count in first.items())
+    assert list(results[0].items()) == [tuple(item) for item in FIXTURE["ranking"]]
+
+
+def test_refine():
+    shown = [(3, 10), (1, 8)]
+    assert list(refine(shown, OrderedDict([(1, 12), (2, 11), (3, 10), (4, 1)])).items()) == \
+        [(3, 10), (1, 8), (2, 11), (4, 1)]
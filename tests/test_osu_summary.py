@@ -0,0 +1,97 @@
+import datetime
+import threading
+import time
+from collections import Counter, OrderedDict
+from types import SimpleNamespace
+
+import slider
+
+from FruityBot.modules.osu import Osu
+from FruityBot.modules.osu_library import BeatmapCache
+from FruityBot.modules.osu_summary import BeatmapSummary, BeatmapSummaryStore
+from FruityBot.utils import SingleFlight
+
+BEATMAP = SimpleNamespace(beatmap_set_id=457332, mode=slider.GameMode.ctb, approach_rate=9.0, overall_difficulty=9.0,
+                          max_combo=2081, hit_objects=[None] * 1604,
+                          display_name="Camellia - Exit This Earth's Atomosphere [Overdose]")
+BEATMAP_API = SimpleNamespace(beatmap_id=1514618, star_rating=7.1382, max_combo=2081,
+                              hit_length=datetime.timedelta(seconds=238))
+
+
+def summary(**kwargs):
+    s = BeatmapSummary.from_beatmap(BEATMAP, BEATMAP_API, slider.GameMode.ctb)
+    for k, v in kwargs.items():
+        setattr(s, k, v)
+    return s
+
+
+def test_summary_pack():
+    s = summary()
+    assert BeatmapSummary.unpack(s.pack()) == s
+    assert len(s.pack()) < 128
+    assert not hasattr(s, "__dict__")
+
+
+def test_summary_store(tmp_path):
+    store = BeatmapSummaryStore(tmp_path / "summaries.bin")
+    store.add(summary())
+    store.add(summary(star_rating=7.5))
+    assert store.get(1514618, slider.GameMode.ctb).star_rating == 7.5
+    assert store.get(1514618, slider.GameMode.taiko) is None
+    assert store.map_mode(1514618) == slider.GameMode.ctb
+
+    reopened = BeatmapSummaryStore(tmp_path / "summaries.bin")
+    assert reopened.get(1514618, slider.GameMode.ctb) == store.get(1514618, slider.GameMode.ctb)
+    assert len(reopened) == 1
+
+
+def test_summary_store_ttl():
+    store = BeatmapSummaryStore(ttl=60)
+    store.add(summary(fetched=0))
+    assert store.get(1514618, slider.GameMode.ctb) is None
+
+
+def test_format_message():
+    message = Osu.format_message(summary(), (OrderedDict(acc=1., player_combo=2081, miss=0),))
+    assert message.startswith("Camellia - Exit This Earth's Atomosphere [Overdose] | osu!catch | SS: ")
+    assert message.endswith("| 7.14* 03:58 AR9.0 MAX2081")
+
+
+def test_get_data_single_flight(monkeypatch):
+    fetches = Counter()
+
+    def lookup_by_id(beatmap_id, *, download=False, save=False):
+        fetches["beatmap"] += 1
+        time.sleep(.1)
+        return BEATMAP
+
+    def get_api_data(beatmap_id, mode):
+        fetches["api"] += 1
+        time.sleep(.1)
+        return BEATMAP_API
+
+    osu = Osu.__new__(Osu)
+    osu.bot = None
+    osu.summaries = BeatmapSummaryStore()
+    osu.summary_flight = SingleFlight()
+    osu.beatmap_cache = BeatmapCache(None)
+    osu.beatmap_cache.open_library = lambda: SimpleNamespace(lookup_by_id=lookup_by_id)
+    osu.get_api_data = get_api_data
+    monkeypatch.setattr("FruityBot.modules.osu.check_mode_in_db", lambda *args, **kwargs: int(slider.GameMode.ctb))
+
+    barrier = threading.Barrier(16)
+    results = []
+
+    def get_data():
+        barrier.wait()
+        results.append(osu.get_data(SimpleNamespace(source="user"), 1514618))
+
+    threads = [threading.Thread(target=get_data) for __ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # one download and one API call for all 16 callers
+    assert fetches == {"beatmap": 1, "api": 1}
+    assert len(results) == 16 and all(result == results[0] for result in results)
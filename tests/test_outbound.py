@@ -0,0 +1,123 @@
+import random
+
+import numpy
+from twisted.internet import task
+
+from FruityBot.core_bot.outbound import NOTICE, PROGRESS, REPLY, OutboundQueue
+
+
+def outbound(rate=1., burst=5, lines=lambda message: 1):
+    clock = task.Clock()
+    sent = []
+
+    def send(user, message, length):
+        sent.append((clock.seconds(), user, message))
+        return lines(message)
+
+    return OutboundQueue(send, rate, burst, reactor=clock), clock, sent
+
+
+def test_outbound_budget():
+    queue, clock, sent = outbound(burst=3)
+    for i in range(6):
+        queue.put("de/odex", f"line {i}")
+    # the burst goes out at once, then a line a second
+    assert [t for t, __, __ in sent] == [0, 0, 0]
+    clock.advance(1)
+    assert len(sent) == 4
+    clock.pump([1] * 5)
+    assert [t for t, __, __ in sent] == [0, 0, 0, 1, 2, 3]
+
+
+def test_outbound_multiline_cost():
+    queue, clock, sent = outbound(burst=3, lines=lambda message: 3)
+    queue.put("de/odex", "a long reply")
+    queue.put("de/odex", "another")
+    # the first reply took the whole burst
+    assert len(sent) == 1
+    clock.advance(1)
+    assert len(sent) == 2
+
+
+def test_outbound_fair_and_prioritized():
+    queue, clock, sent = outbound(burst=1)
+    queue.put("owner", "Bot started.", priority=NOTICE)
+    for i in range(3):
+        queue.put("heavy", f"reply {i}")
+    queue.put("light", "reply")
+    for i in range(3):
+        queue.put("heavy", f"progress {i}", priority=PROGRESS)
+    clock.pump([1] * 10)
+
+    # round-robin between users, replies before progress before notices, and only the latest progress
+    assert [(user, message) for __, user, message in sent] == [
+        ("owner", "Bot started."), ("heavy", "reply 0"), ("light", "reply"), ("heavy", "reply 1"),
+        ("heavy", "reply 2"), ("heavy", "progress 2"),
+    ]
+    assert queue.metrics()["superseded"] == 2
+
+
+def test_outbound_reply_drops_progress():
+    queue, clock, sent = outbound(burst=1)
+    queue.put("other", "reply")
+    queue.put("de/odex", "Progress: ██░", priority=PROGRESS)
+    queue.put("de/odex", "Camellia - Exit This Earth's Atomosphere [Overdose]")
+    clock.pump([1] * 5)
+    assert [message for __, __, message in sent] == ["reply", "Camellia - Exit This Earth's Atomosphere [Overdose]"]
+    assert queue.metrics()["superseded"] == 1
+
+
+def test_outbound_stop():
+    queue, clock, sent = outbound(burst=1)
+    for i in range(3):
+        queue.put("de/odex", f"line {i}")
+    queue.stop()
+    clock.pump([1] * 3)
+    assert len(sent) == 1 and queue.pending() == 0
+
+
+def workload(users=20, seconds=120, seed=0):
+    """(time, user, message, priority, lines): users each running a command now and then, while one user's
+    !r streams progress bars and four-line replies."""
+    rng = random.Random(seed)
+    return sorted([(rng.uniform(0, seconds), f"user{rng.randrange(users)}", "reply", REPLY, 1)
+                   for __ in range(seconds // 3)] +
+                  [(t, "heavy", f"progress {t}", PROGRESS, 1) for t in numpy.arange(0, seconds, .5)] +
+                  [(t, "heavy", "rec", REPLY, 4) for t in range(0, seconds, 10)])
+
+
+def reply_latency(events):
+    """p50 and p99 reply latency of everyone but the heavy user, a line a second in bursts of 5."""
+    queue, clock, sent = outbound(rate=1., burst=5, lines=lambda message: 4 if message == "rec" else 1)
+    queued = {}
+    for t, user, message, priority, __ in events:
+        clock.advance(t - clock.seconds())
+        queued.setdefault((user, message), []).append(t)
+        queue.put(user, message, priority=priority)
+    clock.pump([1] * 1000)
+
+    latencies = [t - queued[user, message].pop(0) for t, user, message in sent
+                 if user != "heavy" and message == "reply"]
+    assert len(latencies) == sum(user != "heavy" for __, user, *__ in events)
+    return numpy.percentile(latencies, [50, 99])
+
+
+def line_rate_latency(events):
+    """The same under IRCClient.lineRate = 1: every line in one queue, a line a second."""
+    free, latencies = 0., []
+    for t, user, message, __, lines in events:
+        start = max(free, t)
+        free = start + lines
+        if user != "heavy":
+            latencies.append(start - t)
+    return numpy.percentile(latencies, [50, 99])
+
+
+def test_outbound_reply_latency():
+    for seed in range(5):
+        events = workload(seed=seed)
+        p50, p99 = reply_latency(events)
+        assert p50 <= 3
+        assert p99 <= 6
+        # the progress bars alone take the whole budget there, so replies wait ever longer
+        assert line_rate_latency(events)[0] > 10 * p99
@@ -0,0 +1,28 @@
+import pytest
+
+from FruityBot.core_bot.router import CommandRouter, ParsedCommand
+
+
+def np(e):
+    pass
+
+
+def acc(e):
+    pass
+
+
+@pytest.fixture
+def router():
+    return CommandRouter("!", {"np": np, "acc": acc})
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("!np https://osu.ppy.sh/b/1514618", (ParsedCommand("np", ("https://osu.ppy.sh/b/1514618",), np),)),
+    ("!np link; acc 99 4m", (ParsedCommand("np", ("link",), np), ParsedCommand("acc", ("99", "4m"), acc))),
+    ("!np link; !acc 99;", (ParsedCommand("np", ("link",), np), ParsedCommand("acc", ("99",), acc))),
+    ("!nope", (ParsedCommand("nope", (), None),)),
+    ("hello there", ()),
+    ("!", ()),
+])
+def test_router_parse(router, line, expected):
+    assert router.parse(line) == expected
@@ -0,0 +1,91 @@
+import logging
+import sys
+import threading
+from types import SimpleNamespace
+
+from FruityBot.modules.osu import Osu, requires_library
+from FruityBot.modules.osu_coplay import CoPlayIndex
+from FruityBot.startup import StartupProfile
+
+
+def test_startup_profile(caplog):
+    profile = StartupProfile()
+    with profile.phase("disabled"):
+        pass
+    assert profile.phases == []
+
+    profile.enable()
+    try:
+        with profile.phase("imports"):
+            import json  # noqa: F401
+            sys.modules.pop("colorsys", None)
+            import colorsys  # noqa: F401
+    finally:
+        profile.disable()
+    assert [name for name, __, __ in profile.phases] == ["imports"]
+    # only what wasn't imported already
+    assert "colorsys" in profile.imports and "json" not in profile.imports
+
+    profile.enable()
+    with caplog.at_level(logging.INFO, logger="FruityBot.startup"):
+        profile.report("signed on")
+        profile.report("signed on")
+    assert not profile.enabled
+    assert sum("signed on after" in message for message in caplog.messages) == 1
+    assert any("phase imports" in message for message in caplog.messages)
+
+
+class Loading:
+    def __init__(self):
+        self.library_ready = threading.Event()
+        self.sent = []
+        self.bot = SimpleNamespace(msg=lambda nick, message: self.sent.append(message),
+                                   user_pref={"de/odex": SimpleNamespace(locale="en")})
+
+    @requires_library
+    def np(self, e):
+        return "pp"
+
+
+def test_requires_library(monkeypatch):
+    monkeypatch.setattr("FruityBot.modules.osu.tl", lambda key, locale: key)
+    module = Loading()
+    e = SimpleNamespace(source=SimpleNamespace(nick="de/odex"))
+    assert module.np(e) is None
+    assert module.sent == ["osu.loading"]
+
+    module.library_ready.set()
+    assert module.np(e) == "pp"
+
+
+def test_load_library_recovers(monkeypatch, tmp_path):
+    calls = []
+
+    def create_db(directory, recurse=True, session=None):
+        calls.append(directory)
+        if len(calls) == 1:
+            raise OSError("osulib is on a drive that isn't mounted yet")
+        return "library"
+
+    monkeypatch.setattr("FruityBot.modules.osu.SessionLibrary.create_db", create_db)
+    (tmp_path / CoPlayIndex.FILE).write_bytes(b"not an npz file")
+    sent = []
+    config = SimpleNamespace(osu={"library_retry": 0}, main=SimpleNamespace(owner="de/odex"))
+    osu = Osu.__new__(Osu)
+    osu.bot = SimpleNamespace(Config=lambda: config, msg=lambda nick, message, priority: sent.append(nick))
+    osu.lib_dir, osu.osu_api_client, osu.http = tmp_path, SimpleNamespace(library=None), None
+    osu.library_ready, osu.closed = threading.Event(), threading.Event()
+
+    osu.load_library()
+    assert len(calls) == 2 and osu.library_ready.is_set()
+    assert osu.osu_library == osu.osu_api_client.library == "library"
+    assert len(osu.coplay) == 0 and (tmp_path / (CoPlayIndex.FILE + ".broken")).exists()
+    assert sent == ["de/odex", "de/odex"]
+
+    # closing stops the retries
+    calls.clear()
+    osu.library_ready.clear()
+    osu.closed.set()
+    osu.bot.Config().osu["library_retry"] = 60
+    osu.load_library()
+    assert len(calls) == 1 and not osu.library_ready.is_set()
@@ -0,0 +1,30 @@
+import time
+
+from FruityBot.utils import LRUCache
+
+
+def test_lru_cache_evicts_least_recent():
+    cache = LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache.get("a")
+    cache["c"] = 3
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_pop():
+    cache = LRUCache(2)
+    cache["a"] = 1
+    assert cache.pop("a") == 1
+    assert cache.get("a", "missing") == "missing"
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(2, ttl=0.01)
+    cache["a"] = 1
+    assert cache.get("a") == 1
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert "a" not in cache